@@ -0,0 +1,115 @@
+import chess
+
+from batch_eval import batch_eval
+from evaluation import trivial_reward
+
+
+def move_keys(games, moves):
+    # Post-move EPD of every legal (game, move) pair (None for illegal ones and for positions the board alone decides,
+    # see trivial_reward), so spellings of the same move share a key
+    boards = {}
+    keys = []
+    for g, m in zip(games, moves):
+        board = boards.get(g)
+        if board is None:
+            board = boards[g] = chess.Board(g)
+        try:
+            move = board.parse_san(m)
+        except ValueError:
+            keys.append(None)
+            continue
+        board.push(move)
+        keys.append(board.epd() if trivial_reward(board, count=False) is None else None)
+        board.pop()
+    return keys
+
+
+def is_mate_reward(score):
+    # score_to_reward maps centipawn scores into (0.1, 0.9), mate scores to the ends
+    return score >= 0.9 or score <= 0.1
+
+
+def uncertainty(scores, keys, games, band=(0.3, 0.7), rank_margin=0.05):
+    # Priority of every distinct legal position for a deeper search (lower is more uncertain), positions that are
+    # neither in the uncertain reward band nor within rank_margin of another move of the same prompt are left out.
+    # Mate scores are exact enough (ties between mates are not ambiguous) and never selected
+    groups = {}
+    for i, key in enumerate(keys):
+        if key is not None and not is_mate_reward(scores[i]):
+            groups.setdefault(games[i], {})[key] = scores[i]
+
+    priorities = {}
+    for group in groups.values():
+        ranked = sorted(group.items(), key=lambda kv: kv[1])
+        for n, (key, score) in enumerate(ranked):
+            gaps = [abs(score - ranked[j][1]) for j in (n - 1, n + 1) if 0 <= j < len(ranked)]
+            gap = min(gaps) if len(gaps) > 0 else float('inf')
+
+            in_band = band[0] <= score <= band[1]
+            ambiguous = gap < rank_margin
+            if in_band or ambiguous:
+                priorities[key] = min(abs(score - 0.5) if in_band else float('inf'), gap if ambiguous else float('inf'))
+    return priorities
+
+
+# Scores (game, move) pairs with an iterative deepening schedule: every prompt is screened with one grouped MultiPV
+# search of low_nodes (the budget is shared by the lines of the search), then the positions whose reward is uncertain
+# (inside band) or whose rank among the completions of their prompt is ambiguous (within rank_margin of a neighbour)
+# are searched again on their own with high_nodes, most uncertain first, until budget (a fraction of the cost of
+# searching every position on its own with high_nodes) is spent.
+# The report holds the nodes the engines reported searching, next to the estimate of that fixed high_nodes run
+def adaptive_batch_eval(games, moves, n_jobs, low_nodes=2_000, high_nodes=50_000, budget=0.5, band=(0.3, 0.7), rank_margin=0.05,
+                        return_messages=False, return_report=False, backend='joblib', use_cache=True):
+    results, info = batch_eval(games, moves, n_jobs, enable_tqdm=False, use_cache=use_cache, group_moves=True, return_messages=True,
+                               backend=backend, nodes=low_nodes, return_info=True)
+
+    keys = move_keys(games, moves)
+    for i, (score, message) in enumerate(results):
+        if message != "Valid move":
+            keys[i] = None
+    num_positions = len(set(k for k in keys if k is not None))
+
+    fixed_nodes = info['positions'] * high_nodes
+    spent_nodes = info['nodes']
+    num_researches = max(0, int((budget * fixed_nodes - spent_nodes) // high_nodes))
+
+    priorities = uncertainty([r[0] for r in results], keys, games, band, rank_margin)
+    research = set(sorted(priorities, key=priorities.get)[:num_researches])
+
+    idxs = {}
+    for i, key in enumerate(keys):
+        if key in research:
+            idxs.setdefault(key, []).append(i)
+
+    if len(idxs) > 0:
+        first = [ids[0] for ids in idxs.values()]
+        deeper, info = batch_eval([games[i] for i in first], [moves[i] for i in first], n_jobs, enable_tqdm=False, use_cache=use_cache,
+                                  group_moves=False, return_messages=True, backend=backend, nodes=high_nodes, return_info=True)
+        for ids, result in zip(idxs.values(), deeper):
+            for i in ids:
+                results[i] = result
+        spent_nodes += info['nodes']
+
+    ret = results if return_messages else [r[0] for r in results]
+    if not return_report:
+        return ret
+
+    report = {'positions': num_positions, 'uncertain': len(priorities), 'researched': len(idxs),
+              'nodes': spent_nodes, 'fixed_nodes': fixed_nodes,
+              'saved': 1 - spent_nodes / fixed_nodes if fixed_nodes > 0 else 0.0}
+    return ret, report
+
+
+if __name__ == '__main__':
+    from dataset.parquetShards import load_shards
+
+    # A few completions per prompt, like a GRPO group
+    games, moves = [], []
+    for fen in load_shards('data/small_shards').select(range(64))['prompt']:
+        board = chess.Board(fen)
+        for move in list(board.legal_moves)[:4]:
+            games.append(fen)
+            moves.append(board.san(move))
+
+    scores, report = adaptive_batch_eval(games, moves, 10, return_report=True)
+    print(report)
@@ -1,26 +1,130 @@
 import json
+import threading
+from concurrent.futures import as_completed
 
-from flask import Flask, request, jsonify
-from batch_eval import batch_eval
+from flask import Flask, request, jsonify, Response
+from async_eval import get_evaluator, MicroBatcher
+from evaluation import shortcut_stats
 
 app = Flask(__name__)
 
+n_jobs = 10
+max_concurrent_requests = 32
 
+# Requests from all clients share the engines of one evaluator and are merged into batches by one batcher
+evaluator = get_evaluator(num_engines=n_jobs)
+batcher = None
+batcher_lock = threading.Lock()
+request_slots = threading.BoundedSemaphore(max_concurrent_requests)
+active_requests = 0
+active_lock = threading.Lock()
+
+
+def get_batcher():
+    global batcher
+    with batcher_lock:
+        if batcher is None:
+            async def make_batcher():
+                return MicroBatcher(evaluator.evaluator, max_batch=64, max_wait=0.01)
+            batcher = evaluator.run(make_batcher())
+    return batcher
+
+
+def get_limit():
+    # Search limit of a request: ?nodes=N or ?depth=D for a fixed budget (reproducible rewards), else ?time=T seconds.
+    # ?group_moves=1 scores the completions of a prompt with one shared MultiPV search instead of one search each
+    nodes = request.args.get('nodes', type=int)
+    depth = request.args.get('depth', type=int)
+    time = request.args.get('time', default=0.1, type=float)
+    group_moves = request.args.get('group_moves', default=0, type=int) == 1
+    return {'time': time, 'nodes': nodes, 'depth': depth, 'group_moves': group_moves}
 
-@app.route('/eval', methods=['POST'])
-def hello():
-    data = request.get_json(force=True)
 
+def submit(data, limit):
     games = [d['prompt'] for d in data]
     moves = [d['completion'] for d in data]
-    n_jobs = 10
+    b = get_batcher()
+    return [evaluator.submit(b.submit(g, m, **limit)) for g, m in zip(games, moves)]
+
+
+def acquire_slot():
+    global active_requests
+    if not request_slots.acquire(blocking=False):
+        return False
+    with active_lock:
+        active_requests += 1
+    return True
+
+
+def release_slot():
+    global active_requests
+    with active_lock:
+        active_requests -= 1
+    request_slots.release()
+
+
+def busy():
+    return jsonify({'error': f'Too many concurrent requests (max {max_concurrent_requests})'}), 503
+
+
+@app.route('/eval', methods=['POST'])
+def hello():
+    data = request.get_json(force=True)
+    limit = get_limit()
 
     #print(games)
     #print(moves)
 
-    return jsonify(batch_eval(games, moves, n_jobs))
+    if not acquire_slot():
+        return busy()
+    try:
+        futures = submit(data, limit)
+        return jsonify([f.result()[0] for f in futures])
+    finally:
+        release_slot()
+
+
+@app.route('/eval/stream', methods=['POST'])
+def eval_stream():
+    # Streams one NDJSON line per evaluation as soon as it finishes, in completion order
+    data = request.get_json(force=True)
+    limit = get_limit()
+
+    if not acquire_slot():
+        return busy()
+    try:
+        futures = submit(data, limit)
+    except Exception:
+        release_slot()
+        raise
+    index = {f: i for i, f in enumerate(futures)}
+
+    def generate():
+        try:
+            for f in as_completed(futures):
+                score, message = f.result()
+                yield json.dumps({'index': index[f], 'score': score, 'message': message}) + '\n'
+        finally:
+            release_slot()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = evaluator.stats()
+    b = batcher
+    stats.update({
+        'active_requests': active_requests,
+        'max_concurrent_requests': max_concurrent_requests,
+        'pending_items': 0 if b is None else b.pending_items(),
+        'batches': 0 if b is None else b.num_batches,
+        'batched_items': 0 if b is None else b.num_items,
+        'shortcuts': shortcut_stats(),
+    })
+    return jsonify(stats)
 
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True, threaded=True)
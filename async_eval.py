@@ -0,0 +1,387 @@
+import asyncio
+import atexit
+import threading
+import warnings
+
+import chess
+import chess.engine
+
+from engine_pool import STOCKFISH_PATH, make_limit, search_game
+from eval_cache import get_cache, position_key
+from evaluation import parse_move, info_to_reward, trivial_result, count_shortcuts, prepare_group, apply_group_infos, search_nodes
+
+
+class AsyncEngine():
+    def __init__(self, path, options, max_uses):
+        self.path = path
+        self.options = options
+        self.max_uses = max_uses
+        self.transport = None
+        self.protocol = None
+        self.uses = 0
+        self.num_restarts = 0
+
+    async def start(self):
+        self.transport, self.protocol = await chess.engine.popen_uci(self.path)
+        if self.options:
+            try:
+                await self.protocol.configure(self.options)
+            except Exception:
+                await self.stop()
+                raise
+        self.uses = 0
+
+    async def stop(self):
+        # Quits the engine, or kills its subprocess when it does not answer, so no process outlives a failed restart
+        if self.protocol is None:
+            return
+        try:
+            await asyncio.wait_for(self.protocol.quit(), 5)
+        except Exception:
+            try:
+                self.transport.close()
+            except Exception:
+                pass
+        finally:
+            self.transport, self.protocol = None, None
+
+    async def restart(self):
+        await self.stop()
+        self.num_restarts += 1
+        await self.start()
+
+
+class AsyncEvaluator():
+    """
+    One event loop driving `num_engines` UCI engine subprocesses.
+
+    Work goes through a bounded queue of `max_queue` jobs, so producers wait (backpressure)
+    when every engine is busy. Each search is cancelled after `task_timeout` seconds and its
+    engine is restarted, engines are also recycled after `max_uses` searches.
+    """
+
+    def __init__(self, path=None, num_engines=4, max_queue=256, task_timeout=30.0, max_uses=1000, options=None):
+        self.path = path or STOCKFISH_PATH
+        self.num_engines = num_engines
+        self.max_queue = max_queue
+        self.task_timeout = task_timeout
+        self.max_uses = max_uses
+        self.options = options or {}
+
+        self.engines = []
+        self.workers = []
+        self.queue = None
+        self.starting = None
+
+        self.num_searches = 0
+        self.num_timeouts = 0
+        self.num_errors = 0
+
+    async def _start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.engines = [AsyncEngine(self.path, self.options, self.max_uses) for _ in range(self.num_engines)]
+        await asyncio.gather(*(engine.start() for engine in self.engines))
+        self.workers = [asyncio.create_task(self._worker(engine)) for engine in self.engines]
+
+    async def start(self):
+        # Every caller waits on the same startup, engines are only spawned once
+        if self.starting is None:
+            self.starting = asyncio.ensure_future(self._start())
+        try:
+            await self.starting
+        except Exception:
+            # Let the next caller try to spawn the engines again
+            self.starting = None
+            raise
+
+    async def close(self):
+        if self.starting is None:
+            return
+        await asyncio.gather(self.starting, return_exceptions=True)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        await asyncio.gather(*(engine.stop() for engine in self.engines), return_exceptions=True)
+        self.starting = None
+
+    async def _worker(self, engine):
+        while True:
+            board, limit, multipv, root_moves, future = await self.queue.get()
+            try:
+                if future.cancelled():
+                    continue
+
+                if engine.protocol is None or engine.uses >= engine.max_uses:
+                    await engine.restart()
+
+                try:
+                    info = await asyncio.wait_for(engine.protocol.analyse(board, limit, multipv=multipv, root_moves=root_moves,
+                                                                          game=search_game(limit)), self.task_timeout)
+                    engine.uses += 1
+                    self.num_searches += 1
+                    if not future.cancelled():
+                        future.set_result(info)
+                except asyncio.TimeoutError as e:
+                    self.num_timeouts += 1
+                    await engine.restart()
+                    if not future.cancelled():
+                        future.set_exception(e)
+                except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+                    self.num_errors += 1
+                    await engine.restart()
+                    if not future.cancelled():
+                        future.set_exception(e)
+            except Exception as e:
+                # Engine could not be restarted, fail the job and try again on the next one
+                try:
+                    await engine.stop()
+                except Exception:
+                    engine.transport, engine.protocol = None, None
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def queue_depth(self):
+        return 0 if self.queue is None else self.queue.qsize()
+
+    def stats(self):
+        return {'engines': self.num_engines, 'queue_depth': self.queue_depth(), 'searches': self.num_searches,
+                'timeouts': self.num_timeouts, 'errors': self.num_errors,
+                'restarts': sum(engine.num_restarts for engine in self.engines)}
+
+    async def analyse(self, board, limit, multipv=None, root_moves=None):
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((board.copy(), limit, multipv, root_moves, future))
+        return await future
+
+    async def score_position(self, fen, time=0.1, nodes=None, depth=None):
+        # White point of view score, as used by diff_eval
+        try:
+            info = await self.analyse(chess.Board(fen), make_limit(time, nodes, depth))
+            return info["score"].white()
+        except Exception:
+            return None
+
+    async def evaluate(self, fen, san, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None, return_info=False):
+        # return_info adds {'nodes': nodes searched, 'shortcuts': [...]} and leaves counting the shortcuts to the caller,
+        # like evaluation.evaluate_position
+        result, search_info = await self._evaluate(fen, san, time, return_score_only, use_cache, nodes, depth)
+        if return_info:
+            return result, search_info
+        count_shortcuts(search_info['shortcuts'])
+        return result
+
+    async def _evaluate(self, fen, san, time, return_score_only, use_cache, nodes, depth):
+        search_info = {'nodes': 0, 'shortcuts': []}
+        board = chess.Board(fen)
+        limit = make_limit(time, nodes, depth)
+
+        move, message = parse_move(fen, board, san, classify=not return_score_only)
+        if move is None:
+            return (-1 if return_score_only else (-1, message)), search_info
+
+        try:
+            board.push(move)
+            key = position_key(board, limit)
+            score, shortcut = trivial_result(board)
+            if shortcut is not None:
+                search_info['shortcuts'].append(shortcut)
+            if score is None and use_cache:
+                score = get_cache().get(key)
+
+            if score is None:
+                info = await self.analyse(board, limit)
+                search_info['nodes'] += info.get('nodes', 0)
+                score = info_to_reward(info, board)
+                if use_cache:
+                    get_cache().put(key, score)
+
+            return (score if return_score_only else (score, "Valid move")), search_info
+        except Exception:
+            return (0.5 if return_score_only else (0.5, 'Unknown error')), search_info
+
+    async def evaluate_group(self, fen, sans, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None, return_info=False):
+        board = chess.Board(fen)
+        limit = make_limit(time, nodes, depth)
+
+        search_info = {'nodes': 0, 'shortcuts': []}
+        results, moves, keys, search_moves = prepare_group(fen, board, sans, limit, not return_score_only, use_cache, search_info['shortcuts'])
+
+        if len(search_moves) > 0:
+            try:
+                infos = await self.analyse(board, limit, multipv=len(search_moves), root_moves=search_moves)
+                search_info['nodes'] += search_nodes(infos)
+                apply_group_infos(infos, board, results, moves, keys, use_cache)
+            except Exception:
+                pass
+
+            missing = [move for move in search_moves if results[moves[move][0]] is None]
+            scores = await asyncio.gather(*(self.evaluate(fen, sans[moves[move][0]], time, use_cache=use_cache, nodes=nodes, depth=depth,
+                                                          return_info=True)
+                                            for move in missing))
+            for move, (result, info) in zip(missing, scores):
+                search_info['nodes'] += info['nodes']
+                search_info['shortcuts'] += info['shortcuts']
+                for i in moves[move]:
+                    results[i] = result
+
+        if return_score_only:
+            results = [r[0] for r in results]
+        if return_info:
+            return results, search_info
+        count_shortcuts(search_info['shortcuts'])
+        return results
+
+    async def evaluate_many(self, games, moves, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None, return_info=False):
+        return await asyncio.gather(*(self.evaluate(g, m, time, return_score_only, use_cache, nodes, depth, return_info)
+                                      for g, m in zip(games, moves)))
+
+
+class MicroBatcher():
+    """
+    Merges evaluation requests from many callers into shared engine batches.
+
+    Items are collected for up to `max_wait` seconds or `max_batch` items, then identical
+    (prompt, completion) pairs are merged. Every distinct move gets its own search (the same
+    rewards as evaluate_position), unless the items were submitted with group_moves=True, then
+    the moves of a prompt share one evaluate_group MultiPV search (cheaper, but the time or
+    nodes budget is split between the lines). Must be used from the evaluator's event loop.
+    """
+
+    def __init__(self, evaluator, max_batch=64, max_wait=0.01):
+        self.evaluator = evaluator
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.pending = []
+        self.timer = None
+
+        self.num_batches = 0
+        self.num_items = 0
+
+    def pending_items(self):
+        return len(self.pending)
+
+    async def submit(self, fen, san, time=0.1, nodes=None, depth=None, group_moves=False):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((fen, san, (time, nodes, depth, group_moves), future))
+
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if len(batch) > 0:
+            self.num_batches += 1
+            self.num_items += len(batch)
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        # Items are grouped by prompt and search limit (time, nodes, depth, group_moves)
+        groups = {}
+        for fen, san, limit, future in batch:
+            groups.setdefault((fen, limit), {}).setdefault(san, []).append(future)
+
+        async def run_group(fen, limit, sans):
+            time, nodes, depth, group_moves = limit
+            try:
+                if group_moves and len(sans) > 1:
+                    results = await self.evaluator.evaluate_group(fen, sans, time, nodes=nodes, depth=depth)
+                else:
+                    results = await asyncio.gather(*(self.evaluator.evaluate(fen, san, time, nodes=nodes, depth=depth) for san in sans))
+            except Exception:
+                results = [(0.5, 'Unknown error')] * len(sans)
+
+            for san, result in zip(sans, results):
+                for future in groups[(fen, limit)][san]:
+                    if not future.done():
+                        future.set_result(result)
+
+        await asyncio.gather(*(run_group(fen, limit, list(sans)) for (fen, limit), sans in groups.items()))
+
+
+class SyncEvaluator():
+    """
+    Runs an AsyncEvaluator on an event loop in a background thread, for callers without a loop.
+    Every method blocks until its results are ready and can be called from any thread.
+    """
+
+    def __init__(self, **kwargs):
+        self.evaluator = AsyncEvaluator(**kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-eval', daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def submit(self, coro):
+        # Returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def evaluate(self, fen, san, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None):
+        return self.run(self.evaluator.evaluate(fen, san, time, return_score_only, use_cache, nodes, depth))
+
+    def evaluate_many(self, games, moves, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None, return_info=False):
+        return self.run(self.evaluator.evaluate_many(games, moves, time, return_score_only, use_cache, nodes, depth, return_info))
+
+    def evaluate_groups(self, groups, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None, return_info=False):
+        # groups is a list of (fen, sans) pairs
+        async def run_groups():
+            return await asyncio.gather(*(self.evaluator.evaluate_group(fen, sans, time, return_score_only, use_cache, nodes, depth, return_info)
+                                          for fen, sans in groups))
+        return self.run(run_groups())
+
+    def score_positions(self, fens, time=0.1, nodes=None, depth=None):
+        async def run_positions():
+            return await asyncio.gather(*(self.evaluator.score_position(fen, time, nodes, depth) for fen in fens))
+        return self.run(run_positions())
+
+    def stats(self):
+        return self.evaluator.stats()
+
+    def close(self):
+        if not self.loop.is_running():
+            return
+        try:
+            self.run(self.evaluator.close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(5)
+
+
+_evaluator = None
+_evaluator_lock = threading.Lock()
+
+
+def get_evaluator(num_engines=4, **kwargs):
+    # The evaluator is shared by the whole process, it keeps the size it was created with (other callers may be using
+    # it, so it is not resized), close_evaluator() first to change it
+    global _evaluator
+    with _evaluator_lock:
+        if _evaluator is None:
+            _evaluator = SyncEvaluator(num_engines=num_engines, **kwargs)
+        elif _evaluator.evaluator.num_engines != num_engines:
+            warnings.warn(f'Shared evaluator already runs {_evaluator.evaluator.num_engines} engines, ignoring num_engines={num_engines}')
+    return _evaluator
+
+
+def close_evaluator():
+    global _evaluator
+    with _evaluator_lock:
+        evaluator, _evaluator = _evaluator, None
+    if evaluator is not None:
+        evaluator.close()
+
+
+# Quit the engines at exit, the event loop thread is a daemon so it still runs when atexit hooks do
+atexit.register(close_evaluator)
@@ -7,30 +7,146 @@ import chess
 import chess.engine
 from tqdm import tqdm
 
-from evaluation import evaluate_position
+from evaluation import evaluate_position, evaluate_group, parse_move, trivial_reward, count_shortcuts
+from engine_pool import get_pool, make_limit, search_game
+from eval_cache import get_cache, position_key
+from async_eval import get_evaluator
 
 
-def get_eval(game, move):
-    engine = chess.engine.SimpleEngine.popen_uci('stockfish/stockfish-windows-x86-64-avx2.exe')
+def get_eval(game, move, time=1, nodes=None, depth=None):
     board = chess.Board(game)
+    limit = make_limit(time, nodes, depth)
     try:
         board.push_san(move)
-        evaluation = engine.analyse(board, chess.engine.Limit(time=1))['score']
+        with get_pool().lease() as engine:
+            evaluation = engine.analyse(board, limit, game=search_game(limit))['score']
         score = evaluation.relative.score(mate_score=math.inf)
         score /= -100
         score = 1 / (1 + 10 ** (-score / 4))
         return score
     except Exception:
         return 0
-    finally:
-        engine.quit()
 
 
-def batch_eval(games, moves, n_jobs, time=0.1, enable_tqdm=True):
-    if enable_tqdm:
-        ret = Parallel(n_jobs=n_jobs)(delayed(evaluate_position)(g, m, time, return_score_only=True) for g, m in tqdm(zip(games, moves), total=len(games)))
-    else:
-        ret = Parallel(n_jobs=n_jobs)(delayed(evaluate_position)(g, m, time, return_score_only=True) for g, m in zip(games, moves))
+def batch_eval(games, moves, n_jobs, time=0.1, enable_tqdm=True, use_cache=True, group_moves=False, return_messages=False, backend='joblib',
+               nodes=None, depth=None, return_info=False):
+    # backend='joblib' runs the searches in n_jobs worker processes, backend='async' on n_jobs engines
+    # driven by one event loop in this process (async_eval).
+    # nodes / depth replace the time limit with a fixed budget, so rewards do not depend on the load of the machine.
+    # return_info adds {'positions': positions sent to the engines, 'nodes': nodes they searched}, measured from the
+    # engine reports (cached and trivially decided positions cost nothing, a grouped MultiPV search counts once).
+    # Grouped rewards are cached apart from per move ones (position_key with multipv), their budget is split
+    cache = get_cache()
+    limit = make_limit(time, nodes, depth)
+    ret = [None] * len(games)
+
+    # Phase 1: parse every pair in this process, illegal moves, positions decided by the board alone (trivial_reward)
+    # and cached positions never reach a worker
+    boards = {}
+    todo = {}
+    todo_moves = {}
+    for i, (g, m) in enumerate(zip(games, moves)):
+        board = boards.get(g)
+        if board is None:
+            board = boards[g] = chess.Board(g)
+
+        move, message = parse_move(g, board, m, classify=return_messages)
+        if move is None:
+            ret[i] = (-1, message)
+            continue
+
+        board.push(move)
+        key = position_key(board, limit)
+        score = trivial_reward(board) if key not in todo else None
+        board.pop()
+
+        if key in todo:
+            todo[key].append(i)
+            continue
+
+        if score is None and use_cache and not group_moves:
+            score = cache.get(key)
+        if score is not None:
+            ret[i] = (score, "Valid move")
+        else:
+            todo[key] = [i]
+            todo_moves[key] = move
+
+    # Phase 2: send every distinct legal, uncached position to the engines once
+    entries = list(todo.items())
+    keys = [key for key, _ in entries]
+    results = [None] * len(entries)
+    infos = []
+    num_searched = len(entries)
+    if group_moves and len(entries) > 0:
+        # One root search per prompt, restricted to the moves of its completions
+        groups = {}
+        for n, (_, idxs) in enumerate(entries):
+            groups.setdefault(games[idxs[0]], []).append(n)
+
+        # Keys carry the width of the prompt's MultiPV search, a prompt is served from the cache when all of its moves are
+        for g, ns in groups.items():
+            board = boards[g]
+            for n in ns:
+                board.push(todo_moves[entries[n][0]])
+                keys[n] = position_key(board, limit, multipv=len(ns))
+                board.pop()
+        if use_cache:
+            for g, ns in list(groups.items()):
+                scores = [cache.get(keys[n]) for n in ns]
+                if all(score is not None for score in scores):
+                    for n, score in zip(ns, scores):
+                        results[n] = (score, "Valid move")
+                    del groups[g]
+        num_searched = sum(len(ns) for ns in groups.values())
+
+        jobs = [(g, [moves[entries[n][1][0]] for n in ns]) for g, ns in groups.items()]
+        if len(jobs) == 0:
+            group_results = []
+        elif backend == 'async':
+            group_results = get_evaluator(num_engines=n_jobs).evaluate_groups(jobs, time, use_cache=False, nodes=nodes, depth=depth, return_info=True)
+        else:
+            if enable_tqdm:
+                jobs = tqdm(jobs)
+            group_results = Parallel(n_jobs=n_jobs)(delayed(evaluate_group)(g, sans, time, use_cache=False, nodes=nodes, depth=depth, return_info=True)
+                                                    for g, sans in jobs)
+
+        for ns, (rs, info) in zip(groups.values(), group_results):
+            infos.append(info)
+            for n, r in zip(ns, rs):
+                results[n] = r
+                if use_cache and r[1] == "Valid move":
+                    cache.put(keys[n], r[0])
+    elif len(entries) > 0:
+        jobs = [idxs[0] for _, idxs in entries]
+
+        if backend == 'async':
+            results = get_evaluator(num_engines=n_jobs).evaluate_many([games[i] for i in jobs], [moves[i] for i in jobs], time, use_cache=False,
+                                                                      nodes=nodes, depth=depth, return_info=True)
+        else:
+            if enable_tqdm:
+                jobs = tqdm(jobs)
+            results = Parallel(n_jobs=n_jobs)(delayed(evaluate_position)(games[i], moves[i], time, use_cache=False, nodes=nodes, depth=depth,
+                                                                         return_info=True)
+                                              for i in jobs)
+        infos = [info for _, info in results]
+        results = [result for result, _ in results]
+        if use_cache:
+            for key, result in zip(keys, results):
+                if result[1] == "Valid move":
+                    cache.put(key, result[0])
+
+    for (_, idxs), result in zip(entries, results):
+        for i in idxs:
+            ret[i] = result
+    cache.flush()
+    # Shortcuts taken by the engine side (in worker processes with joblib) are counted here, in the caller's process
+    count_shortcuts(name for info in infos for name in info['shortcuts'])
+
+    if not return_messages:
+        ret = [r[0] for r in ret]
+    if return_info:
+        return ret, {'positions': num_searched, 'nodes': sum(info['nodes'] for info in infos)}
     return ret
 
 
@@ -1,51 +1,202 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoTokenizer, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
 import chess
-from evaluation import evaluate_position
+import torch
+from evaluation import parse_move
+
+
+class MoveBoundaryCriteria(StoppingCriteria):
+    """
+    Stops every sequence once its continuation holds a complete move, i.e. some text followed by whitespace.
+    """
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        return torch.tensor([len(text.split()) > 1 or (len(text.strip()) > 0 and text[-1].isspace()) for text in texts],
+                            dtype=torch.bool, device=input_ids.device)
+
+
+def san_trie(tokenizer, sans):
+    # Token-level prefix trie of SAN strings, tokenized like the completions the model was trained on. Nodes are
+    # {token: child} dicts, the None key marks a complete move and holds its SAN
+    root = {}
+    for san in sans:
+        node = root
+        for token in tokenizer(san, add_special_tokens=False)['input_ids']:
+            node = node.setdefault(token, {})
+        node[None] = san
+    return root
+
+
+def trie_depth(node):
+    children = [trie_depth(child) for token, child in node.items() if token is not None]
+    return 1 + max(children) if len(children) > 0 else 0
+
+
+class LegalMoveLogitsProcessor(LogitsProcessor):
+    """
+    Masks the logits of every row so only tokens continuing a legal move of its position can be decoded, and only
+    the end of sequence token once a complete move has been spelled. `tries` holds one san_trie per row, so rows of
+    different positions can share a batch.
+    """
+
+    def __init__(self, tries, prompt_length, eos_token_id):
+        self.tries = tries
+        self.prompt_length = prompt_length
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        mask = torch.full_like(scores, float('-inf'))
+        for row, (trie, tokens) in enumerate(zip(self.tries, input_ids[:, self.prompt_length:].tolist())):
+            node = trie
+            for token in tokens:
+                node = node.get(token) if node is not None else None
+            if node is None:
+                # Finished row (padded after its end of sequence token)
+                mask[row, self.eos_token_id] = 0
+                continue
+            allowed = [token for token in node if token is not None]
+            if None in node or len(allowed) == 0:
+                allowed.append(self.eos_token_id)
+            mask[row, allowed] = 0
+        return scores + mask
+
+
+def move_log_prob(tokenizer, tokens, log_probs):
+    # First move of a generated continuation and the summed log-probability of the tokens that spell it
+    text, total = '', 0.0
+    for token, log_prob in zip(tokens, log_probs):
+        if token == tokenizer.eos_token_id or token == tokenizer.pad_token_id:
+            break
+        piece = tokenizer.decode([token], skip_special_tokens=True)
+        if len(text.strip()) > 0 and (len(piece) == 0 or piece[0].isspace()):
+            break
+        text += piece
+        total += float(log_prob)
+        if len(text.split()) > 1:
+            break
+    words = text.split()
+    return (words[0] if len(words) > 0 else ''), total
+
+
+def generate_candidates(model, tokenizer, fens, num_candidates=8, max_new_tokens=8, constrained=True, do_sample=True, **generate_kwargs):
+    # Samples num_candidates continuations of every FEN in one left padded generate call and returns, per FEN, the
+    # (move, log-probability) pairs, most likely first. When constrained, decoding is restricted to the legal moves
+    # of each position and every row ends with the end of sequence token after one move, otherwise rows stop at the
+    # first move boundary. generate_kwargs (temperature, top_p...) go to model.generate
+    tokenizer.padding_side = 'left'
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    ret = [[] for _ in fens]
+    tries = None
+    if constrained:
+        tries = {}
+        for i, fen in enumerate(fens):
+            board = chess.Board(fen)
+            trie = san_trie(tokenizer, [board.san(move) for move in board.legal_moves])
+            if len(trie) > 0:
+                tries[i] = trie
+        fens = [fen for i, fen in enumerate(fens) if i in tries]
+        rows = list(tries.keys())
+        if len(rows) == 0:
+            return ret
+        max_new_tokens = max(trie_depth(trie) for trie in tries.values()) + 1
+    else:
+        rows = list(range(len(fens)))
+
+    inputs = tokenizer(fens, return_tensors='pt', padding=True).to(model.device)
+    prompt_length = inputs['input_ids'].shape[1]
+
+    logits_processor = LogitsProcessorList()
+    stopping_criteria = StoppingCriteriaList()
+    if constrained:
+        # generate repeats every prompt num_candidates times in a row
+        logits_processor.append(LegalMoveLogitsProcessor([tries[i] for i in rows for _ in range(num_candidates)],
+                                                         prompt_length, tokenizer.eos_token_id))
+    else:
+        stopping_criteria.append(MoveBoundaryCriteria(tokenizer, prompt_length))
+
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=do_sample,
+            num_return_sequences=num_candidates,
+            logits_processor=logits_processor,
+            stopping_criteria=stopping_criteria,
+            output_scores=True,
+            return_dict_in_generate=True,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            **generate_kwargs,
+        )
+    log_probs = model.compute_transition_scores(outputs.sequences, outputs.scores, normalize_logits=True)
+
+    sequences = outputs.sequences[:, prompt_length:].tolist()
+    log_probs = log_probs.tolist()
+    for n, i in enumerate(rows):
+        candidates = {}
+        for sequence, scores in zip(sequences[n * num_candidates:(n + 1) * num_candidates], log_probs[n * num_candidates:(n + 1) * num_candidates]):
+            move, log_prob = move_log_prob(tokenizer, sequence, scores)
+            if move not in candidates or log_prob > candidates[move]:
+                candidates[move] = log_prob
+        ret[i] = sorted(candidates.items(), key=lambda c: -c[1])
+    return ret
 
 
 class GRPOBot():
-    def __init__(self):
+    """
+    Plays the most likely legal move of the model. The model is loaded in process, or with `server` the moves come
+    from a shared ModelServer (an instance, or the address of one listening on a Unix socket) that batches the
+    requests of many games. `runtime` selects the CPU inference mode of bot.runtime.load_model ('fp32', 'int8' or
+    'onnx' for a directory written by export_onnx).
+    """
+
+    def __init__(self, model_path='saved/models/final_model', tokenizer_path='saved/tokenizers/final_model', num_candidates=8,
+                 max_new_tokens=8, constrained=True, server=None, runtime='fp32'):
         self.board = chess.Board()
-        self.model = AutoModelForCausalLM.from_pretrained('saved/models/final_model')
-        self.tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/final_model')
-        self.num_times_regen = 0
-        self.num_moves_regen = 0
+        self.num_candidates = num_candidates
+        self.max_new_tokens = max_new_tokens
+        self.constrained = constrained
+
+        if isinstance(server, str):
+            from bot.modelServer import ModelClient
+            server = ModelClient(server)
+        self.server = server
+        if server is None:
+            from bot.runtime import load_model
+            self.model = load_model(model_path, runtime)
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+        self.num_moves = 0
+        self.num_illegal_candidates = 0
         self.num_fails = 0
 
     def end(self):
-        print(f'num moves regened: {self.num_moves_regen}, num times regened: {self.num_times_regen}, num failures: {self.num_fails}')
-
-    def generate_text(self, prompt, p=0.7, do_sample=True):
-        inputs = self.tokenizer(prompt, return_tensors='pt').to(self.model.device)
-        if do_sample:
-            outputs = self.model.generate(
-                **inputs,
-                max_length=100,
-                do_sample=True,
-                top_p=p
-            )
-        else:
-            outputs = self.model.generate(**inputs)
-        return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        print(f'num moves: {self.num_moves}, num illegal candidates: {self.num_illegal_candidates}, num failures: {self.num_fails}')
+
+    def generate_candidates(self, fen, num_candidates=None):
+        num_candidates = num_candidates or self.num_candidates
+        if self.server is not None:
+            return self.server.candidates(fen, num_candidates)
+        return generate_candidates(self.model, self.tokenizer, [fen], num_candidates, self.max_new_tokens, self.constrained)[0]
 
     def get_move(self, fen):
-        res = self.generate_text(fen, do_sample=False)[len(fen):]
-        p = 0.7
-
-        if evaluate_position(fen, res)[1] != 'Valid move':
-            self.num_moves_regen += 1
-
-        while evaluate_position(fen, res)[1] != 'Valid move':
-            print(res, p)
-            self.num_times_regen += 1
-
-            if p > 5:
-                self.num_fails += 1
-                board = chess.Board(fen)
-                for move in board.legal_moves:
-                    return board.san(move)
-
-            print('Illegal, regenerating ...')
-            p += 0.05
-            res = self.generate_text(fen, p)[len(fen):]
-        return res
+        # Most likely legal candidate, legality is checked with parse_move (no engine search). With constrained
+        # decoding every candidate is legal, so this is the most likely one
+        board = chess.Board(fen)
+        self.num_moves += 1
+
+        for move, _ in self.generate_candidates(fen):
+            parsed, _ = parse_move(fen, board, move, classify=False)
+            if parsed is not None:
+                return board.san(parsed)
+            self.num_illegal_candidates += 1
+
+        self.num_fails += 1
+        for move in board.legal_moves:
+            return board.san(move)
@@ -0,0 +1,163 @@
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+import queue
+import threading
+import time
+
+from transformers import AutoTokenizer
+
+from bot.GRPOBot import generate_candidates
+from bot.runtime import load_model
+
+
+class ModelServer():
+    """
+    Loads the model once and serves move candidates to many games.
+
+    Requests are collected for up to `max_wait` seconds after the first one arrives, or until `max_batch`
+    positions are pending, and every batch runs as one left padded generate call on a background thread.
+    `candidates` can be called from any thread; `listen` additionally serves ModelClient connections over a
+    Unix socket.
+    """
+
+    def __init__(self, model_path='saved/models/final_model', tokenizer_path='saved/tokenizers/final_model', max_batch=32, max_wait=0.01,
+                 max_new_tokens=8, constrained=True, runtime='fp32'):
+        self.model = load_model(model_path, runtime)
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self.constrained = constrained
+
+        self.queue = queue.Queue()
+        self.running = True
+        self.listener = None
+
+        self.num_batches = 0
+        self.num_requests = 0
+
+        self.thread = threading.Thread(target=self._worker, name='model-server', daemon=True)
+        self.thread.start()
+
+    def submit(self, fen, num_candidates=8):
+        # Returns a concurrent.futures.Future of the (move, log-probability) candidates
+        future = Future()
+        self.queue.put((fen, num_candidates, future))
+        return future
+
+    def candidates(self, fen, num_candidates=8):
+        return self.submit(fen, num_candidates).result()
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while self.running:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                continue
+            self.num_batches += 1
+            self.num_requests += len(batch)
+
+            # One generate call per number of candidates (usually a single group)
+            groups = {}
+            for request in batch:
+                groups.setdefault(request[1], []).append(request)
+            for num_candidates, requests in groups.items():
+                try:
+                    results = generate_candidates(self.model, self.tokenizer, [fen for fen, _, _ in requests], num_candidates,
+                                                  self.max_new_tokens, self.constrained)
+                except Exception as e:
+                    for _, _, future in requests:
+                        future.set_exception(e)
+                    continue
+                for (_, _, future), result in zip(requests, results):
+                    future.set_result(result)
+
+    def listen(self, address, authkey=None):
+        # Serves ModelClient connections on a Unix socket path, one thread per connection
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        thread = threading.Thread(target=self._accept, name='model-server-listener', daemon=True)
+        thread.start()
+        return thread
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    fen, num_candidates = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    conn.send(self.candidates(fen, num_candidates))
+                except Exception as e:
+                    conn.send(e)
+
+    def stats(self):
+        return {'batches': self.num_batches, 'requests': self.num_requests,
+                'mean_batch': self.num_requests / self.num_batches if self.num_batches > 0 else 0.0,
+                'queue_depth': self.queue.qsize()}
+
+    def close(self):
+        self.running = False
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        self.thread.join(5)
+
+
+class ModelClient():
+    """
+    Connection to a ModelServer listening on a Unix socket, usable as GRPOBot(server=...). One client per game
+    (thread), requests on a connection are answered in order.
+    """
+
+    def __init__(self, address, authkey=None):
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+
+    def candidates(self, fen, num_candidates=8):
+        self.conn.send((fen, num_candidates))
+        result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python -m bot.modelServer /tmp/llm-chess.sock
+    address = sys.argv[1] if len(sys.argv) > 1 else '/tmp/llm-chess.sock'
+    server = ModelServer()
+    server.listen(address)
+    print(f'serving on {address}')
+    try:
+        while True:
+            time.sleep(10)
+            print(server.stats())
+    except KeyboardInterrupt:
+        server.close()
@@ -0,0 +1,139 @@
+import time
+
+import chess
+import torch
+from transformers import AutoModelForCausalLM
+
+try:
+    from optimum.onnxruntime import ORTModelForCausalLM
+except ImportError:
+    ORTModelForCausalLM = None
+
+from bot.GRPOBot import generate_candidates
+from evaluation import parse_move
+
+
+RUNTIMES = ('fp32', 'int8', 'onnx')
+
+
+def _require_optimum():
+    if ORTModelForCausalLM is None:
+        raise ImportError('The onnx runtime needs optimum with onnxruntime (pip install optimum[onnxruntime])')
+
+
+def quantize_int8(model):
+    # Dynamic int8 quantization of every linear layer (weights stored as int8, activations quantized per batch),
+    # for CPU inference. generate keeps its KV cache as with the fp32 model
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_onnx(model_path, out_dir):
+    # One-off export of the model with its KV cache inputs/outputs, load it back with load_model(out_dir, 'onnx')
+    _require_optimum()
+    model = ORTModelForCausalLM.from_pretrained(model_path, export=True, use_cache=True)
+    model.save_pretrained(out_dir)
+    return out_dir
+
+
+def load_model(model_path, runtime='fp32'):
+    if runtime == 'fp32':
+        return AutoModelForCausalLM.from_pretrained(model_path).eval()
+    if runtime == 'int8':
+        return quantize_int8(AutoModelForCausalLM.from_pretrained(model_path))
+    if runtime == 'onnx':
+        _require_optimum()
+        return ORTModelForCausalLM.from_pretrained(model_path, use_cache=True)
+    raise ValueError(f'Unknown runtime {runtime}, expected one of {RUNTIMES}')
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+def model_size(model):
+    # Bytes of the weights in the state dict (counts the packed int8 weights, which are not parameters)
+    if not isinstance(model, torch.nn.Module):
+        return None
+    return sum(_nbytes(value) for value in model.state_dict().values())
+
+
+def move_stats(model, tokenizer, fens, num_candidates=8, batch_size=16):
+    # Legal rate of unconstrained samples, greedy constrained move of every position and mean latency per position
+    legal, total = 0, 0
+    moves = []
+    elapsed = 0.0
+    for i in range(0, len(fens), batch_size):
+        batch = fens[i:i + batch_size]
+        start = time.perf_counter()
+        greedy = generate_candidates(model, tokenizer, batch, num_candidates=1, do_sample=False)
+        elapsed += time.perf_counter() - start
+        moves.extend(c[0][0] if len(c) > 0 else None for c in greedy)
+
+        sampled = generate_candidates(model, tokenizer, batch, num_candidates=num_candidates, constrained=False)
+        for fen, candidates in zip(batch, sampled):
+            board = chess.Board(fen)
+            for move, _ in candidates:
+                total += 1
+                legal += parse_move(fen, board, move, classify=False)[0] is not None
+    return {'legal_rate': legal / total if total > 0 else 0.0, 'moves': moves, 'latency': elapsed / max(len(fens), 1)}
+
+
+# Compares a CPU runtime against the fp32 model on held-out positions: legal move rate of unconstrained samples,
+# agreement and mean reward of the greedy (constrained) moves, per-position latency and weight size. The runtime
+# passes when neither the legal rate nor the mean reward drops by more than the tolerances
+def accuracy_gate(model_path, tokenizer, fens, runtime='int8', runtime_path=None, num_candidates=8, max_legal_drop=0.02,
+                  max_reward_drop=0.02, n_jobs=8, backend='joblib'):
+    from batch_eval import batch_eval
+
+    reference = load_model(model_path, 'fp32')
+    candidate = load_model(runtime_path or model_path, runtime)
+
+    torch.manual_seed(0)
+    ref = move_stats(reference, tokenizer, fens, num_candidates)
+    torch.manual_seed(0)
+    new = move_stats(candidate, tokenizer, fens, num_candidates)
+
+    games = [fen for fen, r, n in zip(fens, ref['moves'], new['moves']) if r is not None and n is not None]
+    ref_moves = [r for r, n in zip(ref['moves'], new['moves']) if r is not None and n is not None]
+    new_moves = [n for r, n in zip(ref['moves'], new['moves']) if r is not None and n is not None]
+    rewards = batch_eval(games + games, ref_moves + new_moves, n_jobs, enable_tqdm=False, group_moves=True, backend=backend)
+    ref_reward = sum(rewards[:len(games)]) / max(len(games), 1)
+    new_reward = sum(rewards[len(games):]) / max(len(games), 1)
+
+    ref_size, new_size = model_size(reference), model_size(candidate)
+    report = {
+        'runtime': runtime,
+        'positions': len(fens),
+        'legal_rate': (ref['legal_rate'], new['legal_rate']),
+        'reward': (ref_reward, new_reward),
+        'agreement': sum(r == n for r, n in zip(ref_moves, new_moves)) / max(len(games), 1),
+        'latency': (ref['latency'], new['latency']),
+        'speedup': ref['latency'] / new['latency'] if new['latency'] > 0 else 0.0,
+        'size': (ref_size, new_size),
+    }
+    report['passed'] = (ref['legal_rate'] - new['legal_rate'] <= max_legal_drop) and (ref_reward - new_reward <= max_reward_drop)
+    return report
+
+
+if __name__ == '__main__':
+    import sys
+    from transformers import AutoTokenizer
+    from dataset.chessDataset import generate_samples
+
+    # python -m bot.runtime [int8|onnx] [runtime_path]
+    runtime = sys.argv[1] if len(sys.argv) > 1 else 'int8'
+    runtime_path = sys.argv[2] if len(sys.argv) > 2 else None
+    model_path = 'saved/models/final_model'
+    tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/final_model')
+
+    if runtime == 'onnx' and runtime_path is None:
+        runtime_path = export_onnx(model_path, model_path + '_onnx')
+
+    # Held-out games, past the ones used for training
+    fens = [prompt for prompt, _ in generate_samples('data/lichess_db_standard_rated_2017-03.pgn', num_games=256, use_FEN=True,
+                                                      end_in='white', offset=50_000, use_index=True)]
+    print(accuracy_gate(model_path, tokenizer, fens, runtime, runtime_path))
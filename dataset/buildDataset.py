@@ -0,0 +1,92 @@
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+from stockfish import Stockfish
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from dataset.pgnIndex import load_index
+from dataset.gameFilter import read_indexed_games
+
+
+def shard_seed(random_seed, shard_id):
+    # Every shard has its own generator, so samples only depend on the seed and the shard, not on the worker running it
+    return None if random_seed is None else f'{random_seed}-{shard_id}'
+
+
+def build_shard(pgn_path, games, shard_id, out_path, random_seed=None, stockfish_path=None, game_filter=None, **options):
+    # Imported here, chessDataset imports this module
+    from dataset.chessDataset import game_samples
+
+    index = load_index(pgn_path, build=False, headers=())
+    rng = random.Random(shard_seed(random_seed, shard_id))
+    stockfish = Stockfish(path=stockfish_path) if options.get('use_best_move') else None
+    options = {k: v for k, v in options.items() if k != 'use_best_move'}
+
+    samples = []
+    with open(pgn_path) as f:
+        for game in read_indexed_games(f, index, games):
+            if game_filter is not None and not game_filter.matches_game(game):
+                continue
+            samples.extend(game_samples(game, stockfish=stockfish, rng=rng, **options))
+
+    np.save(out_path, np.array(samples, dtype=str).reshape(-1, 2))
+    return out_path
+
+
+def make_shards(index, offset=0, num_games=None, shard_size=10_000, game_filter=None):
+    # Game indices split in shards of shard_size games, a game_filter is applied to the index header columns first
+    # so every shard gets shard_size kept games
+    end = len(index) if num_games is None else min(len(index), offset + num_games)
+    games = np.arange(offset, end) if game_filter is None else game_filter.select(index, offset, end)
+    return [games[start:start + shard_size] for start in range(0, len(games), shard_size)]
+
+
+# Builds (prompt, completion) samples with a process pool. The .pgn is split into shards of shard_size games (located
+# through the byte-offset index, after the header predicates of an optional game_filter), workers run process_game (or process_game_multi with samples_per_game) over their shards and write them to shard_dir as .npy,
+# and the shards are merged in order. The result only depends on random_seed and shard_size, not on n_jobs
+def build_samples(pgn_path, num_games=None, offset=0, n_jobs=-1, shard_size=10_000, random_seed=None, num_random_moves=0,
+                  use_FEN=False, end_in='both', use_addendum=False, use_best_move=False, stockfish_path=None, shard_dir=None,
+                  enable_tqdm=True, samples_per_game=None, game_filter=None):
+    index = load_index(pgn_path, headers=() if game_filter is None else game_filter.headers())
+    shards = make_shards(index, offset, num_games, shard_size, game_filter)
+
+    keep_shards = shard_dir is not None
+    if shard_dir is None:
+        shard_dir = tempfile.mkdtemp(prefix='chess_shards_')
+    os.makedirs(shard_dir, exist_ok=True)
+
+    options = dict(num_random_moves=num_random_moves, use_FEN=use_FEN, end_in=end_in, use_addendum=use_addendum, use_best_move=use_best_move,
+                   samples_per_game=samples_per_game, game_filter=game_filter)
+    jobs = list(enumerate(shards))
+    if enable_tqdm:
+        jobs = tqdm(jobs, desc='Building shards')
+
+    try:
+        paths = Parallel(n_jobs=n_jobs)(
+            delayed(build_shard)(pgn_path, games, shard_id, os.path.join(shard_dir, f'shard_{shard_id:05d}.npy'),
+                                 random_seed=random_seed, stockfish_path=stockfish_path, **options)
+            for shard_id, games in jobs
+        )
+
+        samples = []
+        for path in paths:
+            samples.extend((str(p), str(c)) for p, c in np.load(path))
+    finally:
+        if not keep_shards:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    return samples
+
+
+if __name__ == '__main__':
+    import json
+
+    samples = build_samples('data/lichess_db_standard_rated_2017-02.pgn', num_games=50_000, use_FEN=True, end_in='white', random_seed=577)
+    print(f'built {len(samples)} samples')
+
+    with open('data/subset_data.json', 'w') as f:
+        json.dump([dict(zip(('prompt', 'completion'), s)) for s in samples], f)
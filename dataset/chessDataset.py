@@ -5,17 +5,231 @@ import os
 
 import chess.pgn
 from stockfish import Stockfish
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import numpy as np
 
-# For multi threading
-from joblib import Parallel, delayed
+from dataset.pgnIndex import load_index
+from dataset.buildDataset import build_samples
+from dataset.parquetShards import write_shards
+from dataset.gameFilter import read_filtered_game, read_indexed_games
+from dataset.labelDataset import label_samples
+from dataset.dedupDataset import dedup_samples, dedup_report, weighted_sampler
+
+def keep_ply(num_keep_moves, num_total_moves, end_in='both', use_addendum=False):
+    # Moves the sampled ply to the side given by end_in and returns it with the addendum for the prompt
+    if use_addendum:
+        addendum = f' {1 + num_keep_moves // 2}. ' if (num_keep_moves % 2 == 0) else ' '
+        addendum = addendum[1:] if num_keep_moves == 0 else addendum
+    else:
+        addendum = ''
+
+    if end_in == 'white':
+        num_keep_moves = num_keep_moves + (num_keep_moves % 2) if num_keep_moves < num_total_moves - 1 else num_keep_moves - (num_keep_moves % 2)
+        addendum = f' {1 + num_keep_moves // 2}. '
+        addendum = addendum[1:] if num_keep_moves == 0 else addendum
+    elif end_in == 'black':
+        num_keep_moves = num_keep_moves + (1 - num_keep_moves % 2) if num_keep_moves < num_total_moves - 1 else num_keep_moves - (1 - num_keep_moves % 2)
+        addendum = ' '
+
+    return num_keep_moves, addendum
+
+
+def finish_sample(board, next_move, addendum, num_random_moves=0, use_FEN=False, stockfish=None, rng=random, moves_text=None):
+    # board is the position at the sampled ply, moves_text its movetext when already known
+    for _ in range(num_random_moves):
+        legal_moves = list(board.legal_moves)
+        num_legal_moves = len(legal_moves)
+        if len(legal_moves) == 0:
+            break
+        move_idx = 0 if num_legal_moves == 1 else rng.randint(0, num_legal_moves-1)
+        r_move = legal_moves[move_idx]
+        board.push(r_move)
+
+    if stockfish is not None:
+        stockfish.set_fen_position(board.fen())
+        next_move = board.san(board.parse_uci(stockfish.get_best_move()))
+
+    if use_FEN:
+        return board.fen(), next_move
+    if moves_text is None or num_random_moves > 0:
+        moves_text = str(chess.pgn.Game.from_board(board).mainline_moves())
+    return moves_text + addendum, next_move
+
+
+def process_game(moves, num_random_moves=0, use_FEN=False, end_in='both', use_addendum=False, stockfish=None, rng=random):
+    if moves == '':
+        return None
+
+    pgn = io.StringIO(moves)
+    game = chess.pgn.read_game(pgn)
+
+    num_total_moves = game.end().board().ply()
+    if num_total_moves <= 1:
+        return None
+    num_keep_moves, addendum = keep_ply(rng.randint(0, num_total_moves - 1), num_total_moves, end_in, use_addendum)
+
+    board = game.board()
+    for i, uci_move in enumerate(game.mainline_moves()):
+        if i == num_keep_moves:
+            next_move = str(board.san(board.parse_uci(str(uci_move)))) if num_random_moves == 0 else 'N/A'
+            break
+        board.push(uci_move)
+
+    return finish_sample(board, next_move, addendum, num_random_moves, use_FEN, stockfish, rng)
+
+
+def process_game_multi(game, samples_per_game='all', num_random_moves=0, use_FEN=False, end_in='both', use_addendum=False, stockfish=None, rng=random):
+    # Replays a parsed game once and returns up to samples_per_game samples (uniformly chosen plies, or every ply
+    # with 'all'), with the same end_in rules as process_game
+    if game is None:
+        return []
+
+    moves = list(game.mainline_moves())
+    num_total_moves = len(moves)
+    if num_total_moves <= 1:
+        return []
+
+    if samples_per_game == 'all':
+        plies = range(num_total_moves)
+    else:
+        plies = rng.sample(range(num_total_moves), min(samples_per_game, num_total_moves))
+
+    keep = {}
+    for ply in plies:
+        num_keep_moves, addendum = keep_ply(ply, num_total_moves, end_in, use_addendum)
+        keep.setdefault(num_keep_moves, addendum)
+    last = max(keep)
+
+    # Build the movetext while replaying, unless the game does not start from the standard position
+    board = game.board()
+    track_text = not use_FEN and board.fen() == chess.STARTING_FEN
+    tokens = []
+
+    samples = []
+    for i, move in enumerate(moves[:last + 1]):
+        if i in keep:
+            san = board.san(move)
+            next_move = san if num_random_moves == 0 else 'N/A'
+            moves_text = ' '.join(tokens) if track_text else None
+            # Random moves are played on a copy, the replay continues from the real position
+            sample_board = board.copy() if num_random_moves > 0 else board
+            samples.append(finish_sample(sample_board, next_move, keep[i], num_random_moves, use_FEN, stockfish, rng, moves_text))
+        elif track_text:
+            san = board.san(move)
+
+        if track_text:
+            tokens.append(f'{i // 2 + 1}. {san}' if i % 2 == 0 else san)
+        board.push(move)
+
+    return samples
+
+
+def game_samples(game, samples_per_game=None, **options):
+    # One process_game sample (samples_per_game=None) or process_game_multi samples of a parsed game, as a list
+    if samples_per_game is None:
+        sample = process_game(str(game.mainline_moves()), **options)
+        return [] if sample is None else [sample]
+    return process_game_multi(game, samples_per_game, **options)
+
+
+def generate_samples(pgn_path, num_games=None, num_random_moves=0, use_FEN=False, end_in='both', use_addendum=False,
+                     random_seed=None, use_best_move=False, stockfish_path=None, offset=0, shard=0, num_shards=1, use_index=False,
+                     samples_per_game=None, game_filter=None):
+    # Lazily yields the same (prompt, completion) samples as ChessDataset, one game in memory at a time.
+    # Game i (counted from offset) belongs to shard i % num_shards, games of other shards are skipped without parsing moves,
+    # or not read at all when the file has a byte-offset index (use_index=True builds one if missing).
+    # With a game_filter (dataset/gameFilter.py) only games whose headers pass are parsed and split between the shards
+    # (the k-th kept game belongs to shard k % num_shards), with an index the filter is applied to its header columns.
+    # Both paths give every shard the same games
+    rng = random.Random(random_seed if num_shards == 1 or random_seed is None else f'{random_seed}-{shard}')
+    stockfish = Stockfish(path=stockfish_path) if use_best_move else None
+    options = dict(num_random_moves=num_random_moves, use_FEN=use_FEN, end_in=end_in, use_addendum=use_addendum, stockfish=stockfish, rng=rng)
+
+    index = load_index(pgn_path, build=use_index, headers=() if game_filter is None else game_filter.headers())
+
+    with open(pgn_path) as pgn:
+        if index is not None:
+            # Seek straight to every game of this shard
+            end = len(index) if num_games is None else min(len(index), offset + num_games)
+            games = range(offset, end) if game_filter is None else game_filter.select(index, offset, end)
+            for game in read_indexed_games(pgn, index, games[shard::num_shards]):
+                if game_filter is not None and not game_filter.matches_game(game):
+                    continue
+                yield from game_samples(game, samples_per_game, **options)
+            return
+
+        for _ in range(offset):
+            if not chess.pgn.skip_game(pgn):
+                return
+
+        # Like the index path, only the games whose headers pass the filter are split between the shards, other shards'
+        # games are skipped after their headers
+        i = 0
+        kept = 0
+        while num_games is None or i < num_games:
+            i += 1
+            pos = pgn.tell()
+            if game_filter is not None:
+                headers = chess.pgn.read_headers(pgn)
+                if headers is None:
+                    return
+                if not game_filter.matches_headers(headers):
+                    continue
+
+            kept += 1
+            if (kept - 1) % num_shards != shard:
+                if game_filter is None and not chess.pgn.skip_game(pgn):
+                    return
+                continue
+
+            if game_filter is not None:
+                pgn.seek(pos)
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                return
+            if game_filter is not None and not game_filter.matches_game(game):
+                continue
+
+            yield from game_samples(game, samples_per_game, **options)
+
+
+def generate_records(**kwargs):
+    # For datasets.Dataset.from_generator(generate_records, gen_kwargs={...})
+    for prompt, completion in generate_samples(**kwargs):
+        yield {'prompt': prompt, 'completion': completion}
+
+
+class StreamingChessDataset(IterableDataset):
+    def __init__(self, pgn_path, num_games=None, num_random_moves=0, use_FEN=False, end_in='both', use_addendum=False,
+                 random_seed=None, use_best_move=False, stockfish_path=None, offset=0, use_index=False, samples_per_game=None,
+                 game_filter=None):
+        if stockfish_path is None and use_best_move:
+            print('*** Must have stockfish to use best move ***')
+            exit(1)
+        if stockfish_path is not None and not os.path.exists(stockfish_path):
+            print('*** Stockfish does not exist ***')
+            exit(1)
+
+        self.kwargs = dict(pgn_path=pgn_path, num_games=num_games, num_random_moves=num_random_moves, use_FEN=use_FEN, end_in=end_in,
+                           use_addendum=use_addendum, random_seed=random_seed, use_best_move=use_best_move,
+                           stockfish_path=stockfish_path, offset=offset, use_index=use_index, samples_per_game=samples_per_game,
+                           game_filter=game_filter)
+
+    def __iter__(self):
+        # Each DataLoader worker streams its own shard of the games
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return generate_samples(**self.kwargs)
+        return generate_samples(**self.kwargs, shard=worker_info.id, num_shards=worker_info.num_workers)
+
 
 class ChessDataset(Dataset):
     def __init__(self, num_games=100, num_random_moves=0, use_FEN=False, pgn_path=None, saved_data_path=None, save_data_to_path=None,
-                 save_processed_to_json=None, end_in='both', use_addendum=False, random_seed=None, use_best_move=False, stockfish_path=None, offset=0):
+                 save_processed_to_json=None, end_in='both', use_addendum=False, random_seed=None, use_best_move=False, stockfish_path=None, offset=0, use_index=False, n_jobs=None,
+                 samples_per_game=None, save_processed_to_parquet=None, shard_max_rows=1_000_000, game_filter=None,
+                 label_dir=None, label_nodes=100_000, label_jobs=4, dedup=False, keep_move_distribution=False):
         if random_seed is not None:
             random.seed(random_seed)
 
@@ -26,6 +240,11 @@ class ChessDataset(Dataset):
         self.use_addendum = use_addendum
         self.use_best_move = use_best_move
         self.offset = offset
+        self.samples_per_game = samples_per_game
+
+        # The original loader read num_games games into an unused list before the ones it kept, so the kept games start
+        # num_games after offset. Kept as is so existing (num_games, offset) configs select the same games
+        self.start = offset + num_games
 
         if stockfish_path is None and use_best_move:
             print('*** Must have stockfish to use best move ***')
@@ -34,8 +253,8 @@ class ChessDataset(Dataset):
             print('*** Stockfish does not exist ***')
             exit(1)
 
-        if self.use_best_move:
-            self.stockfish = Stockfish(path=stockfish_path)
+        # With a label_dir the best moves are found after extraction by labelDataset.label_samples instead of inline
+        self.stockfish = Stockfish(path=stockfish_path) if self.use_best_move and label_dir is None else None
 
         if save_data_to_path is not None and pgn_path is None:
             print('*** Can only save data read from pgn_path ***')
@@ -45,17 +264,43 @@ class ChessDataset(Dataset):
             exit(1)
         
 
-        if pgn_path is not None and saved_data_path is None:
+        if pgn_path is not None and saved_data_path is None and n_jobs is not None:
+            print('Building games from .pgn')
+            self.games = build_samples(pgn_path, num_games=self.num_games, offset=self.start, n_jobs=n_jobs, random_seed=random_seed,
+                                       num_random_moves=self.num_random_moves, use_FEN=self.use_FEN, end_in=self.end_in,
+                                       use_addendum=self.use_addendum, use_best_move=self.stockfish is not None, stockfish_path=stockfish_path,
+                                       samples_per_game=self.samples_per_game, game_filter=game_filter)
+
+            if self.use_best_move and label_dir is not None:
+                self.games = label_samples(self.games, label_dir, stockfish_path=stockfish_path, n_jobs=label_jobs, nodes=label_nodes)
+
+            if save_data_to_path is not None:
+                np.save(save_data_to_path, self.games)
+
+        elif pgn_path is not None and saved_data_path is None:
             self.dataset = open(pgn_path)
 
-            for _ in range(self.offset):
-              chess.pgn.read_game(self.dataset)
+            # With a byte-offset index (built when use_index=True, used whenever one exists) seek straight to the first game
+            index = load_index(pgn_path, build=use_index, headers=())
+            if index is not None:
+                self.dataset.seek(index.byte_range(self.start, self.start)[0])
+            else:
+                # Skipped games are scanned for their end without parsing moves
+                for _ in range(self.start):
+                    if not chess.pgn.skip_game(self.dataset):
+                        break
 
             print('Loading games from .pgn')
-            games = [str(chess.pgn.read_game(self.dataset).mainline_moves()) for _ in tqdm(range(self.num_games))]
-            self.games = [self.process_game(str(chess.pgn.read_game(self.dataset).mainline_moves())) for _ in tqdm(range(self.num_games))]
-            #self.games = Parallel(n_jobs=40)(delayed(self.process_game)(game) for game in games)
-            self.games = [g for g in self.games if g is not None]
+            # Games filtered out on their headers (False) or past the end of the file (None) are dropped
+            games = (read_filtered_game(self.dataset, game_filter) for _ in tqdm(range(self.num_games)))
+            if self.samples_per_game is None:
+                self.games = [self.process_game(str(g.mainline_moves())) for g in games if g]
+                self.games = [g for g in self.games if g is not None]
+            else:
+                self.games = [s for g in games if g for s in self.process_game_multi(g)]
+
+            if self.use_best_move and label_dir is not None:
+                self.games = label_samples(self.games, label_dir, stockfish_path=stockfish_path, n_jobs=label_jobs, nodes=label_nodes)
 
             if save_data_to_path is not None:
                 np.save(save_data_to_path, self.games)
@@ -67,60 +312,46 @@ class ChessDataset(Dataset):
             print('*** Exactly one of pgn_path and saved_data_path must be passed in ***')
             exit(1)
 
+        # One record per position, with how often it occurred (and which moves were played there)
+        self.counts = None
+        self.move_counts = None
+        if dedup:
+            self.games, self.counts, self.move_counts = dedup_samples(self.games, keep_distribution=keep_move_distribution)
+            report = dedup_report(self.counts)
+            print(f"Deduplicated {report['samples']} samples to {report['positions']} positions (ratio {report['dedup_ratio']:.2f})")
+
         if save_processed_to_json is not None:
             to_json = [dict(zip(('prompt', 'completion'), g)) for g in self.games]
+            if self.counts is not None:
+                for d, count in zip(to_json, self.counts.tolist()):
+                    d['count'] = count
+            if self.move_counts is not None:
+                for d, moves in zip(to_json, self.move_counts):
+                    d['moves'] = moves
             with open(save_processed_to_json, 'w') as f:
                 json.dump(to_json, f)
 
-    def process_game(self, moves):
-        if moves == '':
-            return None
+        if save_processed_to_parquet is not None:
+            if self.counts is not None:
+                # Occurrence counts go to a count column, for dedupDataset.weighted_indices / weighted_sampler
+                write_shards(((p, c, n) for (p, c), n in zip(self.games, self.counts.tolist())), save_processed_to_parquet,
+                             max_rows=shard_max_rows, with_counts=True)
+            else:
+                write_shards(self.games, save_processed_to_parquet, max_rows=shard_max_rows)
 
-        pgn = io.StringIO(moves)
-        game = chess.pgn.read_game(pgn)
+    def process_game(self, moves):
+        return process_game(moves, num_random_moves=self.num_random_moves, use_FEN=self.use_FEN, end_in=self.end_in,
+                            use_addendum=self.use_addendum, stockfish=self.stockfish)
 
-        num_total_moves = game.end().board().ply()
-        if num_total_moves <= 1:
-            return None
-        num_keep_moves = random.randint(0, num_total_moves - 1)
+    def process_game_multi(self, game):
+        return process_game_multi(game, self.samples_per_game, num_random_moves=self.num_random_moves, use_FEN=self.use_FEN, end_in=self.end_in,
+                                  use_addendum=self.use_addendum, stockfish=self.stockfish)
 
-        if self.use_addendum:
-            addendum = f' {1 + num_keep_moves // 2}. ' if (num_keep_moves % 2 == 0) else ' '
-            addendum = addendum[1:] if num_keep_moves == 0 else addendum
-        else:
-            addendum = ''
-
-        if self.end_in == 'white':
-            num_keep_moves = num_keep_moves + (num_keep_moves % 2) if num_keep_moves < num_total_moves - 1 else num_keep_moves - (num_keep_moves % 2)
-            addendum = f' {1 + num_keep_moves // 2}. '
-            addendum = addendum[1:] if num_keep_moves == 0 else addendum
-        elif self.end_in == 'black':
-            num_keep_moves = num_keep_moves + (1 - num_keep_moves % 2) if num_keep_moves < num_total_moves - 1 else num_keep_moves - (1 - num_keep_moves % 2)
-            addendum = ' '
-
-        board = game.board()
-        for i, uci_move in enumerate(game.mainline_moves()):
-            if i == num_keep_moves:
-                next_move = str(board.san(board.parse_uci(str(uci_move)))) if self.num_random_moves == 0 else 'N/A'
-                break
-            board.push(uci_move)
-
-        for _ in range(self.num_random_moves):
-            legal_moves = list(board.legal_moves)
-            num_legal_moves = len(legal_moves)
-            if len(legal_moves) == 0:
-                break
-            move_idx = 0 if num_legal_moves == 1 else random.randint(0, num_legal_moves-1)
-            r_move = legal_moves[move_idx]
-            board.push(r_move)
-
-        if self.use_best_move:
-            self.stockfish.set_fen_position(board.fen())
-            next_move = board.san(board.parse_uci(self.stockfish.get_best_move()))
-
-        if self.use_FEN:
-            return board.fen(), next_move
-        return str(chess.pgn.Game.from_board(board).mainline_moves()) + addendum, next_move
+    def sampler(self, alpha=0.5, num_samples=None):
+        # Sampler over a deduplicated dataset that down-weights frequent positions (see dedupDataset.position_weights)
+        if self.counts is None:
+            raise ValueError('sampler needs a dataset built with dedup=True')
+        return weighted_sampler(self.counts, alpha, num_samples)
 
     def __len__(self):
         return len(self.games)
@@ -138,11 +369,38 @@ Arguments of ChessDataset and default values:
     saved_data_path=None            Path of the saved .npy file (from setting save_data_to_path to anything besides None)
     save_data_to_path=None          Path to save .npy file containing processed subset of games
     save_processed_to_json=None     Path to save .json file containing processed subset of games
+    save_processed_to_parquet=None  Directory to save processed games as parquet shards (dataset/parquetShards.py, needs pyarrow),
+                                    load them with load_shards(dir) instead of load_dataset('json', ...). A directory that
+                                    already holds shards is refused rather than overwritten
+    shard_max_rows=1_000_000        Maximum samples per parquet shard
+    label_dir=None                  With use_best_move, label the extracted positions afterwards (dataset/labelDataset.py) on label_jobs
+                                    engines with label_nodes nodes per search, checkpointing to label_dir so a rerun resumes
+    label_nodes=100_000             Node budget per best move search when labeling to label_dir
+    label_jobs=4                    Number of stockfish engines labeling in parallel
+    dedup=False                     Keep one sample per position (zobrist hash) labeled with its most frequent move, occurrence counts
+                                    are in dataset.counts (and the count column of the .json / parquet output) and
+                                    dataset.sampler(alpha) down-weights frequent positions
+    keep_move_distribution=False    With dedup, keep the {move: count} of every position in dataset.move_counts (and the .json output)
+    game_filter=None                GameFilter (dataset/gameFilter.py) on Elo, time control, result, termination and ply count,
+                                    checked on the headers before the moves are parsed, num_games still counts the games read
     end_in='both'                   Which player should make the next move, effectively always sets use_addendum=True
     use_addendum=False              Whether or not to add ' number. ' or ' ' to the end of moves, only applicable when end_in='both'
     random_seed=None                Seed the randomness for reproduction
     use_best_move=False             Whether the best move is returned as the label instead of the actual move (works with random moves)
     stockfish_path                  The path to the .exe stockfish file
+    offset=0                        Number of games to skip at the start of the .pgn file. As in the original loader, ChessDataset also
+                                    skips the num_games games after offset, so it keeps games offset + num_games to
+                                    offset + 2 * num_games - 1 (generate_samples / StreamingChessDataset start right at offset)
+    use_index=False                 Build a byte-offset index of the .pgn file (dataset/pgnIndex.py) if missing, so offset is a seek
+    n_jobs=None                     Build the games with dataset/buildDataset.py in n_jobs processes (-1 for all cores), reproducible for
+                                    a given random_seed whatever n_jobs is, but not the same samples as the serial (n_jobs=None) path
+    samples_per_game=None           None for one sample per game, K for up to K samples (distinct plies) per game or 'all' for every
+                                    ply, extracted in a single replay of the game (end_in still applies, so plies can collapse together)
+
+StreamingChessDataset(pgn_path, ...) takes the same options (num_games=None reads the whole file) and parses games
+lazily, one at a time. With DataLoader(num_workers=k) each worker streams every k-th game. generate_samples yields the
+same (prompt, completion) tuples without torch and generate_records yields dicts for datasets.Dataset.from_generator.
+parquetShards.build_shards(pgn_path, out_dir, ...) writes those samples to size-bounded parquet shards as they are generated.
 """
 
 if __name__ == '__main__':
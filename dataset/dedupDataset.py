@@ -0,0 +1,57 @@
+from collections import Counter
+
+import numpy as np
+from torch.utils.data import WeightedRandomSampler
+
+from dataset.labelDataset import prompt_board, position_hash
+
+
+# Collapses (prompt, completion) samples of the same position (zobrist hash, so transpositions and move order
+# variations of a position merge) into one record. Returns the records with the most frequent completion of each
+# position, the number of samples of every position and, with keep_distribution, the {completion: count} of each
+def dedup_samples(samples, keep_distribution=False):
+    rows = {}
+    records = []
+    moves = []
+    for prompt, completion in samples:
+        h = position_hash(prompt_board(prompt))
+        row = rows.get(h)
+        if row is None:
+            row = rows[h] = len(records)
+            records.append(prompt)
+            moves.append(Counter())
+        moves[row][completion] += 1
+
+    deduped = [(prompt, counter.most_common(1)[0][0]) for prompt, counter in zip(records, moves)]
+    counts = np.array([sum(counter.values()) for counter in moves], dtype=np.int64)
+    distributions = [dict(counter) for counter in moves] if keep_distribution else None
+    return deduped, counts, distributions
+
+
+def dedup_report(counts):
+    num_samples = int(counts.sum())
+    num_positions = len(counts)
+    return {'samples': num_samples, 'positions': num_positions,
+            'dedup_ratio': num_samples / num_positions if num_positions > 0 else 0.0,
+            'duplicate_fraction': 1 - num_positions / num_samples if num_samples > 0 else 0.0,
+            'max_count': int(counts.max()) if num_positions > 0 else 0}
+
+
+def position_weights(counts, alpha=0.5):
+    # Sampling weight count ** alpha per record: alpha=1 keeps the original position frequencies, alpha=0 samples
+    # every distinct position equally, values in between down-weight frequent (opening) positions
+    weights = np.asarray(counts, dtype=np.float64) ** alpha
+    return weights / weights.sum()
+
+
+def weighted_indices(counts, alpha=0.5, num_samples=None, seed=None):
+    # Record indices drawn with replacement by position_weights, for trainers that build their own sampler:
+    # dataset.select(weighted_indices(dataset['count']))
+    rng = np.random.default_rng(seed)
+    return rng.choice(len(counts), size=len(counts) if num_samples is None else num_samples, p=position_weights(counts, alpha))
+
+
+def weighted_sampler(counts, alpha=0.5, num_samples=None):
+    # For DataLoader(dataset, sampler=weighted_sampler(dataset.counts)) over a deduplicated ChessDataset
+    return WeightedRandomSampler(position_weights(counts, alpha).tolist(), len(counts) if num_samples is None else num_samples,
+                                 replacement=True)
@@ -0,0 +1,153 @@
+import chess.pgn
+import numpy as np
+
+
+# Lichess speed categories, from the estimated duration base + 40 * increment (seconds)
+SPEEDS = (('ultrabullet', 30), ('bullet', 180), ('blitz', 480), ('rapid', 1500), ('classical', float('inf')))
+
+
+def time_control_speed(time_control):
+    # '300+3' -> 'blitz', '-' (correspondence) or malformed -> None
+    try:
+        base, increment = time_control.split('+')
+        duration = int(base) + 40 * int(increment)
+    except (AttributeError, ValueError):
+        return None
+    for speed, limit in SPEEDS:
+        if duration < limit:
+            return speed
+
+
+def _elo(value):
+    return int(value) if value is not None and value.isdigit() else -1
+
+
+class GameFilter():
+    """
+    Predicates on PGN games, checked on the headers alone so only the games that pass are parsed.
+
+    min_elo / max_elo apply to both players (games with a missing Elo fail a min_elo check),
+    time_controls holds exact TimeControl values ('300+0') and/or speeds ('bullet', 'blitz', ...),
+    results and terminations hold accepted Result / Termination values. min_plies / max_plies
+    use the PlyCount header when there is one, otherwise they are checked on the parsed game.
+    """
+
+    def __init__(self, min_elo=None, max_elo=None, time_controls=None, results=None, terminations=None, min_plies=None, max_plies=None):
+        self.min_elo = min_elo
+        self.max_elo = max_elo
+        self.time_controls = None if time_controls is None else set(time_controls)
+        self.results = None if results is None else set(results)
+        self.terminations = None if terminations is None else set(terminations)
+        self.min_plies = min_plies
+        self.max_plies = max_plies
+
+    def headers(self):
+        # Headers needed in a PgnIndex to apply the filter with mask()
+        names = ['WhiteElo', 'BlackElo', 'Result']
+        if self.time_controls is not None:
+            names.append('TimeControl')
+        if self.terminations is not None:
+            names.append('Termination')
+        if self.needs_game():
+            names.append('PlyCount')
+        return tuple(names)
+
+    def _check_time_control(self, time_control):
+        return time_control in self.time_controls or time_control_speed(time_control) in self.time_controls
+
+    def _check_plies(self, plies):
+        return (self.min_plies is None or plies >= self.min_plies) and (self.max_plies is None or plies <= self.max_plies)
+
+    def matches_headers(self, headers):
+        if self.min_elo is not None or self.max_elo is not None:
+            elos = (_elo(headers.get('WhiteElo')), _elo(headers.get('BlackElo')))
+            if self.min_elo is not None and min(elos) < self.min_elo:
+                return False
+            if self.max_elo is not None and max(elos) > self.max_elo:
+                return False
+        if self.time_controls is not None and not self._check_time_control(headers.get('TimeControl')):
+            return False
+        if self.results is not None and headers.get('Result') not in self.results:
+            return False
+        if self.terminations is not None and headers.get('Termination') not in self.terminations:
+            return False
+        if 'PlyCount' in headers and headers['PlyCount'].isdigit() and not self._check_plies(int(headers['PlyCount'])):
+            return False
+        return True
+
+    def needs_game(self):
+        # Whether matches_game has anything left to check after the headers passed
+        return self.min_plies is not None or self.max_plies is not None
+
+    def matches_game(self, game):
+        if not self.needs_game():
+            return True
+        return self._check_plies(game.end().ply())
+
+    def mask(self, index, start=0, end=None):
+        # Vectorized matches_headers over games start..end-1 of a PgnIndex built with self.headers()
+        end = len(index) if end is None else end
+        headers = {name: values[start:end] for name, values in index.headers.items()}
+        keep = np.ones(end - start, dtype=bool)
+
+        if self.min_elo is not None:
+            keep &= np.minimum(headers['WhiteElo'], headers['BlackElo']) >= self.min_elo
+        if self.max_elo is not None:
+            keep &= np.maximum(headers['WhiteElo'], headers['BlackElo']) <= self.max_elo
+        if self.time_controls is not None:
+            time_controls = headers['TimeControl']
+            allowed = [tc for tc in np.unique(time_controls) if self._check_time_control(str(tc))]
+            keep &= np.isin(time_controls, allowed)
+        if self.results is not None:
+            keep &= np.isin(headers['Result'], list(self.results))
+        if self.terminations is not None:
+            keep &= np.isin(headers['Termination'], list(self.terminations))
+        if self.needs_game():
+            # Games without a PlyCount header pass here and are checked on the parsed game, like in matches_headers
+            ply_counts = headers['PlyCount']
+            known = np.char.isdigit(ply_counts)
+            plies = np.where(known, ply_counts, '0').astype(np.int64)
+            in_range = np.ones(len(plies), dtype=bool)
+            if self.min_plies is not None:
+                in_range &= plies >= self.min_plies
+            if self.max_plies is not None:
+                in_range &= plies <= self.max_plies
+            keep &= ~known | in_range
+        return keep
+
+    def select(self, index, start=0, end=None):
+        # Indices of the games in start..end-1 that pass the header predicates
+        return np.flatnonzero(self.mask(index, start, end)) + start
+
+
+def read_filtered_game(pgn, game_filter=None):
+    # Reads the next game of pgn, parsing its moves only when its headers pass game_filter.
+    # Returns the game, False when it was filtered out, or None at the end of the file
+    if game_filter is None:
+        return chess.pgn.read_game(pgn)
+
+    pos = pgn.tell()
+    headers = chess.pgn.read_headers(pgn)
+    if headers is None:
+        return None
+    if not game_filter.matches_headers(headers):
+        return False
+
+    pgn.seek(pos)
+    game = chess.pgn.read_game(pgn)
+    if game is None or not game_filter.matches_game(game):
+        return False
+    return game
+
+
+def read_indexed_games(pgn, index, games):
+    # Parses the given (sorted) game indices of an indexed .pgn, seeking only over gaps
+    expected = None
+    for k in games:
+        if k != expected:
+            index.seek(pgn, k)
+        game = chess.pgn.read_game(pgn)
+        if game is None:
+            return
+        expected = k + 1
+        yield game
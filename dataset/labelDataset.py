@@ -0,0 +1,112 @@
+import glob
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+import numpy as np
+from tqdm import tqdm
+
+from engine_pool import EnginePool, STOCKFISH_PATH, search_game
+
+
+def prompt_board(prompt):
+    # Position of a FEN prompt or of a movetext prompt (a trailing ' 12. ' addendum is ignored by the parser)
+    try:
+        return chess.Board(prompt)
+    except ValueError:
+        game = chess.pgn.read_game(io.StringIO(prompt))
+        return chess.Board() if game is None else game.end().board()
+
+
+def position_hash(board):
+    return chess.polyglot.zobrist_hash(board)
+
+
+def label_path(label_dir, shard_id):
+    return os.path.join(label_dir, f'labels_{shard_id:05d}.npz')
+
+
+def load_labels(label_dir):
+    # Zobrist hash -> best move (SAN) of every checkpointed shard in label_dir
+    labels = {}
+    for path in sorted(glob.glob(os.path.join(label_dir, 'labels_*.npz'))):
+        data = np.load(path)
+        labels.update(zip(data['hashes'].tolist(), data['moves'].tolist()))
+    return labels
+
+
+def save_labels(path, labels):
+    # Written to a temporary file first, so an interrupted run never leaves a truncated checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, hashes=np.array(list(labels.keys()), dtype=np.uint64), moves=np.array(list(labels.values()), dtype=str))
+    os.replace(tmp_path, path)
+
+
+def best_move(pool, board, limit):
+    if board.is_game_over():
+        return 'N/A'
+    with pool.lease() as engine:
+        move = engine.play(board, limit, game=search_game(limit)).move
+    return board.san(move)
+
+
+def next_label_id(label_dir):
+    # Checkpoints are append-only, a run never overwrites the shards of an earlier one
+    ids = [int(os.path.basename(path)[len('labels_'):-len('.npz')]) for path in glob.glob(os.path.join(label_dir, 'labels_*.npz'))]
+    return max(ids) + 1 if len(ids) > 0 else 0
+
+
+# Replaces the completion of every (prompt, completion) sample with the best move found by stockfish under a fixed
+# node (or depth) budget. Samples are labeled in shards of shard_size on a pool of n_jobs engines, the new labels of
+# every finished shard are checkpointed to label_dir as the next labels_NNNNN.npz (zobrist hash -> SAN). Only positions
+# missing from the checkpoints are searched, so an interrupted run, or a run over a reordered or extended sample list
+# with the same label_dir, resumes without searching a position twice
+def label_samples(samples, label_dir, stockfish_path=None, n_jobs=4, nodes=100_000, depth=None, shard_size=10_000,
+                  engine_options=None, enable_tqdm=True):
+    os.makedirs(label_dir, exist_ok=True)
+    limit = chess.engine.Limit(nodes=nodes, depth=depth)
+    labels = load_labels(label_dir)
+    label_id = next_label_id(label_dir)
+
+    boards = [prompt_board(prompt) for prompt, _ in samples]
+    hashes = [position_hash(board) for board in boards]
+
+    pool = None
+    shards = range(0, len(samples), shard_size)
+    try:
+        for start in tqdm(shards, desc='Labeling shards') if enable_tqdm else shards:
+            todo = {}
+            for board, h in zip(boards[start:start + shard_size], hashes[start:start + shard_size]):
+                if h not in labels and h not in todo:
+                    todo[h] = board
+            if len(todo) == 0:
+                continue
+
+            if pool is None:
+                pool = EnginePool(stockfish_path or STOCKFISH_PATH, size=n_jobs, options=engine_options)
+            with ThreadPoolExecutor(n_jobs) as executor:
+                moves = executor.map(lambda board: best_move(pool, board, limit), todo.values())
+                shard_labels = dict(zip(todo.keys(), moves))
+
+            save_labels(label_path(label_dir, label_id), shard_labels)
+            label_id += 1
+            labels.update(shard_labels)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return [(prompt, labels[h]) for (prompt, _), h in zip(samples, hashes)]
+
+
+if __name__ == '__main__':
+    from dataset.chessDataset import generate_samples
+
+    samples = list(generate_samples('data/lichess_db_standard_rated_2017-02.pgn', num_games=100_000, use_FEN=True, end_in='white',
+                                    random_seed=577, use_index=True))
+    samples = label_samples(samples, 'data/best_move_labels', stockfish_path='stockfish/stockfish-windows-x86-64-avx2.exe', n_jobs=8)
+    print(f'labeled {len(samples)} samples')
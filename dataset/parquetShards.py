@@ -0,0 +1,173 @@
+import glob
+import json
+import os
+import shutil
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+COLUMNS = ('prompt', 'completion')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('Writing parquet shards needs pyarrow (pip install pyarrow)')
+
+
+def shard_paths(out_dir):
+    return sorted(glob.glob(os.path.join(out_dir, 'shard_*.parquet')))
+
+
+class ShardWriter():
+    """
+    Writes (prompt, completion) samples to out_dir as shard_00000.parquet, shard_00001.parquet, ...
+
+    A shard is closed once it holds `max_rows` samples or about `max_bytes` bytes of (UTF-8) text,
+    whichever comes first. Samples are buffered and flushed as row groups of `row_group_size`, so only
+    one row group is ever held in memory. Shards are written to out_dir.tmp and only replace the shards
+    in out_dir on close, so an interrupted run never touches an existing dataset. Opening a writer on
+    a directory that already holds shards raises unless overwrite=True. With with_counts, samples are
+    (prompt, completion, count) and the count column holds the occurrences of a deduplicated position
+    (dataset/dedupDataset.py).
+    """
+
+    def __init__(self, out_dir, max_rows=1_000_000, max_bytes=256 * 2**20, row_group_size=50_000, compression='zstd', overwrite=False,
+                 with_counts=False):
+        _require_pyarrow()
+        if not overwrite and len(shard_paths(out_dir)) > 0:
+            raise FileExistsError(f'{out_dir} already holds parquet shards, pass overwrite=True to replace them')
+        self.out_dir = out_dir
+        self.tmp_dir = out_dir.rstrip('/') + '.tmp'
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+        self.with_counts = with_counts
+        self.schema = pa.schema([(c, pa.string()) for c in COLUMNS] + ([('count', pa.int64())] if with_counts else []))
+        self.writer = None
+        self.buffer = []
+        self.shard_rows = 0
+        self.shard_bytes = 0
+
+        self.paths = []
+        self.num_rows = 0
+
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+
+    def _flush(self):
+        if len(self.buffer) == 0:
+            return
+        if self.writer is None:
+            path = os.path.join(self.tmp_dir, f'shard_{len(self.paths):05d}.parquet')
+            self.writer = pq.ParquetWriter(path, self.schema, compression=self.compression)
+            self.paths.append(path)
+
+        columns = dict(zip(COLUMNS + ('count',), map(list, zip(*self.buffer))))
+        self.writer.write_table(pa.table(columns, schema=self.schema))
+        self.buffer = []
+
+    def _close_shard(self):
+        self._flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.shard_rows = 0
+        self.shard_bytes = 0
+
+    def write(self, prompt, completion, count=None):
+        if self.with_counts:
+            self.buffer.append((str(prompt), str(completion), int(count)))
+        else:
+            self.buffer.append((str(prompt), str(completion)))
+        self.shard_rows += 1
+        self.shard_bytes += len(str(prompt).encode()) + len(str(completion).encode())
+        self.num_rows += 1
+
+        if self.shard_rows >= self.max_rows or self.shard_bytes >= self.max_bytes:
+            self._close_shard()
+        elif len(self.buffer) >= self.row_group_size:
+            self._flush()
+
+    def write_many(self, samples):
+        for sample in samples:
+            self.write(*sample)
+
+    def close(self):
+        # Publishes the finished shards: the old shards of out_dir are replaced by the new ones
+        self._close_shard()
+        os.makedirs(self.out_dir, exist_ok=True)
+        for path in shard_paths(self.out_dir):
+            os.remove(path)
+        paths = []
+        for path in self.paths:
+            paths.append(os.path.join(self.out_dir, os.path.basename(path)))
+            os.replace(path, paths[-1])
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.paths = paths
+        return self.paths
+
+    def abort(self):
+        # Drops the shards written so far, out_dir is left as it was
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_shards(samples, out_dir, **kwargs):
+    # Streams any iterable of (prompt, completion) into parquet shards, returns the shard paths
+    with ShardWriter(out_dir, **kwargs) as writer:
+        writer.write_many(samples)
+    return writer.paths
+
+
+def json_to_shards(json_path, out_dir, **kwargs):
+    # Migrates a dataset saved with ChessDataset(save_processed_to_json=...) to parquet shards
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    if len(data) > 0 and 'count' in data[0]:
+        return write_shards(((d['prompt'], d['completion'], d['count']) for d in data), out_dir, with_counts=True, **kwargs)
+    return write_shards(((d['prompt'], d['completion']) for d in data), out_dir, **kwargs)
+
+
+def build_shards(pgn_path, out_dir, max_rows=1_000_000, max_bytes=256 * 2**20, **kwargs):
+    # Writes the samples of generate_samples(pgn_path, **kwargs) to out_dir while they are built, one game in memory at a time
+    from dataset.chessDataset import generate_samples
+
+    return write_shards(generate_samples(pgn_path, **kwargs), out_dir, max_rows=max_rows, max_bytes=max_bytes)
+
+
+def load_shards(out_dir, streaming=False):
+    # HuggingFace dataset over the shards, memory-mapped Arrow (or an IterableDataset with streaming=True)
+    from datasets import load_dataset
+
+    paths = shard_paths(out_dir)
+    if len(paths) == 0:
+        raise FileNotFoundError(f'No parquet shards in {out_dir}')
+    return load_dataset('parquet', data_files=paths, split='train', streaming=streaming)
+
+
+if __name__ == '__main__':
+    paths = build_shards('data/lichess_db_standard_rated_2017-02.pgn', 'data/subset_shards', num_games=50_000, use_FEN=True,
+                         end_in='white', random_seed=577, use_index=True)
+    print(f'wrote {len(paths)} shards')
+
+    dataset = load_shards('data/subset_shards')
+    print(dataset)
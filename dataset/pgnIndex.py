@@ -0,0 +1,109 @@
+import os
+import re
+
+import chess.pgn
+import numpy as np
+from tqdm import tqdm
+
+
+HEADER_RE = re.compile(rb'\[(\w+)\s+"(.*)"\]\s*$')
+DEFAULT_HEADERS = ('WhiteElo', 'BlackElo', 'Result')
+
+
+def index_path_for(pgn_path):
+    return pgn_path + '.idx.npz'
+
+
+def _header_array(name, values):
+    # Elo style headers are stored as ints (-1 when missing or '?'), everything else as strings
+    if name.endswith('Elo'):
+        return np.array([int(v) if v.isdigit() else -1 for v in values], dtype=np.int32)
+    return np.array(values, dtype=str)
+
+
+# Scans a .pgn file once and writes a sidecar .npz with the byte offset of every game start (offsets)
+# and one array per requested header (header_<name>), in game order
+def build_index(pgn_path, index_path=None, headers=DEFAULT_HEADERS, enable_tqdm=True):
+    if index_path is None:
+        index_path = index_path_for(pgn_path)
+
+    offsets = []
+    values = {h: [] for h in headers}
+    wanted = {h.encode(): h for h in headers}
+
+    in_headers = False
+    pos = 0
+    with open(pgn_path, 'rb') as f:
+        lines = tqdm(f, desc='Indexing .pgn', unit=' lines') if enable_tqdm else f
+        for line in lines:
+            match = HEADER_RE.match(line)
+            if match is not None:
+                # First header line after movetext (or at the start of the file) starts a new game
+                if not in_headers:
+                    offsets.append(pos)
+                    for h in headers:
+                        values[h].append('')
+                    in_headers = True
+                name = wanted.get(match.group(1))
+                if name is not None:
+                    values[name][-1] = match.group(2).decode('utf-8', 'replace')
+            else:
+                in_headers = False
+            pos += len(line)
+
+    stat = os.stat(pgn_path)
+    arrays = {'offsets': np.array(offsets, dtype=np.int64), 'pgn_size': np.int64(stat.st_size)}
+    arrays.update({f'header_{h}': _header_array(h, v) for h, v in values.items()})
+    # np.savez appends .npz when missing, write to the exact path instead
+    with open(index_path, 'wb') as f:
+        np.savez(f, **arrays)
+
+    return PgnIndex(index_path)
+
+
+class PgnIndex():
+    def __init__(self, index_path):
+        data = np.load(index_path)
+        self.offsets = data['offsets']
+        self.pgn_size = int(data['pgn_size'])
+        self.headers = {k[len('header_'):]: data[k] for k in data.files if k.startswith('header_')}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def seek(self, f, k):
+        f.seek(int(self.offsets[k]))
+
+    def read_game(self, f, k):
+        self.seek(f, k)
+        return chess.pgn.read_game(f)
+
+    def byte_range(self, start, end):
+        # Byte range [begin, stop) covering games start..end-1
+        begin = int(self.offsets[start]) if start < len(self.offsets) else self.pgn_size
+        stop = int(self.offsets[end]) if end < len(self.offsets) else self.pgn_size
+        return begin, stop
+
+
+# Returns the PgnIndex of pgn_path, (re)building it when the sidecar is missing, was built for a file of a
+# different size or lacks one of the requested headers. With build=False returns None instead of building
+def load_index(pgn_path, index_path=None, build=True, headers=DEFAULT_HEADERS):
+    if index_path is None:
+        index_path = index_path_for(pgn_path)
+
+    if os.path.exists(index_path):
+        index = PgnIndex(index_path)
+        if index.pgn_size == os.path.getsize(pgn_path) and all(h in index.headers for h in headers):
+            return index
+
+    if not build:
+        return None
+    return build_index(pgn_path, index_path, headers=tuple(DEFAULT_HEADERS) + tuple(h for h in headers if h not in DEFAULT_HEADERS))
+
+
+if __name__ == '__main__':
+    index = build_index('data/lichess_db_standard_rated_2017-03.pgn')
+    print(f'indexed {len(index)} games')
+
+    with open('data/lichess_db_standard_rated_2017-03.pgn') as f:
+        print(index.read_game(f, 50_000).headers)
@@ -13,76 +13,125 @@ import numpy as np
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 
+from engine_pool import get_pool, make_limit, search_game
+from async_eval import get_evaluator
 
-def get_eval(game, move, time=0.1):
-    engine = chess.engine.SimpleEngine.popen_uci('stockfish/stockfish-windows-x86-64-avx2.exe')
-    new_board = chess.Board(game)
-    old_board = chess.Board(game)
+
+def get_score(fen, time=0.1, nodes=None, depth=None):
+    board = chess.Board(fen)
+    limit = make_limit(time, nodes, depth)
     try:
-        new_board.push_san(move)
+        with get_pool().lease() as engine:
+            info = engine.analyse(board, limit, game=search_game(limit))
+        return info["score"].white()
+    except Exception:
+        return None
 
-        old_info = engine.analyse(old_board, chess.engine.Limit(time=time))
-        new_info = engine.analyse(new_board, chess.engine.Limit(time=time))
 
-        old_score = old_info["score"].white()
-        new_score = new_info["score"].white()
+def score_diff(old_score, new_score, white_moved):
+    old_mate, new_mate = None, None
+    if old_score.is_mate():
+        old_mate = old_score.mate()
+    if new_score.is_mate():
+        new_mate = new_score.mate()
 
-        old_mate, new_mate = None, None
-        if old_score.is_mate():
-            old_mate = old_score.mate()
-        if new_score.is_mate():
-            new_mate = new_score.mate()
+    if old_mate is None and new_mate is None:
+        ret = new_score.score() - old_score.score()
 
-        if old_mate is None and new_mate is None:
-            ret = new_score.score() - old_score.score()
-        
-        elif old_mate is not None and new_mate is not None:
-            if np.sign(old_mate) == np.sign(new_mate):
-                ret = 0
-            else:
-                # Was white mate, made a move and is now black mate (very bad for white)
-                if old_mate > new_mate:
-                    ret = -math.inf
-                # Was black mate, made a move and is now white mate (very good for white)
-                else:
-                    ret = math.inf
-                
-        elif old_mate is not None and new_mate is None:
-            # Was white mating, made move, now is not mating (very bad for white)
-            if old_mate >= 0:
+    elif old_mate is not None and new_mate is not None:
+        if np.sign(old_mate) == np.sign(new_mate):
+            ret = 0
+        else:
+            # Was white mate, made a move and is now black mate (very bad for white)
+            if old_mate > new_mate:
                 ret = -math.inf
-            # Was black mating, made move, now is not mating (very good for white)
+            # Was black mate, made a move and is now white mate (very good for white)
             else:
                 ret = math.inf
 
-        elif old_mate is None and new_mate is not None:
-            # Was no one mating, made move, now white is mating (very good for white)
-            if new_mate >= 0:
-                ret = math.inf
-            # Was no one mating, made move, now black is mating (very bad for white)
-            else:
-                ret = -math.inf
+    elif old_mate is not None and new_mate is None:
+        # Was white mating, made move, now is not mating (very bad for white)
+        if old_mate >= 0:
+            ret = -math.inf
+        # Was black mating, made move, now is not mating (very good for white)
+        else:
+            ret = math.inf
 
-        # Adjust for turn
-        # Evaluating white move (always for our model)
-        if old_board.turn:
-            return ret
-        # Evaluating black move
+    elif old_mate is None and new_mate is not None:
+        # Was no one mating, made move, now white is mating (very good for white)
+        if new_mate >= 0:
+            ret = math.inf
+        # Was no one mating, made move, now black is mating (very bad for white)
         else:
-            return -ret
+            ret = -math.inf
+
+    # Adjust for turn
+    # Evaluating white move (always for our model)
+    if white_moved:
+        return ret
+    # Evaluating black move
+    else:
+        return -ret
+
+
+def get_eval(game, move, time=0.1, nodes=None, depth=None):
+    new_board = chess.Board(game)
+    old_board = chess.Board(game)
+    limit = make_limit(time, nodes, depth)
+    try:
+        new_board.push_san(move)
+
+        with get_pool().lease() as engine:
+            old_info = engine.analyse(old_board, limit, game=search_game(limit))
+            new_info = engine.analyse(new_board, limit, game=search_game(limit))
+
+        return score_diff(old_info["score"].white(), new_info["score"].white(), old_board.turn)
     except Exception:
         return -123456
-    finally:
-        engine.quit()
 
 
-def batch_diff_eval(games, moves, n_jobs, time=0.1, enable_tqdm=False):
+def batch_diff_eval(games, moves, n_jobs, time=0.1, enable_tqdm=False, backend='joblib', nodes=None, depth=None):
+    # Group the completions by prompt, so every distinct pre-move and post-move position is analysed once
+    pairs = {}
+    positions = {}
+    for g, m in zip(games, moves):
+        if (g, m) in pairs:
+            continue
+
+        try:
+            old_board = chess.Board(g)
+            new_board = chess.Board(g)
+            new_board.push_san(m)
+        except ValueError:
+            pairs[(g, m)] = None
+            continue
+
+        old_fen, new_fen = old_board.fen(), new_board.fen()
+        pairs[(g, m)] = (old_fen, new_fen, old_board.turn)
+        positions[old_fen] = None
+        positions[new_fen] = None
+
+    fens = list(positions)
     if enable_tqdm:
-        print('Evaluating ...')
-        ret = Parallel(n_jobs=n_jobs)(delayed(get_eval)(g, m, time=time) for g, m in tqdm(zip(games, moves), total=len(games)))
+        print(f'Evaluating {len(fens)} distinct positions for {len(games)} moves ...')
+        fens = tqdm(fens)
+    if backend == 'async':
+        scores = get_evaluator(num_engines=n_jobs).score_positions(list(positions), time, nodes, depth)
     else:
-        ret = Parallel(n_jobs=n_jobs)(delayed(get_eval)(g, m, time=time) for g, m in zip(games, moves))
-    return ret
+        scores = Parallel(n_jobs=n_jobs)(delayed(get_score)(f, time=time, nodes=nodes, depth=depth) for f in fens)
+    positions = dict(zip(positions, scores))
+
+    evals = {}
+    for pair, info in pairs.items():
+        if info is None or positions[info[0]] is None or positions[info[1]] is None:
+            evals[pair] = -123456
+            continue
+        try:
+            evals[pair] = score_diff(positions[info[0]], positions[info[1]], info[2])
+        except Exception:
+            evals[pair] = -123456
+
+    return [evals[(g, m)] for g, m in zip(games, moves)]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,209 @@
+import os
+import statistics
+import threading
+from contextlib import contextmanager
+
+import chess
+import chess.engine
+
+
+# Path to the stockfish executable used by every evaluator
+STOCKFISH_PATH = 'stockfish/stockfish-windows-x86-64-avx2.exe'
+
+
+class PooledEngine():
+    def __init__(self, path, options):
+        self.engine = chess.engine.SimpleEngine.popen_uci(path)
+        if options:
+            self.engine.configure(options)
+        self.uses = 0
+
+    def is_alive(self):
+        try:
+            self.engine.ping()
+            return True
+        except Exception:
+            return False
+
+    def quit(self):
+        try:
+            self.engine.quit()
+        except Exception:
+            pass
+
+
+class EnginePool():
+    """
+    Long lived UCI engines that are leased out per evaluation.
+
+    Engines are spawned lazily up to `size`, health checked (ping) before every lease,
+    replaced when they crash and recycled after `max_uses` leases.
+    """
+
+    def __init__(self, path=STOCKFISH_PATH, size=1, max_uses=1000, options=None):
+        self.path = path
+        self.size = size
+        self.max_uses = max_uses
+        self.options = options or {}
+
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.closed = False
+
+        self.num_spawned = 0
+        self.num_restarts = 0
+        self.num_recycled = 0
+        self.num_leases = 0
+
+    def _spawn(self):
+        engine = PooledEngine(self.path, self.options)
+        with self.lock:
+            self.num_spawned += 1
+        return engine
+
+    def _checkout(self):
+        self.slots.acquire()
+        try:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError('Engine pool is closed')
+                engine = self.idle.pop() if self.idle else None
+                self.num_leases += 1
+
+            if engine is not None and not engine.is_alive():
+                engine.quit()
+                engine = None
+                with self.lock:
+                    self.num_restarts += 1
+
+            return engine if engine is not None else self._spawn()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _checkin(self, engine, healthy):
+        try:
+            engine.uses += 1
+            if not healthy:
+                engine.quit()
+                with self.lock:
+                    self.num_restarts += 1
+                return
+
+            with self.lock:
+                keep = engine.uses < self.max_uses and not self.closed
+                if keep:
+                    self.idle.append(engine)
+                else:
+                    self.num_recycled += 1
+            if not keep:
+                engine.quit()
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def lease(self):
+        engine = self._checkout()
+        healthy = True
+        try:
+            yield engine.engine
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+            # Engine crashed or stopped responding, replace it on next lease
+            healthy = False
+            raise
+        finally:
+            self._checkin(engine, healthy)
+
+    def stats(self):
+        with self.lock:
+            return {'spawned': self.num_spawned, 'restarts': self.num_restarts, 'recycled': self.num_recycled,
+                    'leases': self.num_leases, 'idle': len(self.idle)}
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for engine in idle:
+            engine.quit()
+
+
+# One pool per process and configuration, so every joblib worker owns its engines and reuses them across batches
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None, size=1, max_uses=1000, options=None):
+    key = (os.getpid(), path or STOCKFISH_PATH, size, max_uses, tuple(sorted((options or {}).items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = EnginePool(key[1], size=size, max_uses=max_uses, options=options)
+            _pools[key] = pool
+    return pool
+
+
+def close_pools():
+    with _pools_lock:
+        pools = [p for key, p in _pools.items() if key[0] == os.getpid()]
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def make_limit(time=0.1, nodes=None, depth=None):
+    # A node or depth budget gives the same search (and reward) whatever the load of the machine, time is the fallback.
+    # With multipv the nodes budget is the total of the search, shared by all of its lines
+    if nodes is not None or depth is not None:
+        return chess.engine.Limit(nodes=nodes, depth=depth)
+    return chess.engine.Limit(time=time)
+
+
+def search_game(limit):
+    # game argument of analyse / play under a make_limit limit. Pooled engines keep their hash table between searches,
+    # so a node or depth budget is only reproducible from a fresh game (a new object, python-chess sends ucinewgame).
+    # Time limited searches are not reproducible anyway and keep the warm hash table
+    if limit.nodes is not None or limit.depth is not None:
+        return object()
+    return None
+
+
+CALIBRATION_FENS = [
+    chess.STARTING_FEN,
+    'r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3',
+    'r2q1rk1/pp2bppp/2n1pn2/3p4/3P4/2NBPN2/PP3PPP/R2Q1RK1 w - - 0 10',
+    '2r3k1/pp3ppp/4p3/3n4/3P4/P4N2/1P3PPP/2R3K1 w - - 0 25',
+    '8/5pk1/6p1/8/3R4/6P1/5PK1/8 b - - 0 40',
+]
+
+
+def calibrate_nodes(target_time=0.1, path=None, fens=CALIBRATION_FENS, repeats=3, options=None):
+    # Node budget that takes about target_time seconds per search on this machine (median of timed searches)
+    engine = PooledEngine(path or STOCKFISH_PATH, options or {})
+    try:
+        nodes = []
+        for fen in fens:
+            for _ in range(repeats):
+                info = engine.engine.analyse(chess.Board(fen), chess.engine.Limit(time=target_time))
+                if info.get('nodes') and info.get('time'):
+                    # Scale to the target, the reported search time is not exactly the limit
+                    nodes.append(info['nodes'] * target_time / info['time'])
+                elif info.get('nodes'):
+                    nodes.append(info['nodes'])
+    finally:
+        engine.quit()
+
+    if len(nodes) == 0:
+        raise RuntimeError('Engine did not report node counts')
+    return max(1, int(statistics.median(nodes)))
+
+
+def _close_pools_at_exit():
+    threading.main_thread().join()
+    close_pools()
+
+
+# SimpleEngine runs its event loop in a non-daemon thread, so engines must be quit before the interpreter joins
+# threads on exit (atexit hooks run after that join and hang). This daemon thread closes the pools as soon as the main
+# thread finishes, explicit close_pools() calls are still the way to release engines earlier
+threading.Thread(target=_close_pools_at_exit, name='engine-pool-exit', daemon=True).start()
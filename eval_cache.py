@@ -0,0 +1,124 @@
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def limit_key(limit):
+    return ','.join(f'{k}={v}' for k, v in (('time', limit.time), ('depth', limit.depth), ('nodes', limit.nodes), ('mate', limit.mate)) if v is not None)
+
+
+def position_key(board, limit, multipv=None):
+    # EPD drops the halfmove and fullmove clocks so transpositions share an entry. Rewards of a grouped MultiPV search
+    # (multipv is its number of lines) split the budget between the lines, so they get keys of their own
+    key = f'{board.epd()}|{limit_key(limit)}'
+    return key if multipv is None else f'{key}|multipv={multipv}'
+
+
+class EvalCache():
+    """
+    Two tier cache of evaluate_position and evaluate_group rewards keyed on position_key.
+
+    The memory tier is an LRU bounded by `max_size` entries, the optional disk tier is a
+    SQLite file at `path` that persists across runs. Writes to disk are committed every
+    `commit_every` entries and on flush().
+    """
+
+    def __init__(self, max_size=100_000, path=None, commit_every=256):
+        self.max_size = max_size
+        self.path = path
+        self.commit_every = commit_every
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS evals (key TEXT PRIMARY KEY, score REAL)')
+            self.db.commit()
+
+    def _remember(self, key, score):
+        self.entries[key] = score
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            score = self.entries.get(key)
+            if score is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return score
+
+            if self.db is not None:
+                row = self.db.execute('SELECT score FROM evals WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, score):
+        with self.lock:
+            self._remember(key, score)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO evals (key, score) VALUES (?, ?)', (key, score))
+                self.pending += 1
+                if self.pending >= self.commit_every:
+                    self.db.commit()
+                    self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            if self.db is not None and self.pending > 0:
+                self.db.commit()
+                self.pending = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total > 0 else 0.0, 'size': len(self.entries)}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+_cache = EvalCache()
+
+
+def get_cache():
+    return _cache
+
+
+def configure_cache(max_size=100_000, path=None):
+    global _cache
+    _cache.close()
+    _cache = EvalCache(max_size=max_size, path=path)
+    return _cache
+
+
+def _close_cache():
+    _cache.close()
+
+
+atexit.register(_close_cache)
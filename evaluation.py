@@ -1,6 +1,6 @@
 
-# NOTE: engine = None
-# This will casuse an error, you must change this to your stockfish executable path
+# NOTE: engines are leased from engine_pool
+# Change engine_pool.STOCKFISH_PATH to your stockfish executable path
 
 
 # -----------------
@@ -9,15 +9,18 @@
 
 
 
-import numpy as np
 import re
 
 import chess
 import chess.engine
 import chess.pgn
 
+import threading
 import traceback
 
+from engine_pool import get_pool, make_limit, search_game
+from eval_cache import get_cache, position_key
+
 
 
 # -----------------
@@ -26,29 +29,20 @@ import traceback
 
 
 
+# Move types of syntactically valid SAN, checked in order (compiled once)
+MOVE_PATTERNS = [
+    ('Short castling', re.compile(r'O-O')),
+    ('Long castling', re.compile(r'O-O-O')),
+    ('Pawn capture', re.compile(r'(?P<file>[a-h])x(?P<dst>[a-h][1-8])')),
+    ('En passant capture', re.compile(r'(?P<file>[a-h])x(?P<dst>[a-h][1-8]) e\.p\.')),
+    ('Pawn capture and promotion', re.compile(r'(?P<file>[a-h])x(?P<dst>[a-h][18])=(?P<promotion>[RNBQ])')),
+    ('Pawn move', re.compile(r'(?P<dst>[a-h][1-8])')),
+    ('Pawn promotion', re.compile(r'(?P<dst>[a-h][18])=(?P<promotion>[RNBQ])')),
+    ('Piece capture', re.compile(r'(?P<piece>[RNBQK])(?P<file>[a-h])?(?P<rank>[1-8])?x(?P<dst>[a-h][1-8])')),
+    ('Piece move', re.compile(r'(?P<piece>[RNBQK])(?P<file>[a-h])?(?P<rank>[1-8])?(?P<dst>[a-h][1-8])')),
+]
 
-# ------------------------------
-#      FEN Helper functions
-# ------------------------------
-
-
-
-def fen_to_matrix(fen):
-    fen_board = fen.split(' ')[0]  # Get only the board part
-    rows = fen_board.split('/')  # Split into ranks
-    
-    board_matrix = []
-    
-    for row in rows:
-        expanded_row = []
-        for char in row:
-            if char.isdigit():  # Convert empty squares
-                expanded_row.extend(['.'] * int(char))
-            else:
-                expanded_row.append(char)
-        board_matrix.append(expanded_row)
-    
-    return np.array(board_matrix)
+CHECK_SUFFIXES = {'#': 'Incorrect checkmate indication', '+': 'Incorrect check indication'}
 
 
 
@@ -58,315 +52,49 @@ def fen_to_matrix(fen):
 
 
 
-def rooksReachingDst(positions, piece, white_to_move, matrix):
-    srcs = []
-    valid = []
-
-    char = piece if white_to_move else piece.lower()
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2] - 1 - i
-        pos3 = positions[3]
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if pos2 >= 0:
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        valid.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos2 >= 0) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2] + 1 + i
-        pos3 = positions[3]
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if pos2 < 8:
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        valid.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos2 < 8) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2]
-        pos3 = positions[3] - 1 - i
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if pos3 >= 0:
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        valid.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos3 >= 0) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2]
-        pos3 = positions[3] + 1 + i
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if pos3 < 8:
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        valid.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos3 < 8) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    return valid, srcs
-
-
-def bishopsReachingDst(positions, piece, white_to_move, matrix):
-    srcs = []
-    valid = []
-
-    char = piece if white_to_move else piece.lower()
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2] - 1 - i
-        pos3 = positions[3] - 1 - i
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if (pos2 >= 0) and (pos3 >= 0):
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        srcs.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos2 >= 0) and (pos3 >= 0) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2] - 1 - i
-        pos3 = positions[3] + 1 + i
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if (pos2 >= 0) and (pos3 < 8):
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        srcs.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos2 >= 0) and (pos3 < 8) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2] + 1 + i
-        pos3 = positions[3] - 1 - i
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if (pos2 < 8) and (pos3 >= 0):
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        srcs.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos2 < 8) and (pos3 >= 0) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    guard = True
-    for i in range(7):
-        pos2 = positions[2] + 1 + i
-        pos3 = positions[3] + 1 + i
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if (pos2 < 8) and (pos3 < 8):
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-                    if guard:
-                        srcs.append([pos2, pos3])
-                    guard = False
-                elif matrix[pos2][pos3] != '.':
-                    guard = False
-            else:
-                break
-        elif (pos2 < 8) and (pos3 < 8) and (matrix[pos2][pos3] != '.'):
-            guard = False
-
-    return valid, srcs
-
-
-def knightsReachingDst(positions, piece, white_to_move, matrix):
-    srcs = []
-    char = piece if white_to_move else piece.lower()
-    knight_moves = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]
-
-    for move in knight_moves:
-        pos2 = positions[2] + move[0]
-        pos3 = positions[3] + move[1]
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if 0 <= pos2 < 8 and 0 <= pos3 < 8:
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-
-    return srcs, srcs
-
-
-def kingsReachingDst(positions, piece, white_to_move, matrix):
-    srcs = []
-    char = piece if white_to_move else piece.lower()
-    king_moves = [(1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (-1, -1), (1, -1), (-1, 1)]
-
-    for move in king_moves:
-        pos2 = positions[2] + move[0]
-        pos3 = positions[3] + move[1]
-        if (positions[0] == -1 and positions[1] == -1) or (positions[0] == pos2) or (positions[1] == pos3):
-            if 0 <= pos2 < 8 and 0 <= pos3 < 8:
-                if matrix[pos2][pos3] == char:
-                    srcs.append([pos2, pos3])
-
-    return srcs, srcs
-
-
-def pawnsReachingDst(positions, piece, white_to_move, matrix, move_type, en_passant_pos):
-    srcs = []
-    valid = []
-
-    char = piece if white_to_move else piece.lower()
-
-    if move_type == 'Pawn double move':
-        if matrix[positions[2]][positions[3]] == char:
-            srcs.append([positions[0], positions[1]])
-            if white_to_move:
-                if matrix[8 - 3][ord(san[0]) - ord('a')] == '.':
-                    valid.append([positions[0], positions[1]])
-            else:
-                if matrix[8 - 6][ord(san[0]) - ord('a')] == '.':
-                    valid.append([positions[0], positions[1]])
+def getMoveInfo(san):
+    # Returns the move type and the regex match of the SAN (without check suffix)
+    for move_type, pattern in MOVE_PATTERNS:
+        match = pattern.fullmatch(san)
+        if match is not None:
+            return move_type, match
 
-    else:
-        if matrix[positions[2]][positions[3]] == char:
-            srcs.append([positions[0], positions[1]])
-            valid.append([positions[0], positions[1]])
+    return 'Unknown move type', None
 
-    return valid, srcs
 
+def pawnSources(board, move_type, dst):
+    # (reaching, aligned) bitmasks of own pawns that could play a non capturing pawn move to dst,
+    # aligned ignores blocked squares in front of a double move
+    forward = 8 if board.turn == chess.WHITE else -8
+    pawns = board.pieces_mask(chess.PAWN, board.turn)
 
-def getMoveInfo(san, white_to_move, matrix):
-    # move src row, col, dst row, col
+    single = dst - forward
+    if 0 <= single < 64 and pawns & chess.BB_SQUARES[single]:
+        return chess.BB_SQUARES[single], chess.BB_SQUARES[single]
 
-    # Check for castling
-    if san == 'O-O-O':
-        if white_to_move:
-            return 'Long castling', [0, 'a', 0, 'd']
-        else:
-            return 'Long castling', [7, 'a', 7, 'd']
-    elif san == 'O-O':
-        if white_to_move:
-            return 'Short castling', [0, 'h', 0, 'f']
-        else:
-            return 'Short castling', [7, 'h', 7, 'f']
-    
-    # pawn actions
-    elif 'a' <= san[0] <= 'h':
-        # pawn capture
-        if 'x' in san:
-            if white_to_move:
-                if re.fullmatch(r"[a-h]x[a-h][1-8]", san):
-                    return 'Pawn capture', [8 - int(san[3]) - 1, ord(san[0]) - ord('a'), 8 - int(san[3]), ord(san[2]) - ord('a')]
-                
-                if re.fullmatch(r"[a-h]x[a-h][1-8] e\.p\.", san):
-                    return 'En passant capture', [8 - int(san[3]) - 1, ord(san[0]) - ord('a'), 8 - int(san[3]), ord(san[2]) - ord('a')]
-                
-                if re.fullmatch(r"[a-h]x[a-h]8=[RNBQ]", san):
-                    return 'Pawn capture and promotion', [8 - 7, ord(san[0]) - ord('a'), 8 - 8, ord(san[2]) - ord('a')]
-                
-            else:
-                if re.fullmatch(r"[a-h]x[a-h][1-8]", san):
-                    return 'Pawn capture', [8 - int(san[3]) + 1, ord(san[0]) - ord('a'), 8 - int(san[3]), ord(san[2]) - ord('a')]
-                
-                if re.fullmatch(r"[a-h]x[a-h][1-8] e\.p\.", san):
-                    return 'En passant capture', [8 - int(san[3]) + 1, ord(san[0]) - ord('a'), 8 - int(san[3]), ord(san[2]) - ord('a')]
-                
-                if re.fullmatch(r"[a-h]x[a-h]1=[RNBQ]", san):
-                    return 'Pawn capture and promotion', [8 - 2, ord(san[0]) - ord('a'), 8 - 1, ord(san[2]) - ord('a')]
-
-        # pawn move
-        else:
-            if white_to_move:
-                if re.fullmatch(r"[a-h]4", san):
-                    if matrix[8 - 3][ord(san[0]) - ord('a')] == 'P':
-                        return 'Pawn move', [8 - 3, ord(san[0]) - ord('a'), 8 - int(san[1]), ord(san[0]) - ord('a')]
-                    else:
-                        return 'Pawn double move', [8 - 2, ord(san[0]) - ord('a'), 8 - int(san[1]), ord(san[0]) - ord('a')]
-                
-                if re.fullmatch(r"[a-h][1-8]", san):
-                    return 'Pawn move', [8 - int(san[1]) - 1, ord(san[0]) - ord('a'), 8 - int(san[1]), ord(san[0]) - ord('a')]
-                
-                
-                if re.fullmatch(r"[a-h][1|8]=[RNBQ]", san):
-                    return 'Pawn promotion', [8 - 7, ord(san[0]) - ord('a'), 8 - 8, ord(san[0]) - ord('a')]
-            
-            else:
-                if re.fullmatch(r"[a-h]5", san):
-                    if matrix[8 - 6][ord(san[0]) - ord('a')] == 'p':
-                        return 'Pawn move', [8 - 6, ord(san[0]) - ord('a'), 8 - int(san[1]), ord(san[0]) - ord('a')]
-                    else:
-                        return 'Pawn double move', [8 - 7, ord(san[0]) - ord('a'), 8 - int(san[1]), ord(san[0]) - ord('a')]
-                
-                if re.fullmatch(r"[a-h][1-8]", san):
-                    return 'Pawn move', [8 - int(san[1]) + 1, ord(san[0]) - ord('a'), 8 - int(san[1]), ord(san[0]) - ord('a')]
-                
-                if re.fullmatch(r"[a-h][1|8]=[RNBQ]", san):
-                    return 'Pawn promotion', [8 - 2, ord(san[0]) - ord('a'), 8 - 1, ord(san[0]) - ord('a')]
+    double = dst - 2 * forward
+    start_rank = chess.BB_RANK_2 if board.turn == chess.WHITE else chess.BB_RANK_7
+    if 0 <= double < 64 and pawns & start_rank & chess.BB_SQUARES[double]:
+        if board.occupied & chess.BB_SQUARES[single]:
+            return chess.BB_EMPTY, chess.BB_SQUARES[double]
+        return chess.BB_SQUARES[double], chess.BB_SQUARES[double]
 
-    
-    # piece actions
-    elif san[0] in 'RNBQK':
-        # piece capture
-        if 'x' in san:
-            if re.fullmatch(r"[RNBQK][x][a-h][1-8]", san):
-                return 'Piece capture', [-1, -1, 8 - int(san[3]), ord(san[2]) - ord('a')]
-            elif re.fullmatch(r"[RNBQK][a-h][x][a-h][1-8]", san):
-                return 'Ambiguous column piece capture', [-1, ord(san[2]) - ord('a'), 8 - int(san[4]), ord(san[3]) - ord('a')]
-            elif re.fullmatch(r"[RNBQK][1-8][x][a-h][1-8]", san):
-                return 'Ambiguous row piece capture', [8 - int(san[1]), -1, 8 - int(san[4]), ord(san[3]) - ord('a')]
-        
-        # piece move
-        else:
-            if re.fullmatch(r"[RNBQK][a-h][1-8]", san):
-                return 'Piece move', [-1, -1, 8 - int(san[2]), ord(san[1]) - ord('a')]
-            elif re.fullmatch(r"[RNBQK][a-h][a-h][1-8]", san):
-                return 'Ambiguous column piece move', [-1, ord(san[1]) - ord('a'), 8 - int(san[3]), ord(san[2]) - ord('a')]
-            elif re.fullmatch(r"[RNBQK][1-8][a-h][1-8]", san):
-                return 'Ambiguous row piece move', [8 - int(san[1]), -1, 8 - int(san[3]), ord(san[2]) - ord('a')]
-            
-    
-    return 'Unknown move type', [-1, -1, -1, -1]
+    return chess.BB_EMPTY, chess.BB_EMPTY
+
+
+def pieceSources(board, piece_type, dst, disambiguation):
+    # (reaching, aligned) bitmasks of own pieces of piece_type that attack dst with the current blockers, or would
+    # on an empty board
+    pieces = board.pieces_mask(piece_type, board.turn) & disambiguation
+    reaching = board.attackers_mask(board.turn, dst) & pieces
+
+    aligned = chess.BB_EMPTY
+    if piece_type in (chess.ROOK, chess.QUEEN):
+        aligned |= (chess.BB_RANK_ATTACKS[dst][0] | chess.BB_FILE_ATTACKS[dst][0]) & pieces
+    if piece_type in (chess.BISHOP, chess.QUEEN):
+        aligned |= chess.BB_DIAG_ATTACKS[dst][0] & pieces
+
+    return reaching, aligned | reaching
 
 
 
@@ -376,311 +104,455 @@ def getMoveInfo(san, white_to_move, matrix):
 
 
 
-def failToRemoveCheck(board, trial_board):
-    if board.is_check():
-        if trial_board.is_check():
-            return True
+def castlingRights(board, move_type):
+    if move_type == 'Short castling':
+        return board.has_kingside_castling_rights(board.turn)
+    if move_type == 'Long castling':
+        return board.has_queenside_castling_rights(board.turn)
 
-    return False
+    return True
 
-def castlingRights(fen, move_type, white_to_move):
-    castling_rights = fen.split(' ')[2]
 
-    if move_type == 'Long castling':
-        if white_to_move:
-            return 'K' in castling_rights
-        else:
-            return 'k' in castling_rights
-    elif move_type == 'Short castling':
-        if white_to_move:
-            return 'Q' in castling_rights
-        else:
-            return 'q' in castling_rights
-        
-    return True
+def castlingIssue(board, move_type):
+    back_rank = chess.BB_RANK_1 if board.turn == chess.WHITE else chess.BB_RANK_8
+    king_square = chess.E1 if board.turn == chess.WHITE else chess.E8
 
+    if move_type == 'Short castling':
+        rook_square = chess.H1 if board.turn == chess.WHITE else chess.H8
+        path = (chess.BB_FILE_E | chess.BB_FILE_F | chess.BB_FILE_G) & back_rank
+    else:
+        rook_square = chess.A1 if board.turn == chess.WHITE else chess.A8
+        path = (chess.BB_FILE_C | chess.BB_FILE_D | chess.BB_FILE_E) & back_rank
 
-def getIllegalMoveType(fen, board, san):
-    matrix = fen_to_matrix(fen)
-    #print(matrix)
+    if board.king(board.turn) != king_square:
+        return 'Illegal castling'
+    if not board.rooks & board.occupied_co[board.turn] & chess.BB_SQUARES[rook_square]:
+        return 'Illegal castling'
+    if chess.between(king_square, rook_square) & board.occupied:
+        return 'Castling through blocked squares'
+    if any(board.is_attacked_by(not board.turn, square) for square in chess.scan_forward(path)):
+        return 'Castling through check'
 
-    white_to_move = 'white' if board.turn else 'black'
+    return None
 
 
+def getIllegalMoveType(fen, board, san):
+    # Classifies a SAN move that board.parse_san rejected as illegal, board is the position of fen
+    # and is not modified
+
     # Check for checkmate or check
-    try:
-        if san[-1] == '#':
-            san = san[:-1]
-            if board.is_legal(board.parse_san(san)):
-                return 'Incorrect checkmate indication'
-        elif san[-1] == '+':
-            san = san[:-1]
+    if san[-1:] in CHECK_SUFFIXES:
+        message = CHECK_SUFFIXES[san[-1]]
+        san = san[:-1]
+        try:
             if board.is_legal(board.parse_san(san)):
-                return 'Incorrect check indication'
-    except:
-        pass
+                return message
+        except ValueError:
+            pass
 
 
     # Get the piece type
-    piece_type = None
-    if san[0] in ['R', 'N', 'B', 'Q', 'K']:
-        piece_type = san[0]
-    elif san[0] in ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']:
-        piece_type = 'P'
-    elif san[0] == 'O':
-        piece_type = 'C'
+    if san[:1] in ('R', 'N', 'B', 'Q', 'K'):
+        piece_type = chess.PIECE_SYMBOLS.index(san[0].lower())
+    elif san[:1] in ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'):
+        piece_type = chess.PAWN
+    elif san[:1] == 'O':
+        piece_type = chess.KING
     else:
         return 'Unknown piece type'
 
-    # Get the move type and positions
-    move_type, positions = getMoveInfo(san, white_to_move, matrix)
-
-    #print(move_type, positions)
-
-
-    # Check if the move is unknown
+    # Get the move type and destination
+    move_type, match = getMoveInfo(san)
     if move_type == 'Unknown move type':
         return 'Unknown move type'
 
+    promotion_rank = 7 if board.turn == chess.WHITE else 0
+    if 'promotion' in move_type and chess.square_rank(chess.parse_square(match.group('dst'))) != promotion_rank:
+        return 'Unknown move type'
+
 
     # Check if castling is allowed
-    if not castlingRights(fen, move_type, white_to_move):
+    if not castlingRights(board, move_type):
         return 'No castling rights'
 
+    if 'castling' in move_type:
+        issue = castlingIssue(board, move_type)
+        return 'Unknown issue' if issue is None else issue
+
+
+    dst = chess.parse_square(match.group('dst'))
+    ours = board.occupied_co[board.turn]
+    theirs = board.occupied_co[not board.turn]
+
+    # A pawn capture onto the en passant square is an en passant capture
+    if move_type == 'Pawn capture' and board.ep_square == dst:
+        move_type = 'En passant capture'
 
     # Check if the move is a self capture
-    if 'castling' not in move_type:
-        if white_to_move and matrix[positions[2]][positions[3]] in ['P', 'R', 'N', 'B', 'Q', 'K']:
-            return 'Self capture'
-        elif not white_to_move and matrix[positions[2]][positions[3]] in ['p', 'r', 'n', 'b', 'q', 'k']:
-            return 'Self capture'
-    
-    
-    en_passant_pos = fen.split(' ')[3]
+    if ours & chess.BB_SQUARES[dst]:
+        return 'Self capture'
+
     if move_type == 'En passant capture':
-        if en_passant_pos != chr(positions[3] + ord('a')) + str(8 - positions[2]):
+        captured = dst - 8 if board.turn == chess.WHITE else dst + 8
+        if board.ep_square != dst or not board.pawns & theirs & chess.BB_SQUARES[captured]:
             return 'Illegal en passant capture'
-        
-        if white_to_move:
-            if matrix[8 - 5][positions[3]] != 'p':
-                return 'Illegal en passant capture'
-        else:
-            if matrix[8 - 4][positions[3]] != 'P':
-                return 'Illegal en passant capture'
-        
 
     # Check if the capture notation is correct
-    if ('capture' in move_type) and (move_type != 'En passant capture'):
-        if white_to_move:
-            if matrix[positions[2]][positions[3]] not in ['p', 'r', 'n', 'b', 'q', 'k']:
-                return 'No piece to be captured'
-        else:
-            if matrix[positions[2]][positions[3]] not in ['P', 'R', 'N', 'B', 'Q', 'K']:
-                return 'No piece to be captured'
-    elif 'castling' not in move_type:
-        if matrix[positions[2]][positions[3]] != '.':
-            return 'Empty square is not empty'
-
-
-    if move_type == 'Long castling' or move_type == 'Short castling':
-        # Check if the castling is legal
-        row = 7 if white_to_move else 0
-
-        if move_type == 'Long castling':
-            if matrix[row][4] != 'K':
-                return 'Illegal castling'
-            if matrix[row][0] != 'R':
-                return 'Illegal castling'
-            if matrix[row][1] != '.' or matrix[row][2] != '.' or matrix[row][3] != '.':
-                return 'Castling through blocked squares'
-            
-        elif move_type == 'Short castling':
-            if matrix[row][4] != 'K':
-                return 'Illegal castling'
-            if matrix[row][7] != 'R':
-                return 'Illegal castling'
-            if matrix[row][5] != '.' or matrix[row][6] != '.':
-                return 'Castling through blocked squares'
-
-
-        castle_board = chess.Board(board.fen())
-
-        row = '1' if white_to_move else '8'
-
-        for i in range(3):
-            col = -1
-
-            if move_type == 'Long castling':
-                castle_board.set_piece_at(chess.parse_square('a' + row), None)
-                castle_board.set_piece_at(chess.parse_square('b' + row), None)
-                castle_board.set_piece_at(chess.parse_square('c' + row), None)
-                castle_board.set_piece_at(chess.parse_square('d' + row), None)
-                castle_board.set_piece_at(chess.parse_square('e' + row), None)
-
-                col = chr(ord('c') + i)
-            else:
-                castle_board.set_piece_at(chess.parse_square('e' + row), None)
-                castle_board.set_piece_at(chess.parse_square('f' + row), None)
-                castle_board.set_piece_at(chess.parse_square('g' + row), None)
-                castle_board.set_piece_at(chess.parse_square('h' + row), None)
-
-                col = chr(ord('e') + i)
-
-            castle_board.set_piece_at(chess.parse_square(col + row), chess.Piece.from_symbol('K' if white_to_move else 'k'))
-
-            if castle_board.is_check():
-                return 'Castling through check'
-
+    elif 'capture' in move_type:
+        if not theirs & chess.BB_SQUARES[dst]:
+            return 'No piece to be captured'
+    elif board.occupied & chess.BB_SQUARES[dst]:
+        return 'Empty square is not empty'
+
+
+    # Check which pieces can reach the destination
+    if piece_type == chess.PAWN and 'capture' in move_type:
+        file_mask = chess.BB_FILES[chess.FILE_NAMES.index(match.group('file'))]
+        reaching = chess.BB_PAWN_ATTACKS[not board.turn][dst] & board.pieces_mask(chess.PAWN, board.turn) & file_mask
+        aligned = reaching
+    elif piece_type == chess.PAWN:
+        reaching, aligned = pawnSources(board, move_type, dst)
     else:
-        # Check which pieces can reach the destination
-        reaching = []
-        aligned = []
-
-        if piece_type == 'R':
-            reaching, aligned = rooksReachingDst(positions, 'R', white_to_move, matrix)
-        elif piece_type == 'B':
-            reaching, aligned = bishopsReachingDst(positions, 'B', white_to_move, matrix)
-        elif piece_type == 'Q':
-            reaching, aligned = rooksReachingDst(positions, 'Q', white_to_move, matrix)
-            reaching1, aligned1 = bishopsReachingDst(positions, 'Q', white_to_move, matrix)
-            reaching += reaching1
-            aligned += aligned1
-        elif piece_type == 'N':
-            reaching, aligned = knightsReachingDst(positions, 'N', white_to_move, matrix)
-        elif piece_type == 'K':
-            reaching, aligned = kingsReachingDst(positions, 'K', white_to_move, matrix)
-        elif piece_type == 'P':
-            reaching, aligned = pawnsReachingDst(positions, 'P', white_to_move, matrix, move_type, en_passant_pos)
-            
-        #print(reaching)
-        #print(aligned)
-
-        # Check if no piece can reach the destination
-        if len(reaching) == 0:
-            if len(aligned) > 0:
-                return 'Attempting to move blocked piece'
-            else:
-                return 'No piece reaches destination'
-
-        src = chr(reaching[0][1] + ord('a')) + str(8 - reaching[0][0])
-        dst = chr(positions[3] + ord('a')) + str(8 - positions[2])
-
-        #print(src, dst)
-
-        trial_board = chess.Board(board.fen())
-        trial_board.set_piece_at(chess.parse_square(src), None)
-
-        piece = chess.Piece.from_symbol(piece_type if white_to_move else piece_type.lower())
-        trial_board.set_piece_at(chess.parse_square(dst), piece)
-
-        #new_matrix = fen_to_matrix(trial_board.fen())
-        #print(new_matrix)
-
-        if failToRemoveCheck(board, trial_board):
+        disambiguation = chess.BB_ALL
+        if match.group('file'):
+            disambiguation &= chess.BB_FILES[chess.FILE_NAMES.index(match.group('file'))]
+        if match.group('rank'):
+            disambiguation &= chess.BB_RANKS[int(match.group('rank')) - 1]
+        reaching, aligned = pieceSources(board, piece_type, dst, disambiguation)
+
+    # Check if no piece can reach the destination
+    if not reaching:
+        if aligned:
+            return 'Attempting to move blocked piece'
+        return 'No piece reaches destination'
+
+    src = chess.lsb(reaching)
+    promotion = chess.PIECE_SYMBOLS.index(match.group('promotion').lower()) if 'promotion' in move_type else None
+
+    if board.is_into_check(chess.Move(src, dst, promotion)):
+        if board.is_check():
             return 'Move keeps king in check'
-        elif trial_board.is_check():
-            return 'Attempting to move pinned piece'
-        
-        if len(reaching) > 1:
-            return 'Ambiguous move'
+        return 'Attempting to move pinned piece'
+
+    if chess.popcount(reaching) > 1:
+        return 'Ambiguous move'
 
     return "Unknown issue"
 
 
+def classify_many(fens, sans):
+    # parse_move messages ('Valid move', 'Bad format', 'Ambiguous format' or the illegal move type) for every pair,
+    # each distinct fen is parsed into a board once
+    boards = {}
+    messages = []
+    for fen, san in zip(fens, sans):
+        board = boards.get(fen)
+        if board is None:
+            board = boards[fen] = chess.Board(fen)
+        messages.append(parse_move(fen, board, san)[1])
+
+    return messages
+
+
 
 # ------------------------
-#       Main function
+#      Score functions
 # ------------------------
 
 
 
-def evaluate_position(fen, san, time=0.1, return_score_only=False):
+def score_to_reward(score):
+    # score is a chess.engine.Score from the point of view of the player who made the move
+    scale = 500
+    mate_bound = 10
 
-    board = chess.Board(fen)
+    if score.is_mate():
+        mate = score.mate()
 
-    engine = None
-    #engine = chess.engine.SimpleEngine.popen_uci("/usr/local/bin/stockfish")
-    #engine = chess.engine.SimpleEngine.popen_uci(r"C:\Stockfish\stockfish-windows-x86-64-avx2.exe")
+        if mate >= 0:
+            mate = min(mate, mate_bound)
+            return 1 - ((mate / mate_bound) * 0.1)
+        else:
+            mate = abs(max(mate, - mate_bound))
+            return ((mate - 1) / (mate_bound - 1)) * 0.1
 
-    limit = chess.engine.Limit(time=time)
+    score = 1 / (1 + 10 ** (- score.score() / scale))
+    return 0.8 * score + 0.1
 
-    try:
-        board.parse_san(san)
-        board.push_san(san)
 
-        #print("FEN:", board.fen())
+def info_to_reward(info, board):
+    # board is the position after the move, so the mover is the side not to move
+    if "score" not in info:
+        return 0.5
 
-        info = engine.analyse(board, limit)
-        
-        if "score" in info:
-            scale = 500
-            mate_bound = 10
+    return score_to_reward(info["score"].white() if not board.turn else info["score"].black())
 
-            score = info["score"].white() if not board.turn else info["score"].black()
-            # print("Score:", score)
 
-            if score.is_mate():
-                mate = score.mate()
+def root_info_to_reward(info, board):
+    # board is the position before the move, as searched with root_moves / multipv
+    if "score" not in info:
+        return 0.5
 
-                if mate >= 0:
-                    mate = min(mate, mate_bound)
-                    score = 1 - ((mate / mate_bound) * 0.1)
+    score = info["score"].pov(board.turn)
 
-                    if return_score_only:
-                        return score
-                    return score, "Valid move"
-                else:
-                    mate = abs(max(mate, - mate_bound))
-                    score = ((mate - 1) / (mate_bound - 1)) * 0.1
+    # A root search counts the move itself in the mate distance, the post-move search does not
+    if score.is_mate() and score.mate() > 0:
+        score = chess.engine.Mate(score.mate() - 1)
 
-                    if return_score_only:
-                        return score
-                    return score, "Valid move"
+    return score_to_reward(score)
 
-            else:
-                score = 1 / (1 + 10 ** (- score.score() / scale))
-                score = 0.8 * score + 0.1
 
-                if return_score_only:
-                    return score
-                return score, "Valid move"
+shortcut_counts = {'checkmate': 0, 'stalemate': 0, 'insufficient_material': 0, 'forced_mate': 0, 'forced_draw': 0}
+shortcut_lock = threading.Lock()
+
+
+def count_shortcuts(names):
+    # Adds shortcut names (None entries are skipped) to shortcut_stats, for results that come back from worker processes
+    with shortcut_lock:
+        for name in names:
+            if name is not None:
+                shortcut_counts[name] += 1
+
+
+def shortcut_stats():
+    with shortcut_lock:
+        return dict(shortcut_counts)
+
+
+def trivial_result(board, max_forced=8):
+    # board is the position after the move. Returns (reward, shortcut name) when the board alone decides the reward
+    # (mate, stalemate, insufficient material, or one of those at the end of a chain of only-move replies), (None, None)
+    # when it needs the engine. Counts nothing, see trivial_reward
+    if board.is_checkmate():
+        return score_to_reward(chess.engine.Mate(0)), 'checkmate'
+    if board.is_stalemate():
+        return 0.5, 'stalemate'
+    if board.is_insufficient_material():
+        return 0.5, 'insufficient_material'
+
+    board = board.copy(stack=False)
+    for plies in range(1, max_forced + 1):
+        legal_moves = list(board.legal_moves)
+        if len(legal_moves) != 1:
+            return None, None
+        board.push(legal_moves[0])
+
+        if board.is_checkmate():
+            # plies is even when the mover's opponent is mated, odd when the mover is
+            mate = plies // 2 if plies % 2 == 0 else - (plies + 1) // 2
+            return score_to_reward(chess.engine.Mate(mate)), 'forced_mate'
+        if board.is_stalemate() or board.is_insufficient_material():
+            return 0.5, 'forced_draw'
+
+    return None, None
+
+
+def trivial_reward(board, max_forced=8, count=True):
+    # trivial_result's reward, the shortcut is counted in this process's shortcut_stats unless count=False
+    # (for checks that do not replace a search)
+    reward, name = trivial_result(board, max_forced)
+    if count:
+        count_shortcuts([name])
+    return reward
+
+
+
+# ------------------------
+#       Main function
+# ------------------------
+
+
+
+def parse_move(fen, board, san, classify=True):
+    try:
+        return board.parse_san(san), "Valid move"
 
-        if return_score_only:
-            return 0.5
-        return (0.5, "Valid move")
-    
     except chess.InvalidMoveError:
-        if return_score_only:
-            return -1
-        return (-1, 'Bad format')
-    
+        return None, 'Bad format'
+
     except chess.AmbiguousMoveError:
-        if return_score_only:
-            return -1
-        return (-1, 'Ambiguous format')
-    
+        return None, 'Ambiguous format'
+
     except chess.IllegalMoveError:
+        if not classify:
+            return None, 'Illegal move'
+
         try:
-            if return_score_only:
-                return -1
-            return (-1, getIllegalMoveType(fen, board, san))
-        
+            return None, getIllegalMoveType(fen, board, san)
+
         except Exception as e:
             # print(e)
             # traceback.print_exc()
 
+            return None, 'getIllegalMoveType error'
+
+
+def evaluate_position(fen, san, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None, return_info=False):
+    # With return_info the result comes with {'nodes': nodes searched, 'shortcuts': [trivial_result shortcut names]},
+    # for callers that measure the search cost or run this in a worker process, where shortcut_stats would not reach
+    # them. The caller then counts the shortcuts (count_shortcuts), they are only counted here without return_info
+    result, search_info = _evaluate_position(fen, san, time, return_score_only, use_cache, nodes, depth)
+    if return_info:
+        return result, search_info
+    count_shortcuts(search_info['shortcuts'])
+    return result
+
+
+def _evaluate_position(fen, san, time, return_score_only, use_cache, nodes, depth):
+    search_info = {'nodes': 0, 'shortcuts': []}
+
+    board = chess.Board(fen)
+
+    limit = make_limit(time, nodes, depth)
+
+    move, message = parse_move(fen, board, san, classify=not return_score_only)
+    if move is None:
+        if return_score_only:
+            return -1, search_info
+        return (-1, message), search_info
+
+    try:
+        board.push(move)
+
+        #print("FEN:", board.fen())
+
+        score, shortcut = trivial_result(board)
+        if score is not None:
+            search_info['shortcuts'].append(shortcut)
             if return_score_only:
-                return -1
-            return (-1, 'getIllegalMoveType error')
+                return score, search_info
+            return (score, "Valid move"), search_info
+
+        key = position_key(board, limit)
+        score = get_cache().get(key) if use_cache else None
+
+        if score is None:
+            with get_pool().lease() as engine:
+                info = engine.analyse(board, limit, game=search_game(limit))
+            search_info['nodes'] += info.get('nodes', 0)
+            score = info_to_reward(info, board)
+
+            if use_cache:
+                get_cache().put(key, score)
+
+        if return_score_only:
+            return score, search_info
+        return (score, "Valid move"), search_info
+
     except Exception as e:
         # print(e)
         # traceback.print_exc()
 
         if return_score_only:
-            return 0.5
-        return (0.5, 'Unknown error')
-    finally:
-        engine.quit()
+            return 0.5, search_info
+        return (0.5, 'Unknown error'), search_info
+
+
+def prepare_group(fen, board, sans, limit, classify=True, use_cache=True, shortcuts=None):
+    # Parses the completions of one prompt, returns the per-completion results known without a search
+    # and the distinct legal moves that still need one. Shortcut names are appended to shortcuts when it is given
+    # (the caller counts them), otherwise counted here
+    results = [None] * len(sans)
+    moves = {}
+    for i, san in enumerate(sans):
+        move, message = parse_move(fen, board, san, classify=classify)
+        if move is None:
+            results[i] = (-1, message)
+        else:
+            moves.setdefault(move, []).append(i)
+
+    search_moves = []
+    for move, idxs in moves.items():
+        board.push(move)
+        score, shortcut = trivial_result(board)
+        board.pop()
+        if shortcut is not None and shortcuts is not None:
+            shortcuts.append(shortcut)
+        elif shortcut is not None:
+            count_shortcuts([shortcut])
+
+        if score is None:
+            search_moves.append(move)
+        else:
+            for i in idxs:
+                results[i] = (score, "Valid move")
+
+    # The rewards of a group come from one MultiPV search over all of its moves, they are cached under keys carrying
+    # that width (position_key) and only served from the cache when every move of the group is
+    keys = {}
+    for move in search_moves:
+        board.push(move)
+        keys[move] = position_key(board, limit, multipv=len(search_moves))
+        board.pop()
+
+    if use_cache and len(search_moves) > 0:
+        scores = [get_cache().get(keys[move]) for move in search_moves]
+        if all(score is not None for score in scores):
+            for move, score in zip(search_moves, scores):
+                for i in moves[move]:
+                    results[i] = (score, "Valid move")
+            search_moves = []
+
+    return results, moves, keys, search_moves
+
+
+def apply_group_infos(infos, board, results, moves, keys, use_cache=True):
+    for info in infos:
+        if "pv" not in info or info["pv"][0] not in keys:
+            continue
+        move = info["pv"][0]
+        score = root_info_to_reward(info, board)
+
+        if use_cache:
+            get_cache().put(keys[move], score)
+        for i in moves[move]:
+            results[i] = (score, "Valid move")
+
+
+def search_nodes(infos):
+    # Nodes of one (MultiPV) search, every line reports the total of the search
+    return max((info.get('nodes', 0) for info in infos), default=0)
+
+
+def evaluate_group(fen, sans, time=0.1, return_score_only=False, use_cache=True, nodes=None, depth=None, return_info=False):
+    # Scores every completion for one prompt with a single root search restricted to the legal moves. A nodes budget
+    # is the total of that MultiPV search, shared by all of its lines, not a per move budget
+    board = chess.Board(fen)
+
+    limit = make_limit(time, nodes, depth)
+
+    search_info = {'nodes': 0, 'shortcuts': []}
+    results, moves, keys, search_moves = prepare_group(fen, board, sans, limit, not return_score_only, use_cache, search_info['shortcuts'])
+
+    if len(search_moves) > 0:
+        try:
+            with get_pool().lease() as engine:
+                infos = engine.analyse(board, limit, multipv=len(search_moves), root_moves=search_moves, game=search_game(limit))
+            search_info['nodes'] += search_nodes(infos)
+            apply_group_infos(infos, board, results, moves, keys, use_cache)
+
+        except Exception as e:
+            # print(e)
+            # traceback.print_exc()
+            pass
+
+        # Lines the engine did not report in time fall back to a search of their own
+        for move in search_moves:
+            idxs = moves[move]
+            if results[idxs[0]] is None:
+                result, info = evaluate_position(fen, sans[idxs[0]], time, use_cache=use_cache, nodes=nodes, depth=depth, return_info=True)
+                search_info['nodes'] += info['nodes']
+                search_info['shortcuts'] += info['shortcuts']
+                for i in idxs:
+                    results[i] = result
+
+    if return_score_only:
+        results = [r[0] for r in results]
+    if return_info:
+        return results, search_info
+    count_shortcuts(search_info['shortcuts'])
+    return results
+
 
 if __name__ == "__main__":
     # Example usage
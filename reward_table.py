@@ -0,0 +1,157 @@
+import os
+
+import chess
+import numpy as np
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from evaluation import evaluate_group, parse_move, count_shortcuts
+from async_eval import get_evaluator
+from dataset.labelDataset import prompt_board
+
+
+def reward_table_path(dataset_path):
+    # Stored next to the dataset file (or shard directory)
+    return dataset_path.rstrip('/') + '.rewards.npz'
+
+
+def valid_scores(sans, results):
+    # {san: reward} of the moves the engine actually scored, failed searches ((0.5, 'Unknown error')) are left out
+    return {san: score for san, (score, message) in zip(sans, results) if message == "Valid move"}
+
+
+def score_all_moves(fen, time=0.1):
+    # {san: reward} of every legal move, from one MultiPV search over all of them (same mapping as evaluate_position),
+    # and the shortcut names to count in the calling process (this runs in joblib workers)
+    board = chess.Board(fen)
+    sans = [board.san(move) for move in board.legal_moves]
+    if len(sans) == 0:
+        return {}, []
+    results, info = evaluate_group(fen, sans, time, use_cache=False, return_info=True)
+    return valid_scores(sans, results), info['shortcuts']
+
+
+# Scores every legal move of every distinct dataset position once and writes the tables to path as flat arrays:
+# positions (EPD), starts (first row of each position), moves (SAN) and rewards (float32). Moves whose search failed
+# are not written (RewardTable.evaluate sends them to its fallback), and nothing is written when no search succeeded
+def build_reward_table(prompts, path, n_jobs=8, time=0.1, enable_tqdm=True, backend='joblib'):
+    fens = {}
+    for prompt in prompts:
+        board = prompt_board(prompt)
+        fens.setdefault(board.epd(), board.fen())
+    positions = list(fens.keys())
+
+    if backend == 'async':
+        groups = []
+        for fen in fens.values():
+            board = chess.Board(fen)
+            groups.append((fen, [board.san(move) for move in board.legal_moves]))
+        results = get_evaluator(num_engines=n_jobs).evaluate_groups([g for g in groups if len(g[1]) > 0], time, use_cache=False)
+        results = iter(results)
+        tables = [valid_scores(sans, next(results)) if len(sans) > 0 else {} for _, sans in groups]
+    else:
+        jobs = list(fens.values())
+        if enable_tqdm:
+            jobs = tqdm(jobs, desc='Scoring positions')
+        scored = Parallel(n_jobs=n_jobs)(delayed(score_all_moves)(fen, time) for fen in jobs)
+        tables = [table for table, _ in scored]
+        count_shortcuts(name for _, shortcuts in scored for name in shortcuts)
+
+    num_moves = sum(chess.Board(fen).legal_moves.count() for fen in fens.values())
+    num_scored = sum(len(t) for t in tables)
+    if num_moves > 0 and num_scored == 0:
+        raise RuntimeError('No move could be scored, check the stockfish path (engine_pool.STOCKFISH_PATH)')
+    if num_scored < num_moves:
+        print(f'{num_moves - num_scored} of {num_moves} moves failed to score and were left out of the reward table')
+
+    starts = np.cumsum([0] + [len(t) for t in tables]).astype(np.int64)
+    moves = [san for t in tables for san in t.keys()]
+    rewards = [r for t in tables for r in t.values()]
+
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, positions=np.array(positions, dtype=str), starts=starts,
+                            moves=np.array(moves, dtype=str), rewards=np.array(rewards, dtype=np.float32))
+    return RewardTable(path)
+
+
+class RewardTable():
+    """
+    Precomputed move -> reward tables of the dataset positions, written by build_reward_table.
+
+    Legal completions are scored with a lookup (after canonicalizing the SAN through the board, so
+    'Nf3' and 'Ng1f3' hit the same entry), illegal ones get -1 and the illegal move classifier message.
+    Completions missing from the table go to `fallback(prompts, completions)` when given, else score 0.5.
+    """
+
+    def __init__(self, path):
+        data = np.load(path)
+        self.rows = {p: i for i, p in enumerate(data['positions'].tolist())}
+        self.starts = data['starts']
+        self.moves = data['moves'].tolist()
+        self.rewards = data['rewards'].tolist()
+
+        self.num_lookups = 0
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, epd, san):
+        row = self.rows.get(epd)
+        if row is None:
+            return None
+        start, end = self.starts[row], self.starts[row + 1]
+        for i in range(start, end):
+            if self.moves[i] == san:
+                return self.rewards[i]
+        return None
+
+    def evaluate(self, prompts, completions, fallback=None, return_messages=False):
+        ret = [None] * len(prompts)
+        boards = {}
+        missing = []
+        for i, (prompt, completion) in enumerate(zip(prompts, completions)):
+            board = boards.get(prompt)
+            if board is None:
+                board = boards[prompt] = prompt_board(prompt)
+
+            move, message = parse_move(board.fen(), board, completion, classify=return_messages)
+            if move is None:
+                ret[i] = (-1, message)
+                continue
+
+            self.num_lookups += 1
+            score = self.get(board.epd(), board.san(move))
+            if score is None:
+                self.num_misses += 1
+                missing.append(i)
+            else:
+                ret[i] = (score, "Valid move")
+
+        if len(missing) > 0:
+            if fallback is not None:
+                scores = fallback([prompts[i] for i in missing], [completions[i] for i in missing])
+            else:
+                scores = [0.5] * len(missing)
+            for i, score in zip(missing, scores):
+                ret[i] = (score, "Valid move")
+
+        if return_messages:
+            return ret
+        return [r[0] for r in ret]
+
+    def stats(self):
+        return {'positions': len(self.rows), 'lookups': self.num_lookups, 'misses': self.num_misses}
+
+
+def load_reward_table(dataset_path):
+    path = reward_table_path(dataset_path)
+    return RewardTable(path) if os.path.exists(path) else None
+
+
+if __name__ == '__main__':
+    from dataset.parquetShards import load_shards
+
+    dataset_path = 'data/small_shards'
+    table = build_reward_table(load_shards(dataset_path)['prompt'], reward_table_path(dataset_path), n_jobs=10)
+    print(f'scored {len(table)} positions')
@@ -1,54 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import json
+import os
+import time
+
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import torch
-from dataset.chessDataset import ChessDataset
-from torch.utils.data import DataLoader
-from tqdm import tqdm
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from tqdm import tqdm
+
 from batch_eval import batch_eval
-import numpy as np
+from bot.GRPOBot import generate_candidates
+from dataset.chessDataset import generate_samples
+
+
+class EvalResults():
+    """
+    Running totals of an evaluation: reward histogram (rewards are in [-1, 1], -1 for illegal moves), illegal move
+    categories and mean reward, updated one evaluated batch at a time. `scoring` records what was scored
+    ('continuation' or 'first_move', see evaluate_model) in the summary.
+    """
+
+    def __init__(self, bins=50, scoring='continuation'):
+        self.scoring = scoring
+        self.edges = np.linspace(-1, 1, bins + 1)
+        self.hist = np.zeros(bins, dtype=np.int64)
+        self.categories = Counter()
+        self.num_samples = 0
+        self.total_reward = 0.0
+
+    def update(self, results):
+        scores = np.array([score for score, _ in results], dtype=np.float64)
+        self.hist += np.histogram(np.clip(scores, -1, 1), bins=self.edges)[0]
+        self.categories.update(message for _, message in results)
+        self.num_samples += len(results)
+        self.total_reward += float(scores.sum())
+
+    def summary(self):
+        num_legal = self.categories.get('Valid move', 0)
+        return {'scoring': self.scoring,
+                'samples': self.num_samples,
+                'mean_reward': self.total_reward / self.num_samples if self.num_samples > 0 else 0.0,
+                'legal_rate': num_legal / self.num_samples if self.num_samples > 0 else 0.0,
+                'categories': dict(self.categories.most_common()),
+                'histogram': {'edges': self.edges.tolist(), 'counts': self.hist.tolist()}}
+
+    def save(self, path):
+        # Writes path.json with the summary and path.png with the reward histogram
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.json', 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+        plt.figure()
+        plt.stairs(self.hist, self.edges, fill=True)
+        plt.xlabel('reward')
+        plt.ylabel('count')
+        plt.title(f'{self.num_samples} samples, mean reward {self.summary()["mean_reward"]:.3f}')
+        plt.savefig(path + '.png')
+        plt.close()
+
+
+def batches(samples, batch_size):
+    batch = []
+    for prompt, _ in samples:
+        batch.append(prompt)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def generate_continuations(model, tokenizer, prompts, max_length=200, **generate_kwargs):
+    # Decoded continuation of every prompt from one left padded generate call, sliced like the serial loop used to
+    # (decode(prompt + continuation)[len(prompt):]). max_length counts the padded prompt, as in a batch of one
+    tokenizer.padding_side = 'left'
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    inputs = tokenizer(prompts, return_tensors='pt', padding=True).to(model.device)
+    with torch.no_grad():
+        outputs = model.generate(**inputs, max_new_tokens=max(1, max_length - inputs['input_ids'].shape[1]), do_sample=True,
+                                 pad_token_id=tokenizer.pad_token_id, **generate_kwargs)
+    texts = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+    return [text[len(prompt):] for prompt, text in zip(prompts, texts)]
 
 
-# model = AutoModelForCausalLM.from_pretrained('saved/models/fb-chess-model-final')
-# tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/fb-chess-tokenizer-final')
+# Generates one completion per prompt in batches and scores every finished batch on a background thread while the
+# next one is generating, so the model and the engines work at the same time. Results are aggregated as batches
+# finish and written to out_path.json / out_path.png.
+# By default the whole decoded continuation is scored, like the earlier serial loop (trailing text or a second move
+# is 'Bad format'). first_move=True scores only the first move of the continuation (GRPOBot's view, decoding stops
+# at the move boundary), its legal rate and rewards are not comparable with continuation runs
+def evaluate_model(model, tokenizer, samples, out_path, batch_size=32, n_jobs=60, backend='joblib', max_length=200, first_move=False,
+                   **generate_kwargs):
+    results = EvalResults(scoring='first_move' if first_move else 'continuation')
+    pending = []
+    start = time.time()
 
-# model = AutoModelForCausalLM.from_pretrained('saved/models/20250406-130417')
-# tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/20250406-130417')
+    def fold(future):
+        # Raises the error of a failed batch as soon as it is folded in, not after the whole run
+        if future.exception() is not None:
+            raise future.exception()
+        results.update(future.result())
 
-# model = AutoModelForCausalLM.from_pretrained('saved/models/GRPO_20250413-165913')
-# tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/GRPO_20250413-165913')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            for prompts in tqdm(batches(samples, batch_size), desc='Generating'):
+                if first_move:
+                    candidates = generate_candidates(model, tokenizer, prompts, num_candidates=1, constrained=False, **generate_kwargs)
+                    responses = [c[0][0] if len(c) > 0 else '' for c in candidates]
+                else:
+                    responses = generate_continuations(model, tokenizer, prompts, max_length, **generate_kwargs)
+                pending.append(executor.submit(batch_eval, prompts, responses, n_jobs, enable_tqdm=False, return_messages=True,
+                                               backend=backend))
 
-model = AutoModelForCausalLM.from_pretrained('saved/models/GRPO_20250413-174516')
-tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/GRPO_20250413-174516')
+                # Fold in the batches that are done without waiting for the rest
+                while len(pending) > 0 and pending[0].done():
+                    fold(pending.pop(0))
 
-model = model.to("cuda" if torch.cuda.is_available() else "cpu")
+            for future in pending:
+                fold(future)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
 
+    results.save(out_path)
+    summary = results.summary()
+    summary['seconds'] = time.time() - start
+    return summary
 
-def generate_text(prompt, max_length=200):
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    outputs = model.generate(
-        **inputs,
-        max_length=max_length,
-        do_sample=True,
-        temperature=0.7,
-        top_p=0.9
-    )
-    return tokenizer.decode(outputs[0], skip_special_tokens=True)
 
+if __name__ == '__main__':
+    # model = AutoModelForCausalLM.from_pretrained('saved/models/fb-chess-model-final')
+    # tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/fb-chess-tokenizer-final')
 
-dataset = ChessDataset(pgn_path='data/lichess_db_standard_rated_2017-03.pgn', end_in='white', num_games=1000, use_FEN=True, offset=50_000)
-dataloader = DataLoader(dataset, shuffle=False)
+    # model = AutoModelForCausalLM.from_pretrained('saved/models/20250406-130417')
+    # tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/20250406-130417')
 
-prompts = []
-responses = []
+    # model = AutoModelForCausalLM.from_pretrained('saved/models/GRPO_20250413-165913')
+    # tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/GRPO_20250413-165913')
 
-for i, (fen, _) in enumerate(tqdm(dataloader)):
-    prompt = fen[0]
-    response = generate_text(prompt)[len(prompt):]
-    prompts.append(prompt)
-    responses.append(response)
+    model = AutoModelForCausalLM.from_pretrained('saved/models/GRPO_20250413-174516')
+    tokenizer = AutoTokenizer.from_pretrained('saved/tokenizers/GRPO_20250413-174516')
 
-evals = batch_eval(prompts, responses, 60)
-evals = np.array(evals)
+    model = model.to("cuda" if torch.cuda.is_available() else "cpu")
 
-plt.hist(evals, bins=50)
-plt.show()
+    # The same games as the earlier ChessDataset(num_games=1000, offset=50_000), which skipped num_games games after offset
+    samples = generate_samples('data/lichess_db_standard_rated_2017-03.pgn', end_in='white', num_games=1000, use_FEN=True,
+                               offset=51_000, use_index=True)
+    summary = evaluate_model(model, tokenizer, samples, 'results/GRPO_20250413-174516', n_jobs=60, temperature=0.7, top_p=0.9)
+    print(json.dumps({k: v for k, v in summary.items() if k != 'histogram'}, indent=2))
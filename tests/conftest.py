@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+
+FAKE_ENGINE = os.path.join(os.path.dirname(__file__), 'fake_engine.py')
+
+
+@pytest.fixture
+def fake_engine():
+    # popen_uci command of tests/fake_engine.py
+    return [sys.executable, FAKE_ENGINE]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    # Fresh in-memory evaluation cache in place of the process wide one
+    import eval_cache
+
+    cache = eval_cache.EvalCache()
+    monkeypatch.setattr(eval_cache, '_cache', cache)
+    return cache
@@ -0,0 +1,36 @@
+# Minimal UCI engine for the tests: every search reports a score of 0 (or mate when the side to move is mated),
+# the nodes it was given, the first legal move and (info string) the number of ucinewgame commands received so far
+import sys
+
+import chess
+
+
+board = chess.Board()
+new_games = 0
+for line in sys.stdin:
+    tokens = line.split()
+    if len(tokens) == 0:
+        continue
+    command = tokens[0]
+
+    if command == 'uci':
+        print('id name Fake\noption name Hash type spin default 16 min 1 max 1024\nuciok', flush=True)
+    elif command == 'isready':
+        print('readyok', flush=True)
+    elif command == 'ucinewgame':
+        new_games += 1
+    elif command == 'position':
+        moves = tokens.index('moves') if 'moves' in tokens else len(tokens)
+        board = chess.Board() if tokens[1] == 'startpos' else chess.Board(' '.join(tokens[2:moves]))
+        for uci in tokens[moves + 1:]:
+            board.push_uci(uci)
+    elif command == 'go':
+        nodes = int(tokens[tokens.index('nodes') + 1]) if 'nodes' in tokens else 1000
+        legal_moves = list(board.legal_moves)
+        if len(legal_moves) == 0:
+            print(f'info depth 0 score {"mate 0" if board.is_check() else "cp 0"}\nbestmove (none)', flush=True)
+        else:
+            print(f'info depth 1 score cp 0 nodes {nodes} pv {legal_moves[0].uci()} string new_games {new_games}\n'
+                  f'bestmove {legal_moves[0].uci()}', flush=True)
+    elif command == 'quit':
+        break
@@ -0,0 +1,86 @@
+import chess
+import pytest
+
+import adaptive_eval
+from adaptive_eval import adaptive_batch_eval, is_mate_reward, move_keys, uncertainty
+
+
+def test_move_keys():
+    fool = 'rnbqkbnr/ppppp2p/5p2/6p1/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 3'
+    keys = move_keys([chess.STARTING_FEN] * 3 + [fool, fool], ['Nf3', 'Ng1f3', 'Ke2', 'Qh5#', 'd4'])
+
+    assert keys[0] == keys[1] == 'rnbqkbnr/pppppppp/8/8/8/5N2/PPPPPPPP/RNBQKB1R b KQkq -'
+    # Illegal moves and positions the board alone decides are never searched again
+    assert keys[2] is None
+    assert keys[3] is None
+    assert keys[4] is not None
+
+
+@pytest.mark.parametrize('score, mate', [(1.0, True), (0.9, True), (0.95, True), (0.1, True), (0.0, True), (0.5, False), (0.89, False), (0.11, False)])
+def test_is_mate_reward(score, mate):
+    assert is_mate_reward(score) == mate
+
+
+def test_uncertainty_selects_the_band_and_close_ranks():
+    games = ['a'] * 5
+    keys = ['mid', 'low', 'high', 'higher', None]
+    scores = [0.45, 0.2, 0.82, 0.84, 0.5]
+    priorities = uncertainty(scores, keys, games, band=(0.3, 0.7), rank_margin=0.05)
+
+    assert set(priorities) == {'mid', 'high', 'higher'}
+    assert priorities['mid'] == pytest.approx(0.05)
+    assert priorities['high'] == pytest.approx(0.02)
+    assert priorities['higher'] == pytest.approx(0.02)
+
+
+def test_uncertainty_ranks_only_within_a_prompt():
+    priorities = uncertainty([0.82, 0.84], ['x', 'y'], ['a', 'b'], band=(0.3, 0.7), rank_margin=0.05)
+    assert priorities == {}
+
+
+def test_uncertainty_ignores_mate_ties():
+    games = ['a'] * 3
+    priorities = uncertainty([0.95, 0.96, 0.88], ['m1', 'm2', 'c'], games, band=(0.3, 0.7), rank_margin=0.05)
+    assert priorities == {}
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    # Replaces batch_eval: the screening pass scores the moves with fixed rewards, every deeper search returns 0.6
+    calls = []
+    screening = {'e4': 0.5, 'd4': 0.2, 'c4': 0.82, 'Nf3': 0.84, 'Ke2': -1}
+
+    def batch_eval(games, moves, n_jobs, nodes=None, group_moves=False, **kwargs):
+        calls.append((list(moves), nodes, group_moves))
+        if group_moves:
+            results = [(screening[m], 'Valid move' if screening[m] >= 0 else 'Self capture') for m in moves]
+            positions = len(set(m for m in moves if screening[m] >= 0))
+        else:
+            results = [(0.6, 'Valid move')] * len(moves)
+            positions = len(moves)
+        # One grouped search per prompt, one search per position otherwise
+        return results, {'positions': positions, 'nodes': nodes if group_moves else positions * nodes}
+
+    monkeypatch.setattr(adaptive_eval, 'batch_eval', batch_eval)
+    return calls
+
+
+def test_adaptive_batch_eval_spends_the_budget_on_the_most_uncertain(batches):
+    games = [chess.STARTING_FEN] * 6
+    moves = ['e4', 'd4', 'c4', 'Nf3', 'Ke2', 'e4']
+    scores, report = adaptive_batch_eval(games, moves, 1, low_nodes=2_000, high_nodes=50_000, budget=0.5, return_report=True)
+
+    # 4 legal positions: the fixed run costs 200k nodes, half of it leaves one deeper search after the 2k screening,
+    # spent on the move closest to 0.5
+    assert batches == [(moves, 2_000, True), (['e4'], 50_000, False)]
+    assert report == {'positions': 4, 'uncertain': 3, 'researched': 1, 'nodes': 52_000, 'fixed_nodes': 200_000, 'saved': pytest.approx(0.74)}
+    assert scores == [0.6, 0.2, 0.82, 0.84, -1, 0.6]
+
+
+def test_adaptive_batch_eval_with_a_full_budget(batches):
+    games = [chess.STARTING_FEN] * 6
+    moves = ['e4', 'd4', 'c4', 'Nf3', 'Ke2', 'e4']
+    scores = adaptive_batch_eval(games, moves, 1, low_nodes=2_000, high_nodes=50_000, budget=1.0)
+
+    assert sorted(batches[1][0]) == ['Nf3', 'c4', 'e4']
+    assert scores == [0.6, 0.2, 0.6, 0.6, -1, 0.6]
@@ -0,0 +1,107 @@
+import chess
+import pytest
+
+import batch_eval
+from batch_eval import batch_eval as run_batch_eval
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    # Replaces the engine searches of the workers, recording every dispatched position or group
+    searches = []
+
+    def evaluate_position(fen, san, time=0.1, use_cache=True, nodes=None, depth=None, return_info=False):
+        searches.append((fen, san))
+        return (0.4, 'Valid move'), {'nodes': 100, 'shortcuts': []}
+
+    def evaluate_group(fen, sans, time=0.1, use_cache=True, nodes=None, depth=None, return_info=False):
+        searches.append((fen, tuple(sans)))
+        return [(0.3, 'Valid move')] * len(sans), {'nodes': 100, 'shortcuts': []}
+
+    monkeypatch.setattr(batch_eval, 'evaluate_position', evaluate_position)
+    monkeypatch.setattr(batch_eval, 'evaluate_group', evaluate_group)
+    return searches
+
+
+def test_grouped_rewards_are_cached_apart_from_per_move_ones(cache, searches):
+    fens = [chess.STARTING_FEN] * 2
+    sans = ['e4', 'd4']
+
+    assert run_batch_eval(fens, sans, 1, enable_tqdm=False, group_moves=True) == [0.3, 0.3]
+    assert searches == [(chess.STARTING_FEN, ('e4', 'd4'))]
+    assert all(key.endswith('|multipv=2') for key in cache.entries)
+
+    # The same group again is served from the cache
+    scores, info = run_batch_eval(fens, sans, 1, enable_tqdm=False, group_moves=True, return_info=True)
+    assert scores == [0.3, 0.3]
+    assert info == {'positions': 0, 'nodes': 0}
+    assert len(searches) == 1
+
+    # Per move scoring does not see the grouped rewards, and the other way round
+    assert run_batch_eval(fens, sans, 1, enable_tqdm=False) == [0.4, 0.4]
+    assert searches[1:] == [(chess.STARTING_FEN, 'e4'), (chess.STARTING_FEN, 'd4')]
+    assert run_batch_eval(fens, sans, 1, enable_tqdm=False, group_moves=True) == [0.3, 0.3]
+    assert len(searches) == 3
+
+
+def test_grouped_width_is_part_of_the_key(cache, searches):
+    run_batch_eval([chess.STARTING_FEN] * 2, ['e4', 'd4'], 1, enable_tqdm=False, group_moves=True)
+    run_batch_eval([chess.STARTING_FEN] * 3, ['e4', 'd4', 'c4'], 1, enable_tqdm=False, group_moves=True)
+
+    assert searches == [(chess.STARTING_FEN, ('e4', 'd4')), (chess.STARTING_FEN, ('e4', 'd4', 'c4'))]
+
+
+def test_illegal_moves_never_reach_the_engines(cache, searches):
+    fens = [chess.STARTING_FEN] * 4
+    results = run_batch_eval(fens, ['xyz', 'Ke2', 'e5', 'e4'], 1, enable_tqdm=False, return_messages=True)
+
+    assert results == [(-1, 'Bad format'), (-1, 'Self capture'), (-1, 'No piece reaches destination'), (0.4, 'Valid move')]
+    assert searches == [(chess.STARTING_FEN, 'e4')]
+
+
+def test_unclassified_illegal_moves(cache, searches):
+    assert run_batch_eval([chess.STARTING_FEN], ['Ke2'], 1, enable_tqdm=False) == [-1]
+
+
+def test_each_distinct_position_is_searched_once(cache, searches):
+    # Nf3 and Ng1f3 are the same move, and 1. Nf3 Nf6 2. Nc3 / 1. Nc3 Nf6 2. Nf3 transpose
+    first = 'rnbqkb1r/pppppppp/5n2/8/8/5N2/PPPPPPPP/RNBQKB1R w KQkq - 2 2'
+    second = 'rnbqkb1r/pppppppp/5n2/8/8/2N5/PPPPPPPP/R1BQKBNR w KQkq - 2 2'
+    fens = [chess.STARTING_FEN, chess.STARTING_FEN, chess.STARTING_FEN, first, second]
+    sans = ['Nf3', 'Ng1f3', 'Nf3', 'Nc3', 'Nf3']
+
+    scores, info = run_batch_eval(fens, sans, 1, enable_tqdm=False, return_info=True)
+    assert scores == [0.4] * 5
+    assert searches == [(chess.STARTING_FEN, 'Nf3'), (first, 'Nc3')]
+    assert info == {'positions': 2, 'nodes': 200}
+
+
+def test_trivial_and_cached_positions_never_reach_the_engines(cache, searches):
+    # Qh5 mates from the fool's mate position
+    fool = 'rnbqkbnr/ppppp2p/5p2/6p1/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 3'
+    run_batch_eval([chess.STARTING_FEN], ['d4'], 1, enable_tqdm=False)
+    searches.clear()
+
+    scores, info = run_batch_eval([fool, chess.STARTING_FEN, chess.STARTING_FEN], ['Qh5#', 'd4', 'e4'], 1, enable_tqdm=False, return_info=True)
+    assert scores == [1.0, 0.4, 0.4]
+    assert searches == [(chess.STARTING_FEN, 'e4')]
+    assert info['positions'] == 1
+
+
+def test_use_cache_false_searches_again(cache, searches):
+    run_batch_eval([chess.STARTING_FEN], ['d4'], 1, enable_tqdm=False, use_cache=False)
+    run_batch_eval([chess.STARTING_FEN], ['d4'], 1, enable_tqdm=False, use_cache=False)
+    assert len(searches) == 2
+    assert len(cache.entries) == 0
+
+
+def test_worker_shortcuts_are_counted_in_the_caller(cache, monkeypatch):
+    import evaluation
+
+    monkeypatch.setattr(evaluation, 'shortcut_counts', dict.fromkeys(evaluation.shortcut_counts, 0))
+    monkeypatch.setattr(batch_eval, 'evaluate_position',
+                        lambda fen, san, time=0.1, use_cache=True, nodes=None, depth=None, return_info=False: ((0.5, 'Valid move'),
+                                                                                                             {'nodes': 0, 'shortcuts': ['forced_draw']}))
+
+    run_batch_eval([chess.STARTING_FEN] * 2, ['e4', 'd4'], 1, enable_tqdm=False)
+    assert evaluation.shortcut_stats()['forced_draw'] == 2
@@ -0,0 +1,50 @@
+import chess
+import numpy as np
+import pytest
+
+from dataset.dedupDataset import dedup_report, dedup_samples, position_weights, weighted_indices
+
+
+# 1. Nf3 Nf6 2. Nc3 and 1. Nc3 Nf6 2. Nf3 reach the same position, as FEN and as movetext prompts
+TRANSPOSED = ['rnbqkb1r/pppppppp/5n2/8/8/2N2N2/PPPPPPPP/R1BQKB1R b KQkq - 3 2', '1. Nc3 Nf6 2. Nf3']
+
+
+def test_transpositions_merge():
+    samples = [(TRANSPOSED[0], 'e6'), (chess.STARTING_FEN, 'e4'), (TRANSPOSED[1], 'd5'), (TRANSPOSED[0], 'd5')]
+    deduped, counts, distributions = dedup_samples(samples, keep_distribution=True)
+
+    # The first prompt of a position is kept, with its most frequent completion
+    assert deduped == [(TRANSPOSED[0], 'd5'), (chess.STARTING_FEN, 'e4')]
+    assert counts.tolist() == [3, 1]
+    assert distributions == [{'e6': 1, 'd5': 2}, {'e4': 1}]
+
+
+def test_move_clocks_do_not_split_positions():
+    samples = [(chess.STARTING_FEN, 'e4'), (chess.STARTING_FEN.replace(' 0 1', ' 4 3'), 'e4')]
+    deduped, counts, distributions = dedup_samples(samples)
+    assert len(deduped) == 1
+    assert counts.tolist() == [2]
+    assert distributions is None
+
+
+def test_dedup_report():
+    report = dedup_report(np.array([3, 1]))
+    assert report == {'samples': 4, 'positions': 2, 'dedup_ratio': 2.0, 'duplicate_fraction': 0.5, 'max_count': 3}
+    assert dedup_report(np.array([], dtype=np.int64))['dedup_ratio'] == 0.0
+
+
+def test_position_weights():
+    counts = [1, 4, 16]
+    assert position_weights(counts, alpha=1) == pytest.approx([1 / 21, 4 / 21, 16 / 21])
+    assert position_weights(counts, alpha=0) == pytest.approx([1 / 3] * 3)
+    assert position_weights(counts, alpha=0.5) == pytest.approx([1 / 7, 2 / 7, 4 / 7])
+
+
+def test_weighted_indices():
+    counts = [1, 1, 100]
+    indices = weighted_indices(counts, alpha=1, num_samples=1000, seed=0)
+
+    assert len(indices) == 1000
+    assert np.bincount(indices, minlength=3)[2] > 900
+    assert indices.tolist() == weighted_indices(counts, alpha=1, num_samples=1000, seed=0).tolist()
+    assert len(weighted_indices(counts)) == 3
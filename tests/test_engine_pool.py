@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import chess
+import chess.engine
+import pytest
+
+import engine_pool
+from engine_pool import EnginePool, get_pool, make_limit, search_game
+
+
+@pytest.fixture
+def pool(fake_engine):
+    pool = EnginePool(fake_engine, size=2, max_uses=3)
+    yield pool
+    pool.close()
+
+
+def test_lease_reuses_engines(pool):
+    with pool.lease() as engine:
+        first = engine
+        info = engine.analyse(chess.Board(), chess.engine.Limit(nodes=10))
+        assert info['nodes'] == 10
+    with pool.lease() as engine:
+        assert engine is first
+
+    assert pool.stats() == {'spawned': 1, 'restarts': 0, 'recycled': 0, 'leases': 2, 'idle': 1}
+
+
+def test_engines_are_recycled_after_max_uses(pool):
+    engines = []
+    for _ in range(4):
+        with pool.lease() as engine:
+            engines.append(engine)
+
+    assert engines[0] is engines[1] is engines[2]
+    assert engines[3] is not engines[0]
+    assert pool.stats()['recycled'] == 1
+    assert pool.stats()['spawned'] == 2
+
+
+def test_crashed_engine_is_replaced(pool):
+    with pytest.raises(chess.engine.EngineTerminatedError):
+        with pool.lease() as engine:
+            crashed = engine
+            raise chess.engine.EngineTerminatedError('engine died')
+
+    with pool.lease() as engine:
+        assert engine is not crashed
+        engine.ping()
+    assert pool.stats()['restarts'] == 1
+
+
+def test_dead_idle_engine_fails_the_health_check(pool):
+    with pool.lease() as engine:
+        dead = engine
+    dead.quit()
+
+    with pool.lease() as engine:
+        assert engine is not dead
+        engine.ping()
+    assert pool.stats()['restarts'] == 1
+
+
+def test_size_bounds_concurrent_engines(fake_engine):
+    pool = EnginePool(fake_engine, size=2)
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def search(_):
+        with pool.lease() as engine:
+            with lock:
+                active.append(engine)
+                peak.append(len(active))
+            engine.analyse(chess.Board(), chess.engine.Limit(nodes=10))
+            with lock:
+                active.remove(engine)
+
+    try:
+        with ThreadPoolExecutor(6) as executor:
+            list(executor.map(search, range(24)))
+        assert max(peak) <= 2
+        assert pool.stats()['spawned'] <= 2
+        assert pool.stats()['leases'] == 24
+    finally:
+        pool.close()
+
+
+def test_closed_pool_refuses_leases(fake_engine):
+    pool = EnginePool(fake_engine)
+    with pool.lease():
+        pass
+    pool.close()
+
+    assert pool.stats()['idle'] == 0
+    with pytest.raises(RuntimeError):
+        with pool.lease():
+            pass
+
+
+def test_get_pool_is_keyed_on_the_configuration(monkeypatch):
+    monkeypatch.setattr(engine_pool, '_pools', {})
+    pool = get_pool('engine', size=2, options={'Hash': 16, 'Threads': 1})
+
+    assert get_pool('engine', size=2, options={'Threads': 1, 'Hash': 16}) is pool
+    assert get_pool('engine', size=2, options={'Hash': 32, 'Threads': 1}) is not pool
+    assert get_pool('engine', size=4, options={'Hash': 16, 'Threads': 1}) is not pool
+    assert get_pool('other', size=2, options={'Hash': 16, 'Threads': 1}) is not pool
+
+    engine_pool.close_pools()
+    assert engine_pool._pools == {}
+    assert pool.closed
+
+
+def test_make_limit():
+    assert make_limit(0.5) == chess.engine.Limit(time=0.5)
+    assert make_limit(0.5, nodes=1000) == chess.engine.Limit(nodes=1000)
+    assert make_limit(0.5, depth=12) == chess.engine.Limit(depth=12)
+
+
+def test_search_game():
+    assert search_game(make_limit(0.1)) is None
+    assert search_game(make_limit(nodes=1000)) is not None
+    assert search_game(make_limit(nodes=1000)) is not search_game(make_limit(nodes=1000))
+    assert search_game(make_limit(depth=8)) is not None
+
+
+def test_only_budgeted_searches_start_a_fresh_game(pool):
+    # tests/fake_engine.py reports the number of ucinewgame commands it received
+    def new_games(limit):
+        info = engine.analyse(chess.Board(), limit, game=search_game(limit))
+        return int(info['string'].split()[-1])
+
+    with pool.lease() as engine:
+        assert [new_games(make_limit(0.01)) for _ in range(3)] == [1, 1, 1]
+        assert [new_games(make_limit(nodes=10)) for _ in range(3)] == [2, 3, 4]
+        assert [new_games(make_limit(depth=3)) for _ in range(2)] == [5, 6]
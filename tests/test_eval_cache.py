@@ -0,0 +1,77 @@
+import chess
+import chess.engine
+
+from eval_cache import EvalCache, position_key
+
+
+def test_lru_evicts_the_least_recently_used():
+    cache = EvalCache(max_size=2)
+    cache.put('a', 0.1)
+    cache.put('b', 0.2)
+    assert cache.get('a') == 0.1
+    cache.put('c', 0.3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 0.1
+    assert cache.get('c') == 0.3
+    assert cache.stats() == {'hits': 3, 'disk_hits': 0, 'misses': 1, 'hit_rate': 0.75, 'size': 2}
+
+
+def test_put_refreshes_an_entry():
+    cache = EvalCache(max_size=2)
+    cache.put('a', 0.1)
+    cache.put('b', 0.2)
+    cache.put('a', 0.4)
+    cache.put('c', 0.3)
+
+    assert cache.get('a') == 0.4
+    assert cache.get('b') is None
+
+
+def test_sqlite_round_trip(tmp_path):
+    path = str(tmp_path / 'evals.sqlite')
+    cache = EvalCache(path=path, commit_every=1000)
+    cache.put('a', 0.25)
+    cache.put('b', 0.75)
+    cache.close()
+
+    cache = EvalCache(max_size=1, path=path)
+    assert cache.get('a') == 0.25
+    assert cache.get('b') == 0.75
+    # Evicted from memory, still on disk
+    assert cache.get('a') == 0.25
+    assert cache.stats()['disk_hits'] == 3
+    assert cache.get('c') is None
+    cache.close()
+
+
+def test_flush_commits_pending_writes(tmp_path):
+    path = str(tmp_path / 'evals.sqlite')
+    writer = EvalCache(path=path, commit_every=1000)
+    writer.put('a', 0.5)
+    writer.flush()
+
+    reader = EvalCache(path=path)
+    assert reader.get('a') == 0.5
+    reader.close()
+    writer.close()
+
+
+def test_clear_keeps_the_disk_tier(tmp_path):
+    cache = EvalCache(path=str(tmp_path / 'evals.sqlite'))
+    cache.put('a', 0.5)
+    cache.clear()
+
+    assert cache.stats()['size'] == 0
+    assert cache.get('a') == 0.5
+    cache.close()
+
+
+def test_position_key_ignores_move_clocks():
+    limit = chess.engine.Limit(time=0.1)
+    first = chess.Board('rnbqkbnr/pppppppp/8/8/8/5N2/PPPPPPPP/RNBQKB1R b KQkq - 1 1')
+    later = chess.Board('rnbqkbnr/pppppppp/8/8/8/5N2/PPPPPPPP/RNBQKB1R b KQkq - 5 3')
+
+    assert position_key(first, limit) == position_key(later, limit)
+    assert position_key(first, limit) != position_key(first, chess.engine.Limit(time=0.2))
+    assert position_key(first, chess.engine.Limit(nodes=1000)) != position_key(first, chess.engine.Limit(depth=10))
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from test_model import EvalResults, batches
+
+
+def test_update_accumulates_batches():
+    results = EvalResults(bins=4)
+    results.update([(1.0, 'Valid move'), (0.2, 'Valid move'), (-1, 'Self capture')])
+    results.update([(-1, 'Bad format'), (0.6, 'Valid move')])
+
+    summary = results.summary()
+    assert summary['samples'] == 5
+    assert summary['mean_reward'] == pytest.approx((1.0 + 0.2 - 1 - 1 + 0.6) / 5)
+    assert summary['legal_rate'] == pytest.approx(3 / 5)
+    assert summary['categories'] == {'Valid move': 3, 'Self capture': 1, 'Bad format': 1}
+    assert list(summary['categories'])[0] == 'Valid move'
+    # Edges -1, -0.5, 0, 0.5, 1, the last bin includes 1
+    assert summary['histogram']['edges'] == pytest.approx([-1, -0.5, 0, 0.5, 1])
+    assert summary['histogram']['counts'] == [2, 0, 1, 2]
+    assert summary['scoring'] == 'continuation'
+
+
+def test_out_of_range_rewards_are_clipped_into_the_histogram():
+    results = EvalResults(bins=2)
+    results.update([(1.5, 'Valid move'), (-3, 'Valid move')])
+    assert results.summary()['histogram']['counts'] == [1, 1]
+
+
+def test_empty_summary():
+    summary = EvalResults(scoring='first_move').summary()
+    assert summary['samples'] == 0
+    assert summary['mean_reward'] == 0.0
+    assert summary['legal_rate'] == 0.0
+    assert summary['scoring'] == 'first_move'
+
+
+def test_save(tmp_path):
+    results = EvalResults(bins=4)
+    results.update([(0.5, 'Valid move'), (-1, 'Self capture')])
+    path = str(tmp_path / 'out' / 'eval')
+    results.save(path)
+
+    with open(path + '.json') as f:
+        assert json.load(f) == json.loads(json.dumps(results.summary()))
+    assert (tmp_path / 'out' / 'eval.png').stat().st_size > 0
+
+
+def test_batches():
+    samples = [(str(i), None) for i in range(7)]
+    assert list(batches(samples, 3)) == [['0', '1', '2'], ['3', '4', '5'], ['6']]
+    assert list(batches([], 3)) == []
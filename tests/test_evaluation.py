@@ -0,0 +1,189 @@
+import chess
+import chess.engine
+import pytest
+
+import evaluation
+from engine_pool import make_limit
+from eval_cache import position_key
+from evaluation import (classify_many, getIllegalMoveType, info_to_reward, prepare_group, root_info_to_reward, score_to_reward, shortcut_stats,
+                        trivial_reward, trivial_result)
+
+
+# ------------------------
+#      Score functions
+# ------------------------
+
+
+@pytest.mark.parametrize('mate', [1, 2, 5, 12])
+def test_root_mate_matches_post_move_mate(mate):
+    # A root search reports mate in n for the mover, the search after the move mate in n - 1
+    board = chess.Board()
+    root = root_info_to_reward({'score': chess.engine.PovScore(chess.engine.Mate(mate), chess.WHITE)}, board)
+
+    board.push_san('e4')
+    post = info_to_reward({'score': chess.engine.PovScore(chess.engine.Mate(-(mate - 1)), chess.BLACK)}, board)
+
+    assert root == pytest.approx(post)
+    assert root == pytest.approx(score_to_reward(chess.engine.Mate(mate - 1)))
+
+
+def test_root_mate_in_one_is_full_reward():
+    board = chess.Board()
+    assert root_info_to_reward({'score': chess.engine.PovScore(chess.engine.Mate(1), chess.WHITE)}, board) == pytest.approx(1.0)
+
+
+def test_root_mated_is_not_shifted():
+    board = chess.Board()
+    score = chess.engine.PovScore(chess.engine.Mate(-3), chess.WHITE)
+    assert root_info_to_reward({'score': score}, board) == pytest.approx(score_to_reward(chess.engine.Mate(-3)))
+
+
+def test_root_score_is_from_the_mover():
+    board = chess.Board()
+    board.push_san('e4')
+    score = chess.engine.PovScore(chess.engine.Cp(300), chess.WHITE)
+    assert root_info_to_reward({'score': score}, board) == pytest.approx(score_to_reward(chess.engine.Cp(-300)))
+    assert root_info_to_reward({'score': score}, board) < 0.5
+
+
+def test_missing_score_is_neutral():
+    assert root_info_to_reward({}, chess.Board()) == 0.5
+    assert info_to_reward({}, chess.Board()) == 0.5
+
+
+# ------------------------
+#     Grouped searches
+# ------------------------
+
+
+def test_prepare_group_keys_carry_the_search_width(cache):
+    board = chess.Board()
+    limit = make_limit(nodes=1000)
+    results, moves, keys, search_moves = prepare_group(board.fen(), board, ['e4', 'Nf3', 'Ng1f3', 'Ke2'], limit)
+
+    assert results == [None, None, None, (-1, 'Self capture')]
+    assert search_moves == [chess.Move.from_uci('e2e4'), chess.Move.from_uci('g1f3')]
+    assert moves[chess.Move.from_uci('g1f3')] == [1, 2]
+    for move in search_moves:
+        board.push(move)
+        assert keys[move] == position_key(board, limit, multipv=2)
+        assert keys[move] != position_key(board, limit)
+        board.pop()
+
+
+def test_prepare_group_is_served_from_the_cache_only_when_every_move_is(cache):
+    board = chess.Board()
+    limit = make_limit(nodes=1000)
+    _, _, keys, _ = prepare_group(board.fen(), board, ['e4', 'd4'], limit)
+
+    cache.put(keys[chess.Move.from_uci('e2e4')], 0.6)
+    results, _, _, search_moves = prepare_group(board.fen(), board, ['e4', 'd4'], limit)
+    assert len(search_moves) == 2
+    assert results == [None, None]
+
+    cache.put(keys[chess.Move.from_uci('d2d4')], 0.55)
+    results, _, _, search_moves = prepare_group(board.fen(), board, ['e4', 'd4'], limit)
+    assert search_moves == []
+    assert results == [(0.6, 'Valid move'), (0.55, 'Valid move')]
+
+
+def test_prepare_group_ignores_per_move_rewards(cache):
+    board = chess.Board()
+    limit = make_limit(nodes=1000)
+    for san in ['e4', 'd4']:
+        board.push_san(san)
+        cache.put(position_key(board, limit), 0.9)
+        board.pop()
+
+    _, _, _, search_moves = prepare_group(board.fen(), board, ['e4', 'd4'], limit)
+    assert len(search_moves) == 2
+
+
+# ------------------------
+#     Trivial rewards
+# ------------------------
+
+
+@pytest.mark.parametrize('fen, reward, name', [
+    # Fool's mate, white is mated after black's move
+    ('rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3', 1.0, 'checkmate'),
+    ('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1', 0.5, 'stalemate'),
+    ('7k/8/8/8/8/8/8/K5N1 b - - 0 1', 0.5, 'insufficient_material'),
+    # Black's only move takes the queen, leaving bare kings
+    ('7k/6Q1/8/8/8/8/8/K7 b - - 0 1', 0.5, 'forced_draw'),
+    (chess.STARTING_FEN, None, None),
+])
+def test_trivial_result(fen, reward, name):
+    assert trivial_result(chess.Board(fen)) == (reward, name)
+
+
+def test_trivial_result_respects_max_forced():
+    assert trivial_result(chess.Board('7k/6Q1/8/8/8/8/8/K7 b - - 0 1'), max_forced=0) == (None, None)
+
+
+def test_trivial_result_leaves_board_untouched():
+    board = chess.Board('7k/6Q1/8/8/8/8/8/K7 b - - 0 1')
+    trivial_result(board)
+    assert board.fen() == '7k/6Q1/8/8/8/8/8/K7 b - - 0 1'
+    assert len(board.move_stack) == 0
+
+
+def test_trivial_reward_counts_shortcuts(monkeypatch):
+    monkeypatch.setattr(evaluation, 'shortcut_counts', dict.fromkeys(evaluation.shortcut_counts, 0))
+    stalemate = chess.Board('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1')
+
+    assert trivial_reward(stalemate) == 0.5
+    assert trivial_reward(stalemate, count=False) == 0.5
+    assert trivial_reward(chess.Board()) is None
+    assert shortcut_stats() == {'checkmate': 0, 'stalemate': 1, 'insufficient_material': 0, 'forced_mate': 0, 'forced_draw': 0}
+
+
+def test_prepare_group_hands_shortcuts_to_the_caller(cache, monkeypatch):
+    monkeypatch.setattr(evaluation, 'shortcut_counts', dict.fromkeys(evaluation.shortcut_counts, 0))
+    fool = 'rnbqkbnr/ppppp2p/5p2/6p1/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 3'
+    board = chess.Board(fool)
+
+    shortcuts = []
+    results, _, _, search_moves = prepare_group(fool, board, ['Qh5#', 'd4'], make_limit(), shortcuts=shortcuts)
+    assert results[0] == (1.0, 'Valid move')
+    assert search_moves == [chess.Move.from_uci('d2d4')]
+    assert shortcuts == ['checkmate']
+    assert shortcut_stats()['checkmate'] == 0
+
+    prepare_group(fool, board, ['Qh5#'], make_limit())
+    assert shortcut_stats()['checkmate'] == 1
+
+
+# ------------------------
+#    Illegal move types
+# ------------------------
+
+
+@pytest.mark.parametrize('fen, san, message', [
+    (chess.STARTING_FEN, 'Nf3+', 'Incorrect check indication'),
+    (chess.STARTING_FEN, 'e4#', 'Incorrect checkmate indication'),
+    (chess.STARTING_FEN, 'Zz4', 'Unknown piece type'),
+    ('4k3/8/8/8/8/8/8/4K3 w - - 0 1', 'Kf9', 'Unknown move type'),
+    ('4k3/8/8/8/8/8/8/4K3 w - - 0 1', 'e5=Q', 'Unknown move type'),
+    ('4k3/8/8/8/8/8/8/R3K2R w - - 0 1', 'O-O', 'No castling rights'),
+    (chess.STARTING_FEN, 'O-O', 'Castling through blocked squares'),
+    ('4kr2/8/8/8/8/8/8/R3K2R w KQ - 0 1', 'O-O', 'Castling through check'),
+    (chess.STARTING_FEN, 'Ke2', 'Self capture'),
+    (chess.STARTING_FEN, 'Nxf3', 'No piece to be captured'),
+    ('4k3/8/8/3pP3/8/8/8/4K3 w - - 0 1', 'exd6', 'No piece to be captured'),
+    ('4k3/8/8/8/8/8/8/4K3 w - - 0 1', 'e8=Q', 'Empty square is not empty'),
+    (chess.STARTING_FEN, 'e5', 'No piece reaches destination'),
+    (chess.STARTING_FEN, 'Bc4', 'Attempting to move blocked piece'),
+    ('4k3/4r3/8/8/8/8/4B3/4K3 w - - 0 1', 'Bd3', 'Attempting to move pinned piece'),
+    ('4k3/4r3/8/8/8/8/3B4/4K3 w - - 0 1', 'Bc3', 'Move keeps king in check'),
+    ('4k3/8/8/8/8/5N2/8/1N2K3 w - - 0 1', 'Nd2', 'Ambiguous move'),
+])
+def test_illegal_move_type(fen, san, message):
+    board = chess.Board(fen)
+    assert getIllegalMoveType(fen, board, san) == message
+    assert board.fen() == fen
+
+
+def test_classify_many():
+    fens = [chess.STARTING_FEN, chess.STARTING_FEN, '4k3/8/8/8/8/5N2/8/1N2K3 w - - 0 1', chess.STARTING_FEN]
+    assert classify_many(fens, ['e4', 'Ke2', 'Nd2', 'Nz9']) == ['Valid move', 'Self capture', 'Ambiguous format', 'Bad format']
@@ -0,0 +1,108 @@
+import io
+import os
+
+import chess.pgn
+import pytest
+
+from dataset.chessDataset import generate_samples
+from dataset.gameFilter import GameFilter, read_filtered_game, time_control_speed
+from dataset.pgnIndex import build_index, index_path_for
+
+
+MOVETEXTS = ['1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7#', '1. f3 e5 2. g4 Qh4#', '1. d4 d5', '1. c4 e5 2. Nc3 Nf6 3. g3 d5']
+
+
+def game_headers(n):
+    # Varied headers, every third game has no PlyCount header
+    headers = {'WhiteElo': str(1200 + 150 * (n % 7)) if n % 11 != 0 else '?', 'BlackElo': str(1300 + 100 * (n % 5)),
+               'Result': ['1-0', '0-1', '1/2-1/2'][n % 3], 'TimeControl': ['60+0', '180+2', '600+5', '-'][n % 4],
+               'Termination': ['Normal', 'Time forfeit'][n % 2]}
+    if n % 3 != 0:
+        headers['PlyCount'] = str(chess.pgn.read_game(io.StringIO(MOVETEXTS[n % 4])).end().ply())
+    return headers
+
+
+def write_pgn(path, num_games=60):
+    with open(path, 'w') as f:
+        for n in range(num_games):
+            headers = ''.join(f'[{k} "{v}"]\n' for k, v in game_headers(n).items())
+            f.write(f'[Event "Game {n}"]\n{headers}\n{MOVETEXTS[n % 4]} {game_headers(n)["Result"]}\n\n')
+
+
+@pytest.mark.parametrize('time_control, speed', [
+    ('15+0', 'ultrabullet'), ('60+0', 'bullet'), ('180+2', 'blitz'), ('600+5', 'rapid'), ('1800+30', 'classical'), ('-', None), ('', None), (None, None),
+])
+def test_time_control_speed(time_control, speed):
+    assert time_control_speed(time_control) == speed
+
+
+def test_matches_headers():
+    headers = {'WhiteElo': '1600', 'BlackElo': '1800', 'Result': '1-0', 'TimeControl': '180+2', 'Termination': 'Normal', 'PlyCount': '40'}
+
+    assert GameFilter().matches_headers(headers)
+    assert GameFilter(min_elo=1600, max_elo=1800).matches_headers(headers)
+    assert not GameFilter(min_elo=1700).matches_headers(headers)
+    assert not GameFilter(max_elo=1700).matches_headers(headers)
+    assert not GameFilter(min_elo=1000).matches_headers({**headers, 'WhiteElo': '?'})
+    assert GameFilter(time_controls=['blitz']).matches_headers(headers)
+    assert GameFilter(time_controls=['180+2']).matches_headers(headers)
+    assert not GameFilter(time_controls=['bullet', 'rapid']).matches_headers(headers)
+    assert not GameFilter(results=['0-1']).matches_headers(headers)
+    assert not GameFilter(terminations=['Time forfeit']).matches_headers(headers)
+    assert not GameFilter(min_plies=41).matches_headers(headers)
+    assert GameFilter(min_plies=41).matches_headers({k: v for k, v in headers.items() if k != 'PlyCount'})
+
+
+def test_matches_game_checks_plies_on_the_parsed_game():
+    game = chess.pgn.read_game(io.StringIO(MOVETEXTS[1]))
+    assert GameFilter(min_plies=4, max_plies=4).matches_game(game)
+    assert not GameFilter(min_plies=5).matches_game(game)
+    assert GameFilter(min_elo=3000).matches_game(game)
+
+
+@pytest.mark.parametrize('game_filter', [
+    GameFilter(min_elo=1400),
+    GameFilter(max_elo=1700, time_controls=['bullet', '600+5']),
+    GameFilter(results=['1-0', '1/2-1/2'], terminations=['Normal']),
+    GameFilter(min_plies=4, max_plies=7),
+])
+def test_mask_agrees_with_matches_headers(tmp_path, game_filter):
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path)
+    index = build_index(pgn_path, headers=game_filter.headers(), enable_tqdm=False)
+
+    expected = [game_filter.matches_headers(game_headers(n)) for n in range(60)]
+    assert game_filter.mask(index).tolist() == expected
+    assert game_filter.select(index, 10, 30).tolist() == [n for n in range(10, 30) if expected[n]]
+
+
+def test_read_filtered_game(tmp_path):
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path, num_games=4)
+    game_filter = GameFilter(results=['0-1'])
+
+    with open(pgn_path) as f:
+        assert read_filtered_game(f, game_filter) is False
+        assert read_filtered_game(f, game_filter).headers['Event'] == 'Game 1'
+        assert read_filtered_game(f, game_filter) is False
+        assert read_filtered_game(f, game_filter) is False
+        assert read_filtered_game(f, game_filter) is None
+
+
+@pytest.mark.parametrize('game_filter', [None, GameFilter(min_elo=1400), GameFilter(min_plies=5, results=['1-0', '0-1'])])
+def test_shards_agree_with_and_without_index(tmp_path, game_filter):
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path)
+
+    def shards(use_index):
+        return [list(generate_samples(pgn_path, num_games=50, offset=3, use_FEN=True, random_seed=0, shard=s, num_shards=3,
+                                      use_index=use_index, game_filter=game_filter))
+                for s in range(3)]
+
+    plain = shards(False)
+    assert not os.path.exists(index_path_for(pgn_path))
+    indexed = shards(True)
+    assert os.path.exists(index_path_for(pgn_path))
+
+    assert indexed == plain
+    assert sum(len(s) for s in plain) > 0
@@ -0,0 +1,117 @@
+import chess
+import pytest
+import torch
+
+from bot.GRPOBot import LegalMoveLogitsProcessor, MoveBoundaryCriteria, move_log_prob, san_trie, trie_depth
+
+
+class CharTokenizer():
+    # One token per character (its code point), token 0 is the end of sequence (and padding) token
+    eos_token_id = 0
+    pad_token_id = 0
+
+    def __call__(self, text, add_special_tokens=True):
+        return {'input_ids': [ord(c) for c in text]}
+
+    def decode(self, ids, skip_special_tokens=False):
+        return ''.join(chr(i) for i in ids if not (skip_special_tokens and i == self.eos_token_id))
+
+    def batch_decode(self, batch, skip_special_tokens=False):
+        return [self.decode(ids, skip_special_tokens) for ids in batch.tolist()]
+
+
+def encode(text):
+    return [ord(c) for c in text]
+
+
+@pytest.mark.parametrize('continuation, stop', [
+    ('e4 ', True),
+    ('Qxf7#\n', True),
+    ('e4 e5', True),
+    ('Nf3', False),
+    ('   ', False),
+    ('', False),
+])
+def test_move_boundary_criteria(continuation, stop):
+    tokenizer = CharTokenizer()
+    prompt = encode('fen ')
+    criteria = MoveBoundaryCriteria(tokenizer, len(prompt))
+    assert criteria(torch.tensor([prompt + encode(continuation)]), None).tolist() == [stop]
+
+
+def test_move_boundary_criteria_is_per_row():
+    tokenizer = CharTokenizer()
+    prompt = encode('fen ')
+    stop = MoveBoundaryCriteria(tokenizer, len(prompt))(torch.tensor([prompt + encode('e4 '), prompt + encode('Nf3')]), None)
+    assert stop.tolist() == [True, False]
+    assert stop.dtype == torch.bool
+
+
+def test_move_log_prob_sums_the_tokens_of_the_first_move():
+    tokenizer = CharTokenizer()
+    tokens = encode(' Nf3 e5')
+    log_probs = [-0.5, -0.1, -0.2, -0.3, -1.0, -1.0, -1.0]
+
+    move, total = move_log_prob(tokenizer, tokens, log_probs)
+    assert move == 'Nf3'
+    assert total == pytest.approx(-1.1)
+
+
+def test_move_log_prob_stops_at_the_end_of_sequence():
+    tokenizer = CharTokenizer()
+    move, total = move_log_prob(tokenizer, encode('e4') + [0, 0], [-0.25, -0.25, -5.0, -5.0])
+    assert move == 'e4'
+    assert total == pytest.approx(-0.5)
+
+    assert move_log_prob(tokenizer, [0], [-1.0]) == ('', 0.0)
+
+
+def test_san_trie():
+    tokenizer = CharTokenizer()
+    trie = san_trie(tokenizer, ['e4', 'e3', 'Nf3'])
+
+    assert set(trie) == {ord('e'), ord('N')}
+    assert trie[ord('e')][ord('4')][None] == 'e4'
+    assert trie[ord('e')][ord('3')][None] == 'e3'
+    assert None not in trie[ord('e')]
+    assert trie[ord('N')][ord('f')][ord('3')] == {None: 'Nf3'}
+    assert trie_depth(trie) == 3
+
+
+def spell(processor, prompt, rows, vocab_size=128):
+    # Greedy decoding under the processor with uniform logits, lowest allowed token first
+    input_ids = torch.tensor([prompt] * rows)
+    for _ in range(8):
+        scores = processor(input_ids, torch.zeros(rows, vocab_size))
+        allowed = [torch.nonzero(row > float('-inf')).flatten().tolist() for row in scores]
+        input_ids = torch.cat([input_ids, torch.tensor([[a[0]] for a in allowed])], dim=1)
+    return input_ids[:, len(prompt):].tolist(), allowed
+
+
+def test_legal_move_logits_processor_spells_only_legal_moves():
+    tokenizer = CharTokenizer()
+    boards = [chess.Board(), chess.Board('4k3/8/8/8/8/8/8/R3K3 w Q - 0 1')]
+    tries = [san_trie(tokenizer, [board.san(move) for move in board.legal_moves]) for board in boards]
+    prompt = encode('fen ')
+    processor = LegalMoveLogitsProcessor(tries, len(prompt), tokenizer.eos_token_id)
+
+    tokens, allowed = spell(processor, prompt, len(boards))
+    for board, row in zip(boards, tokens):
+        san = tokenizer.decode(row, skip_special_tokens=True)
+        assert board.parse_san(san) in board.legal_moves
+    # Finished rows only ever get the end of sequence token
+    assert allowed == [[0], [0]]
+
+
+def test_legal_move_logits_processor_masks_every_other_token():
+    tokenizer = CharTokenizer()
+    trie = san_trie(tokenizer, ['e4', 'e3', 'e'])
+    prompt = encode('fen ')
+    processor = LegalMoveLogitsProcessor([trie], len(prompt), tokenizer.eos_token_id)
+
+    scores = processor(torch.tensor([prompt]), torch.zeros(1, 128))
+    assert torch.nonzero(scores[0] > float('-inf')).flatten().tolist() == [ord('e')]
+
+    # A complete move that prefixes longer ones allows both the end of sequence token and its continuations
+    scores = processor(torch.tensor([prompt + encode('e')]), torch.zeros(1, 128))
+    assert torch.nonzero(scores[0] > float('-inf')).flatten().tolist() == [0, ord('3'), ord('4')]
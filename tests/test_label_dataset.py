@@ -0,0 +1,81 @@
+import os
+
+import chess
+import pytest
+
+from dataset import labelDataset
+from dataset.labelDataset import label_samples, load_labels, position_hash
+
+
+class FakePool():
+    def __init__(self, path, size=1, options=None):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def searched(monkeypatch):
+    # Replaces the engine by the first legal move, recording every searched position
+    searched = []
+
+    def best_move(pool, board, limit):
+        searched.append(board.fen())
+        return board.san(next(iter(board.legal_moves)))
+
+    monkeypatch.setattr(labelDataset, 'EnginePool', FakePool)
+    monkeypatch.setattr(labelDataset, 'best_move', best_move)
+    return searched
+
+
+def positions(num):
+    board = chess.Board()
+    fens = []
+    for _ in range(num):
+        fens.append(board.fen())
+        board.push(next(iter(board.legal_moves)))
+    return fens
+
+
+def test_labels_every_distinct_position_once(tmp_path, searched):
+    fens = positions(5)
+    samples = [(fen, 'old') for fen in fens + fens[:2]]
+    labeled = label_samples(samples, str(tmp_path), n_jobs=2, shard_size=3, enable_tqdm=False)
+
+    assert sorted(searched) == sorted(fens)
+    assert [prompt for prompt, _ in labeled] == [prompt for prompt, _ in samples]
+    for prompt, move in labeled:
+        assert chess.Board(prompt).parse_san(move) in chess.Board(prompt).legal_moves
+    assert len(load_labels(str(tmp_path))) == len(fens)
+
+
+def test_resume_searches_only_missing_positions(tmp_path, searched):
+    fens = positions(8)
+    first = label_samples([(fen, 'old') for fen in fens[:5]], str(tmp_path), shard_size=2, enable_tqdm=False)
+    assert len(searched) == 5
+    files = sorted(os.listdir(tmp_path))
+
+    # Reordered and extended: the new positions land anywhere in the list and in new checkpoint files
+    searched.clear()
+    samples = [(fen, 'old') for fen in reversed(fens)]
+    second = label_samples(samples, str(tmp_path), shard_size=2, enable_tqdm=False)
+
+    assert sorted(searched) == sorted(fens[5:])
+    assert set(files) < set(os.listdir(tmp_path))
+    assert dict(second)[fens[0]] == dict(first)[fens[0]]
+    assert len(load_labels(str(tmp_path))) == len(fens)
+
+
+def test_fully_labeled_run_never_starts_engines(tmp_path, searched, monkeypatch):
+    fens = positions(3)
+    label_samples([(fen, 'old') for fen in fens], str(tmp_path), enable_tqdm=False)
+    searched.clear()
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError('engine pool started')
+
+    monkeypatch.setattr(labelDataset, 'EnginePool', no_pool)
+    labeled = label_samples([(fen, 'old') for fen in fens], str(tmp_path), enable_tqdm=False)
+    assert searched == []
+    assert [position_hash(chess.Board(prompt)) for prompt, _ in labeled] == [position_hash(chess.Board(fen)) for fen in fens]
@@ -0,0 +1,84 @@
+import json
+import os
+
+import pyarrow.parquet as pq
+import pytest
+
+from dataset.parquetShards import ShardWriter, json_to_shards, shard_paths, write_shards
+
+
+SAMPLES = [(f'prompt {n}', f'move{n}') for n in range(10)]
+
+
+def read_rows(out_dir):
+    return [row for path in shard_paths(out_dir) for row in pq.read_table(path).to_pylist()]
+
+
+def test_shards_roll_over_at_max_rows(tmp_path):
+    out_dir = str(tmp_path / 'shards')
+    paths = write_shards(SAMPLES, out_dir, max_rows=4, row_group_size=3)
+
+    assert [os.path.basename(p) for p in paths] == ['shard_00000.parquet', 'shard_00001.parquet', 'shard_00002.parquet']
+    assert [pq.ParquetFile(p).metadata.num_rows for p in paths] == [4, 4, 2]
+    assert pq.ParquetFile(paths[0]).metadata.num_row_groups == 2
+    assert read_rows(out_dir) == [{'prompt': p, 'completion': c} for p, c in SAMPLES]
+    assert not os.path.exists(out_dir + '.tmp')
+
+
+def test_shards_roll_over_at_max_bytes(tmp_path):
+    # 'é' is two bytes in UTF-8, every sample is 6 bytes
+    out_dir = str(tmp_path / 'shards')
+    paths = write_shards([('éé', 'ab')] * 5, out_dir, max_bytes=12)
+    assert [pq.ParquetFile(p).metadata.num_rows for p in paths] == [2, 2, 1]
+
+
+def test_existing_shards_need_overwrite(tmp_path):
+    out_dir = str(tmp_path / 'shards')
+    write_shards(SAMPLES[:3], out_dir)
+
+    with pytest.raises(FileExistsError):
+        ShardWriter(out_dir)
+
+    write_shards(SAMPLES[3:4], out_dir, overwrite=True)
+    assert read_rows(out_dir) == [{'prompt': 'prompt 3', 'completion': 'move3'}]
+
+
+def test_failed_write_leaves_the_dataset_untouched(tmp_path):
+    out_dir = str(tmp_path / 'shards')
+    write_shards(SAMPLES[:3], out_dir)
+
+    def samples():
+        yield from SAMPLES
+        raise RuntimeError('interrupted')
+
+    with pytest.raises(RuntimeError):
+        write_shards(samples(), out_dir, max_rows=2, overwrite=True)
+
+    assert read_rows(out_dir) == [{'prompt': p, 'completion': c} for p, c in SAMPLES[:3]]
+    assert not os.path.exists(out_dir + '.tmp')
+
+
+def test_abort(tmp_path):
+    out_dir = str(tmp_path / 'shards')
+    writer = ShardWriter(out_dir, max_rows=2)
+    writer.write_many(SAMPLES)
+    writer.abort()
+
+    assert writer.paths == []
+    assert shard_paths(out_dir) == []
+    assert not os.path.exists(out_dir + '.tmp')
+
+
+def test_count_column(tmp_path):
+    out_dir = str(tmp_path / 'shards')
+    write_shards([('a', 'b', 3), ('c', 'd', 1)], out_dir, with_counts=True)
+    assert read_rows(out_dir) == [{'prompt': 'a', 'completion': 'b', 'count': 3}, {'prompt': 'c', 'completion': 'd', 'count': 1}]
+
+
+def test_json_to_shards(tmp_path):
+    json_path = str(tmp_path / 'data.json')
+    with open(json_path, 'w') as f:
+        json.dump([{'prompt': 'a', 'completion': 'b', 'count': 2}], f)
+
+    json_to_shards(json_path, str(tmp_path / 'shards'))
+    assert read_rows(str(tmp_path / 'shards')) == [{'prompt': 'a', 'completion': 'b', 'count': 2}]
@@ -0,0 +1,87 @@
+import chess.pgn
+
+from dataset.pgnIndex import build_index, load_index
+
+
+GAMES = [
+    ('1500', '1600', '1-0', '1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0'),
+    ('?', '2100', '0-1', '1. f3 e5 2. g4 Qh4# 0-1'),
+    ('1800', '1750', '1/2-1/2', '1. d4 d5 1/2-1/2'),
+]
+
+
+def write_pgn(path, games=GAMES):
+    with open(path, 'w', newline='\n') as f:
+        for n, (white_elo, black_elo, result, movetext) in enumerate(games):
+            f.write(f'[Event "Game {n}"]\n[WhiteElo "{white_elo}"]\n[BlackElo "{black_elo}"]\n[Result "{result}"]\n\n{movetext}\n\n')
+
+
+def test_offsets_point_at_game_starts(tmp_path):
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path)
+    index = build_index(pgn_path, enable_tqdm=False)
+
+    assert len(index) == len(GAMES)
+    with open(pgn_path, 'rb') as f:
+        data = f.read()
+    for n, offset in enumerate(index.offsets):
+        assert data[offset:].startswith(f'[Event "Game {n}"]'.encode())
+
+
+def test_read_game_in_any_order(tmp_path):
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path)
+    index = build_index(pgn_path, enable_tqdm=False)
+
+    with open(pgn_path) as f:
+        for n in [2, 0, 1]:
+            game = index.read_game(f, n)
+            assert game.headers['Event'] == f'Game {n}'
+            assert game.headers['Result'] == GAMES[n][2]
+            assert game.end().board().is_checkmate() == (n != 2)
+
+
+def test_headers(tmp_path):
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path)
+    index = build_index(pgn_path, enable_tqdm=False)
+
+    # Missing or '?' Elo is stored as -1
+    assert index.headers['WhiteElo'].tolist() == [1500, -1, 1800]
+    assert index.headers['BlackElo'].tolist() == [1600, 2100, 1750]
+    assert index.headers['Result'].tolist() == ['1-0', '0-1', '1/2-1/2']
+
+
+def test_load_index_rebuilds_stale_sidecar(tmp_path):
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path, GAMES[:2])
+    assert load_index(pgn_path, build=False) is None
+    assert len(load_index(pgn_path)) == 2
+
+    # A sidecar built for a file of a different size is rebuilt
+    write_pgn(pgn_path)
+    assert load_index(pgn_path, build=False) is None
+    index = load_index(pgn_path)
+    assert len(index) == 3
+
+    # A sidecar lacking a requested header is rebuilt with it
+    index = load_index(pgn_path, headers=('Event',))
+    assert index.headers['Event'].tolist() == ['Game 0', 'Game 1', 'Game 2']
+    assert 'WhiteElo' in index.headers
+
+
+def test_chess_dataset_selects_the_same_games_with_and_without_index(tmp_path):
+    from dataset.chessDataset import ChessDataset
+
+    first_moves = ['a3', 'b3', 'c3', 'd3', 'e3', 'f3', 'g3', 'h3']
+    games = [('1500', '1500', '1-0', f'1. {move} e5 2. Nf3 Nc6 3. Bb5 a6 1-0') for move in first_moves]
+    pgn_path = str(tmp_path / 'games.pgn')
+    write_pgn(pgn_path, games)
+
+    plain = ChessDataset(num_games=2, pgn_path=pgn_path, offset=1, random_seed=0).games
+    build_index(pgn_path, enable_tqdm=False)
+    indexed = ChessDataset(num_games=2, pgn_path=pgn_path, offset=1, random_seed=0).games
+
+    # The kept games start num_games after offset (ChessDataset's original selection)
+    assert [prompt.split()[1] for prompt, _ in plain] == ['d3', 'e3']
+    assert indexed == plain
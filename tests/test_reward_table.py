@@ -0,0 +1,51 @@
+import chess
+import numpy as np
+import pytest
+
+from reward_table import RewardTable, valid_scores
+
+
+@pytest.fixture
+def table(tmp_path):
+    board = chess.Board()
+    path = str(tmp_path / 'data.rewards.npz')
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, positions=np.array([board.epd()], dtype=str), starts=np.array([0, 2], dtype=np.int64),
+                            moves=np.array(['e4', 'Nf3'], dtype=str), rewards=np.array([0.6, 0.55], dtype=np.float32))
+    return RewardTable(path)
+
+
+def test_get(table):
+    epd = chess.Board().epd()
+    assert table.get(epd, 'e4') == pytest.approx(0.6)
+    assert table.get(epd, 'd4') is None
+    assert table.get('8/8/8/8/8/8/8/8 w - -', 'e4') is None
+
+
+def test_evaluate_canonicalizes_san(table):
+    assert table.evaluate([chess.STARTING_FEN] * 2, ['Nf3', 'Ng1f3']) == pytest.approx([0.55, 0.55])
+
+
+def test_misses_go_to_fallback(table):
+    calls = []
+
+    def fallback(prompts, completions):
+        calls.append((prompts, completions))
+        return [0.3] * len(prompts)
+
+    prompts = [chess.STARTING_FEN] * 4
+    results = table.evaluate(prompts, ['e4', 'd4', 'e5', 'Nc3'], fallback=fallback, return_messages=True)
+
+    assert calls == [([chess.STARTING_FEN] * 2, ['d4', 'Nc3'])]
+    assert [score for score, _ in results] == pytest.approx([0.6, 0.3, -1, 0.3])
+    assert [message for _, message in results] == ['Valid move', 'Valid move', 'No piece reaches destination', 'Valid move']
+    assert table.stats() == {'positions': 1, 'lookups': 3, 'misses': 2}
+
+
+def test_misses_without_fallback_are_neutral(table):
+    assert table.evaluate([chess.STARTING_FEN] * 2, ['d4', 'e4']) == pytest.approx([0.5, 0.6])
+
+
+def test_valid_scores_drop_failed_searches():
+    results = [(0.7, 'Valid move'), (0.5, 'Unknown error'), (0.2, 'Valid move')]
+    assert valid_scores(['e4', 'd4', 'c4'], results) == {'e4': 0.7, 'c4': 0.2}
@@ -1,7 +1,6 @@
 import time
 import os
 
-from datasets import load_dataset
 from trl import GRPOConfig, GRPOTrainer
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from transformers import AutoModelForCausalLM, TrainingArguments
@@ -9,24 +8,48 @@ import torch
 from joblib import Parallel, delayed
 
 from dataset.chessDataset import ChessDataset
+from dataset.parquetShards import load_shards, shard_paths, json_to_shards
+from dataset.dedupDataset import weighted_indices
 from evaluation import evaluate_position
 from batch_eval import batch_eval
+from eval_cache import configure_cache
+from reward_table import load_reward_table
 
 
-dataset_path = "data/small_data.json"
+dataset_path = "data/small_shards"
 pgn_path = 'data/lichess_db_standard_rated_2017-03.pgn'
-if not os.path.exists(dataset_path):
-    _ = ChessDataset(pgn_path=pgn_path, use_FEN=True, num_games=1000, end_in='white', save_processed_to_json=dataset_path)
-dataset = load_dataset('json', data_files=dataset_path, split='train')
+# Datasets prepared as JSON by earlier versions are converted instead of rebuilt
+legacy_path = 'data/small_data.json'
+if len(shard_paths(dataset_path)) == 0 and os.path.exists(legacy_path):
+    json_to_shards(legacy_path, dataset_path)
+if len(shard_paths(dataset_path)) == 0:
+    _ = ChessDataset(pgn_path=pgn_path, use_FEN=True, num_games=1000, end_in='white', save_processed_to_parquet=dataset_path, dedup=True)
+dataset = load_shards(dataset_path)
+# Deduplicated positions are drawn by their occurrence counts with frequent (opening) positions down-weighted,
+# GRPOTrainer builds its own sampler, so the draw is applied to the dataset
+if 'count' in dataset.column_names:
+    dataset = dataset.select(weighted_indices(dataset['count'], alpha=0.5, seed=0))
+
+# Rewards of positions seen in earlier epochs (or earlier runs) are served from the cache
+configure_cache(max_size=500_000, path='data/eval_cache.sqlite')
 
 save_name = time.strftime("%Y%m%d-%H%M%S")
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+# With a reward table next to the dataset (python reward_table.py) rewards are lookups, the engine only scores table misses
+reward_table = load_reward_table(dataset_path)
+
+
+def live_reward(prompts, completions):
+    return batch_eval(prompts, completions, 24, enable_tqdm=False, group_moves=True)
+
+
 def reward_move(completions, **kwargs):
     prompts = kwargs["prompts"]
-    rewards = batch_eval(prompts, completions, 24, enable_tqdm=False)
-    return rewards
+    if reward_table is not None:
+        return reward_table.evaluate(prompts, completions, fallback=live_reward)
+    return live_reward(prompts, completions)
 
 
 model = AutoModelForCausalLM.from_pretrained("saved/models/fb-chess-model-final").to(device)
@@ -1,6 +1,6 @@
-from datasets import load_dataset
 from trl import SFTConfig, SFTTrainer
 from dataset.chessDataset import ChessDataset
+from dataset.parquetShards import load_shards, shard_paths, json_to_shards
 
 import time
 import os
@@ -11,9 +11,15 @@ max_length = 64
 save_name = time.strftime("%Y%m%d-%H%M%S")
 pgn_path = 'data/lichess_db_standard_rated_2017-02.pgn'
 
-if not os.path.exists('data/subset_data.json'):
-    _ = ChessDataset(pgn_path=pgn_path, use_FEN=True, num_games=num_games, end_in='white', save_processed_to_json='data/subset_data.json')
-dataset = load_dataset('json', data_files='data/subset_data.json', split='train')
+shard_dir = 'data/subset_shards'
+
+# Datasets prepared as JSON by earlier versions are converted instead of rebuilt
+legacy_path = 'data/subset_data.json'
+if len(shard_paths(shard_dir)) == 0 and os.path.exists(legacy_path):
+    json_to_shards(legacy_path, shard_dir)
+if len(shard_paths(shard_dir)) == 0:
+    _ = ChessDataset(pgn_path=pgn_path, use_FEN=True, num_games=num_games, end_in='white', save_processed_to_parquet=shard_dir, n_jobs=-1)
+dataset = load_shards(shard_dir)
 
 training_args = SFTConfig(
     max_length=max_length,